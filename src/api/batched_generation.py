@@ -0,0 +1,273 @@
+import time
+import logging
+import threading
+from typing import List,Optional,Dict,Callable,Tuple
+
+import torch
+from transformers import GenerationConfig
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from .streaming import TokenStream,StopWordMatcher,IncrementalDetokenizer
+
+logger = logging.getLogger(__name__)
+
+PastKeyValues = Tuple[Tuple[torch.Tensor,...],...]
+
+def build_logits_processor(config:GenerationConfig)->LogitsProcessorList:
+    processors = LogitsProcessorList()
+    if config.repetition_penalty is not None and config.repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty=config.repetition_penalty))
+    if config.do_sample:
+        if config.temperature is not None and config.temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(config.temperature))
+        if config.top_k is not None and config.top_k > 0:
+            processors.append(TopKLogitsWarper(top_k=config.top_k))
+        if config.top_p is not None and config.top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p=config.top_p))
+    return processors
+
+def eos_token_ids(model,tokenizer)->List[int]:
+    eos_token_id = getattr(model.generation_config,"eos_token_id",None) if hasattr(model,"generation_config") else None
+    if eos_token_id is None:
+        eos_token_id = tokenizer.eos_token_id
+    return [eos_token_id] if isinstance(eos_token_id,int) else list(eos_token_id or [])
+
+def _left_pad(tensor:torch.Tensor,length:int,dim:int)->torch.Tensor:
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([torch.zeros(shape,dtype=tensor.dtype,device=tensor.device),tensor],dim=dim)
+
+
+class BatchedSequence():
+    """
+    A single chat stream in the `BatchedGenerationEngine`, with its own sampling settings, stop words and `TokenStream`.
+    """
+    def __init__(self,prepare_inputs:Callable[[],Dict],generation_config:GenerationConfig,tokenizer,eos_token_ids:List[int],stop_words:List[str]=None) -> None:
+        self.prepare_inputs = prepare_inputs
+        self.config = generation_config
+        self.eos_token_ids = eos_token_ids
+        self.prompt_ids:List[int] = []
+        self.generated_ids:List[int] = []
+        self.stream = TokenStream(max_buffer=None)
+        self.stop_word_matcher = StopWordMatcher(stop_words or [])
+        self.detokenizer = IncrementalDetokenizer(tokenizer,skip_special_tokens=True)
+        self.logits_processor = build_logits_processor(generation_config)
+        self.stop_reason:Optional[str] = None
+
+    @property
+    def max_new_tokens(self)->int:
+        if self.config.max_new_tokens is not None:
+            return self.config.max_new_tokens
+        return max(1,self.config.max_length-len(self.prompt_ids))
+
+    def scores(self,logits:torch.Tensor,token_ids:Optional[List[int]]=None)->torch.Tensor:
+        """
+        Applies the penalties and warpers of the config to the logits of one position (shape (1,vocab)).
+        `token_ids` are the tokens before the position, by default the sequence so far.
+        """
+        scores = logits.float()
+        if len(self.logits_processor) > 0:
+            token_ids = token_ids if token_ids is not None else self.prompt_ids+self.generated_ids
+            scores = self.logits_processor(torch.tensor([token_ids],device=logits.device),scores)
+        return scores
+
+    def next_token(self,logits:torch.Tensor)->int:
+        """
+        Picks the next token from the logits of the last position (shape (1,vocab)).
+        """
+        scores = self.scores(logits)
+        if self.config.do_sample:
+            return int(torch.multinomial(torch.softmax(scores,dim=-1),num_samples=1))
+        return int(scores.argmax(dim=-1))
+
+    def accept(self,token:int)->bool:
+        """
+        Appends the token and streams its text. Returns False once the sequence is finished.
+        """
+        if self.stream.cancelled:
+            return self.finish("Cancelled!")
+        if token in self.eos_token_ids:
+            return self.finish("End of sequence!")
+
+        self.generated_ids.append(token)
+        released,stopped = self.stop_word_matcher.feed(self.detokenizer.put([token]))
+        if len(released) > 0:
+            self.stream.put(released)
+        if stopped:
+            return self.finish("Stopword detected!")
+        if len(self.generated_ids) >= self.max_new_tokens:
+            return self.finish("Max Tokens!")
+        return True
+
+    def finish(self,reason:str)->bool:
+        if self.stop_reason is None:
+            released,_ = self.stop_word_matcher.feed(self.detokenizer.flush())
+            released += self.stop_word_matcher.flush()
+            if len(released) > 0:
+                self.stream.put(released)
+            self.stop_reason = reason
+            self.stream.completion_tokens = len(self.generated_ids)
+            self.stream.end(reason)
+        return False
+
+
+class BatchedGenerationEngine():
+    """
+    Decodes the active sequences of a causal LM together, one token per sequence and step.
+    New sequences are prefilled and join between steps, finished or cancelled ones leave, the batched kv-cache is left padded
+    to the longest sequence. Needs a model whose kv-cache layers are (batch,heads,length,head_dim) tensors, e.g. Llama or GPT-2.
+    """
+    def __init__(self,model,tokenizer,device:str="cuda",max_batch_size:int=8) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.condition = threading.Condition()
+        self.thread:Optional[threading.Thread] = None
+        self.pending:List[BatchedSequence] = []
+
+        #Batched decoding state, only touched by the decode thread
+        self.active:List[BatchedSequence] = []
+        self.past_key_values:Optional[PastKeyValues] = None
+        self.attention_mask:Optional[torch.Tensor] = None
+        self.positions:List[int] = []
+        self.next_tokens:List[int] = []
+
+        self.steps = 0
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+
+        self.eos_token_ids = eos_token_ids(model,tokenizer)
+
+    def submit(self,prepare_inputs:Callable[[],Dict],generation_config:GenerationConfig,stop_words:List[str]=None)->BatchedSequence:
+        """
+        Queues a sequence. `prepare_inputs` is called on the decode thread and returns the `input_ids` and optionally
+        the `past_key_values` of all but the last prompt token, like the keyword arguments of `model.generate`.
+        """
+        sequence = BatchedSequence(prepare_inputs,generation_config,self.tokenizer,self.eos_token_ids,stop_words)
+        with self.condition:
+            self.pending.append(sequence)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,daemon=True)
+                self.thread.start()
+        return sequence
+
+    def stats(self)->Dict[str,float]:
+        return {
+            "steps":self.steps,
+            "generated_tokens":self.generated_tokens,
+            "tokens_per_second":self.generated_tokens/self.generation_seconds if self.generation_seconds > 0 else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            with self.condition:
+                joining = self.pending[:max(0,self.max_batch_size-len(self.active))]
+                del self.pending[:len(joining)]
+                if len(joining) == 0 and len(self.active) == 0:
+                    self.thread = None
+                    return
+            try:
+                with torch.no_grad():
+                    for sequence in joining:
+                        self._prefill(sequence)
+                    if len(self.active) > 0:
+                        self._step()
+            except Exception as e:
+                logger.exception(e)
+                for sequence in self.active+joining:
+                    sequence.finish("Error!")
+                self._reset()
+
+    def _reset(self):
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.positions = []
+        self.next_tokens = []
+
+    def _prefill(self,sequence:BatchedSequence):
+        if sequence.stream.cancelled:
+            sequence.finish("Cancelled!")
+            return
+        started = time.perf_counter()
+        inputs = sequence.prepare_inputs()
+        input_ids = inputs["input_ids"].to(self.device)
+        past_key_values = inputs.get("past_key_values")
+        sequence.prompt_ids = input_ids[0].tolist()
+        sequence.stream.prompt_tokens = len(sequence.prompt_ids)
+        cached = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+
+        output = self.model(input_ids=input_ids[:,cached:],past_key_values=past_key_values,use_cache=True)
+        token = sequence.next_token(output.logits[:,-1,:])
+        self.generated_tokens += 1
+        self.generation_seconds += time.perf_counter()-started
+        if sequence.accept(token):
+            self._join(sequence,output.past_key_values,len(sequence.prompt_ids),token)
+
+    def _join(self,sequence:BatchedSequence,past_key_values:PastKeyValues,length:int,token:int):
+        attention_mask = torch.ones((1,length),dtype=torch.long,device=self.device)
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+        else:
+            total = max(self.attention_mask.shape[1],length)
+            self.past_key_values = tuple(
+                tuple(torch.cat([_left_pad(batched,total,2),_left_pad(single,total,2)],dim=0) for batched,single in zip(batched_layer,single_layer))
+                for batched_layer,single_layer in zip(self.past_key_values,past_key_values)
+            )
+            self.attention_mask = torch.cat([_left_pad(self.attention_mask,total,1),_left_pad(attention_mask,total,1)],dim=0)
+        self.active.append(sequence)
+        self.positions.append(length)
+        self.next_tokens.append(token)
+
+    def _step(self):
+        started = time.perf_counter()
+        input_ids = torch.tensor([[token] for token in self.next_tokens],device=self.device)
+        position_ids = torch.tensor([[position] for position in self.positions],device=self.device)
+        attention_mask = torch.cat([self.attention_mask,torch.ones((len(self.active),1),dtype=torch.long,device=self.device)],dim=1)
+        output = self.model(input_ids=input_ids,
+                            past_key_values=self.past_key_values,
+                            attention_mask=attention_mask,
+                            position_ids=position_ids,
+                            use_cache=True)
+        self.past_key_values = output.past_key_values
+        self.attention_mask = attention_mask
+
+        logits = output.logits[:,-1,:]
+        keep = []
+        for i,sequence in enumerate(self.active):
+            self.positions[i] += 1
+            self.next_tokens[i] = sequence.next_token(logits[i:i+1])
+            if sequence.accept(self.next_tokens[i]):
+                keep.append(i)
+        self.steps += 1
+        self.generated_tokens += len(self.active)
+        self.generation_seconds += time.perf_counter()-started
+        if len(keep) < len(self.active):
+            self._leave(keep)
+
+    def _leave(self,keep:List[int]):
+        """
+        Removes the finished sequences from the batch and drops the padding columns no remaining sequence needs.
+        """
+        if len(keep) == 0:
+            self._reset()
+            return
+        index = torch.tensor(keep,device=self.device)
+        attention_mask = self.attention_mask.index_select(0,index)
+        padding = int((attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        self.attention_mask = attention_mask[:,padding:]
+        self.past_key_values = tuple(tuple(tensor.index_select(0,index)[:,:,padding:,:] for tensor in layer) for layer in self.past_key_values)
+        self.active = [self.active[i] for i in keep]
+        self.positions = [self.positions[i] for i in keep]
+        self.next_tokens = [self.next_tokens[i] for i in keep]
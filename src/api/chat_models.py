@@ -1,5 +1,6 @@
-from typing import Dict,List,Generator,Type,Optional
-import openai
+from typing import Any,Dict,List,Generator,Type,Optional,Tuple
+import asyncio
+import concurrent.futures
 from transformers.generation.stopping_criteria import StoppingCriteriaList
 from transformers import AutoModel,AutoTokenizer,AutoModelForCausalLM,GenerationConfig,LlamaTokenizer,LlamaForCausalLM
 from llm_rs import Llama,SessionConfig,Precision
@@ -11,7 +12,17 @@ import logging
 from dependency_injector.providers import Configuration  
 from schemas.chat import ChatMessage,ModelInfo
 from .model_utils import GeneratorStreamer,ManualStopCondition,CPUStreamer
+from .streaming import TokenStream
+from .prefix_cache import PrefixStateCache
+from .batched_generation import BatchedGenerationEngine,BatchedSequence
+from .speculative import SpeculativeDecoder
+from .prompt_packing import PromptPacker,PackedMessages
+from .openai_client import OpenAIClient
+from .model_pool import ModelPool,split_threads
+from .model_registry import ModelRegistry
+from .thread_tuning import ThreadCalibration,thread_candidates
 import threading
+import time
 
 
 #gpu only dependencies:
@@ -22,18 +33,60 @@ try:
 except:
     pass
 
+CAN_COUNT_OPENAI_TOKENS=False
+try:
+    import tiktoken
+    CAN_COUNT_OPENAI_TOKENS=True
+except:
+    pass
+
+#Room for the BOS token and the trailing "AI:" of the prompt
+PROMPT_MARGIN=8
+
+#Fixed greedy generation which is timed to calibrate the thread count of the cpu model
+CALIBRATION_PROMPT="Explain in a few sentences how a steam engine works."
+CALIBRATION_TOKENS=32
+
 class ModelAdapter(ABC):
+    #The last user message and the reply before it are never dropped from the prompt
+    keep_last_messages:int = 2
+    packer:Optional[PromptPacker] = None
+    #Adapters which don't block the event loop implement `agenerate`
+    supports_async:bool = False
+    #Prompt template of retrieval augmented chats, see `rag.DEFAULT_RAG_TEMPLATES`
+    rag_template:str = "alpaca"
+    
     def __init__(self) -> None:
         pass
     
     @abstractmethod
-    def generate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->str:
+    def generate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Tuple[str,Optional[str]]:
+        """
+        Returns the generated text and the reason the generation stopped.
+        """
         pass
     
     @abstractmethod
     def generate_streaming(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Generator[str,None,None]:
         pass
     
+    def stream(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->TokenStream:
+        """
+        Starts the generation in the background and returns a stream of the generated text, which can also be consumed from an event loop.
+        """
+        stream = TokenStream()
+        def produce():
+            try:
+                for chunk in self.generate_streaming(messages,generationConfig,stop_words):
+                    if not stream.put(chunk):
+                        break
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                stream.end()
+        threading.Thread(target=produce,daemon=True).start()
+        return stream
+    
     @abstractmethod
     def load(self):
         pass
@@ -42,86 +95,241 @@ class ModelAdapter(ABC):
     def info(self)->ModelInfo:
         pass
     
+    def settings(self)->Dict[str,Any]:
+        """
+        The settings which affect the generation speed, reported next to the generation telemetry.
+        """
+        return {}
+    
     def default_config(self)->GenerationConfig:
         return GenerationConfig()
+    
+    def prefill(self,messages:List[ChatMessage]):
+        """
+        Evaluates messages which a following prompt will start with, so adapters with a prefix cache can reuse their state.
+        """
+        pass
+    
+    def warmup(self):
+        """
+        Generates a single token after loading, so the first request doesn't pay for lazy initialization and allocations.
+        """
+        config = self.default_config()
+        config.max_new_tokens = 1
+        self.generate([ChatMessage(role="user",content="Hello")],config)
+    
+    def is_deterministic(self,generationConfig:GenerationConfig)->bool:
+        """
+        If the same messages always produce the same output with this config.
+        """
+        return not generationConfig.do_sample or generationConfig.temperature == 0
+    
+    @abstractmethod
+    def count_tokens(self,text:str)->int:
+        pass
+    
+    def prompt_budget(self,generationConfig:GenerationConfig)->Optional[int]:
+        """
+        Max number of prompt tokens, None if the prompt isn't limited.
+        """
+        return None
+    
+    def pack_messages(self,messages:List[ChatMessage],generationConfig:GenerationConfig)->PackedMessages:
+        """
+        Drops or truncates older turns until the prompt fits into the `prompt_budget`.
+        """
+        budget = self.prompt_budget(generationConfig)
+        if budget is None:
+            return PackedMessages(messages=list(messages),tokens=0)
+        if self.packer is None:
+            self.packer = PromptPacker(self.count_tokens,_format_message,keep_last=self.keep_last_messages)
+        return self.packer.pack(messages,budget)
+
 
+OPENAI_STOP_REASONS = {"stop":"End of sequence!","length":"Max Tokens!","content_filter":"Content filtered!"}
 
 class ChatGPT_Adapter(ModelAdapter):
-    def __init__(self,token:str=None) -> None:
+    """
+    Adapter for the OpenAI chat completions API. Requests run on a private event loop with a pooled async http client,
+    so blocking callers (`generate`) and the event loop of the api (`agenerate`, `stream`) share the connections and the rate limit.
+    """
+    supports_async = True
+    rag_template = "chatgpt"
+    
+    def __init__(self,token:str=None,base_url:str="https://api.openai.com/v1",max_concurrency:int=4,max_retries:int=5,context_length:int=4096) -> None:
         self.token = token
         self.total_tokens = 0
         self.model_name = "gpt-3.5-turbo"
-        if token:
-            openai.api_key = token
-        else:
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.context_length = context_length
+        self.client:Optional[OpenAIClient] = None
+        self.loop:Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+        self.encoding = None
+        if not token:
             raise Exception("No OpenAI Token Provided! Please provide it over the envirnoment variable OPENAI_TOKEN or use the GPU or CPU models!")
     
     def load(self):
-        pass
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever,daemon=True,name="openai-client").start()
+        async def create_client():
+            return OpenAIClient(self.token,base_url=self.base_url,max_concurrency=self.max_concurrency,max_retries=self.max_retries)
+        self.client = self._run(create_client()).result()
+        if CAN_COUNT_OPENAI_TOKENS:
+            self.encoding = tiktoken.encoding_for_model(self.model_name)
     
     def info(self)->ModelInfo:
         return ModelInfo(name="OpenAI",model=self.model_name,accelerator="External API")
     
+    def settings(self)->Dict[str,Any]:
+        return {"base_url":self.base_url,"max_concurrency":self.max_concurrency,"context_length":self.context_length}
+    
     def default_config(self) -> GenerationConfig:
         return GenerationConfig(temperature=1,top_p=1,repetition_penalty=0,max_new_tokens=256)
     
-    def generate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->str:
-        
-        transformed_messages = [m.dict() for m in messages]
-        result = openai.ChatCompletion.create(
-                    model=self.model_name,
-                    messages=transformed_messages,
-                    temperature=generationConfig.temperature,
-                    top_p=generationConfig.top_p,
-                    frequency_penalty = generationConfig.repetition_penalty,
-                    max_tokens=generationConfig.max_new_tokens
-                    )
-        
-        used_tokens = result['usage']['total_tokens']
-        self.total_tokens += used_tokens
-        logging.info(f"OpenAI: Used {used_tokens} Tokens! Accumulated costs: ({(self.total_tokens/1000)*0.002}$)")
-        
-        return result['choices'][0]['message']['content']
+    def warmup(self):
+        #Nothing to warm up locally and every request costs money
+        pass
     
-    def generate_streaming(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Generator[str,None,None]:
-        transformed_messages = [m.dict() for m in messages]
-        tokens_of_request=0
-        for result in openai.ChatCompletion.create(
-                    model=self.model_name,
-                    messages=transformed_messages,
-                    temperature=generationConfig.temperature,
-                    top_p=generationConfig.top_p,
-                    frequency_penalty = generationConfig.repetition_penalty,
-                    max_tokens=generationConfig.max_new_tokens,
-                    stream=True
-                    ):
-            
-            delta = result['choices'][0]['delta']
-            if "role" in delta:
-                continue
-            elif "content" in delta:
-                yield delta['content']
-            else:
-                break
-            
-        self.total_tokens += tokens_of_request
-        logging.info(f"OpenAI: Used {tokens_of_request} Tokens! Accumulated costs: ({(self.total_tokens/1000)*0.002}$)")
+    def is_deterministic(self,generationConfig:GenerationConfig)->bool:
+        #The API always samples, only temperature 0 is (nearly) greedy
+        return generationConfig.temperature == 0
     
-def build_llm_prompt(messages:List[ChatMessage])->str:
-    prompt=""
+    def count_tokens(self,text:str)->int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        #Rough estimate if tiktoken isn't installed
+        return (len(text)+3)//4
     
-    for message in messages:
-        clean_content = message.content.strip('\n').strip()
-        if message.role == "system":
-            prompt += clean_content+"\n"
-        elif message.role == "user":
-            prompt += f"Human:{clean_content}\n"
-        elif message.role == "assistant":
-            prompt += f"AI:{clean_content}\n"
+    def count_message_tokens(self,messages:List[ChatMessage])->int:
+        #Every message is wrapped into a few special tokens and the reply is primed with 3 more
+        return sum(4+self.count_tokens(message.content) for message in messages)+3
+    
+    def prompt_budget(self,generationConfig:GenerationConfig)->Optional[int]:
+        return self.context_length-generationConfig.max_new_tokens-PROMPT_MARGIN
+    
+    def pack_messages(self,messages:List[ChatMessage],generationConfig:GenerationConfig)->PackedMessages:
+        if self.packer is None:
+            #The formatting of the messages is done by the API, each message costs 4 tokens on top of its content
+            self.packer = PromptPacker(lambda text:self.count_tokens(text)+4,lambda message:message.content,keep_last=self.keep_last_messages)
+        return super().pack_messages(messages,generationConfig)
+    
+    def _run(self,coroutine)->concurrent.futures.Future:
+        if self.loop is None:
+            raise Exception("The OpenAI adapter isn't loaded!")
+        return asyncio.run_coroutine_threadsafe(coroutine,self.loop)
+    
+    def _payload(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str])->Dict:
+        return {
+            "model":self.model_name,
+            "messages":[m.dict() for m in messages],
+            "temperature":generationConfig.temperature,
+            "top_p":generationConfig.top_p,
+            "frequency_penalty":generationConfig.repetition_penalty,
+            "max_tokens":generationConfig.max_new_tokens,
+            "stop":stop_words[:4] if stop_words else None,
+        }
+    
+    def _account(self,prompt_tokens:int,completion_tokens:int):
+        used_tokens = prompt_tokens+completion_tokens
+        with self.lock:
+            self.total_tokens += used_tokens
+            total_tokens = self.total_tokens
+        logging.info(f"OpenAI: Used {used_tokens} Tokens! Accumulated costs: ({(total_tokens/1000)*0.002}$)")
+    
+    async def _generate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Tuple[str,Optional[str]]:
+        result = await self.client.chat(self._payload(messages,generationConfig,stop_words))
+        usage = result.get("usage") or {}
+        choice = result['choices'][0]
+        content = choice['message']['content']
+        self._account(usage.get("prompt_tokens",self.count_message_tokens(messages)),usage.get("completion_tokens",self.count_tokens(content)))
+        finish_reason = choice.get("finish_reason")
+        return content,OPENAI_STOP_REASONS.get(finish_reason,finish_reason)
+    
+    async def _stream(self,stream:TokenStream,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[]):
+        payload = self._payload(messages,generationConfig,stop_words)
+        payload["stream_options"] = {"include_usage":True}
+        completion = []
+        usage = None
+        stop_reason = None
+        try:
+            async for chunk in self.client.chat_stream(payload):
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                for choice in chunk.get("choices") or []:
+                    content = choice.get("delta",{}).get("content")
+                    if content:
+                        completion.append(content)
+                        if not stream.put(content):
+                            return
+                    if choice.get("finish_reason"):
+                        stop_reason = OPENAI_STOP_REASONS.get(choice["finish_reason"],choice["finish_reason"])
+        except Exception as e:
+            logging.exception(e)
+            stop_reason = "Error!"
+        finally:
+            #Older API versions don't send the usage when streaming, then the tokens are counted locally
+            stream.prompt_tokens = usage["prompt_tokens"] if usage else self.count_message_tokens(messages)
+            stream.completion_tokens = usage["completion_tokens"] if usage else self.count_tokens("".join(completion))
+            self._account(stream.prompt_tokens,stream.completion_tokens)
+            stream.end(stop_reason or "End of sequence!")
+    
+    def generate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Tuple[str,Optional[str]]:
+        return self._run(self._generate(messages,generationConfig,stop_words)).result()
+    
+    async def agenerate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Tuple[str,Optional[str]]:
+        return await asyncio.wrap_future(self._run(self._generate(messages,generationConfig,stop_words)))
+    
+    def stream(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->TokenStream:
+        #Unbounded, the producer runs on an event loop and must not block on a slow consumer
+        stream = TokenStream(max_buffer=None)
+        self._run(self._stream(stream,messages,generationConfig,stop_words))
+        return stream
+    
+    def generate_streaming(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Generator[str,None,None]:
+        stream = self.stream(messages,generationConfig,stop_words)
+        try:
+            yield from stream
+        finally:
+            stream.cancel()
+
+def _format_message(message:ChatMessage)->str:
+    clean_content = message.content.strip('\n').strip()
+    if message.role == "system":
+        return clean_content+"\n"
+    elif message.role == "user":
+        return f"Human:{clean_content}\n"
+    elif message.role == "assistant":
+        return f"AI:{clean_content}\n"
+    return ""
+
+def build_llm_prompt(messages:List[ChatMessage])->str:
+    prompt="".join(_format_message(message) for message in messages)
         
     if  messages[-1].role == "user":
         prompt += "AI:"
     return prompt
+
+def build_llm_prompt_prefixes(messages:List[ChatMessage])->List[str]:
+    """
+    The prompt after each message (the system prompt, the prior turns, ...), these are the prefixes which can be shared between requests.
+    """
+    prefixes=[]
+    prompt=""
+    for message in messages:
+        prompt += _format_message(message)
+        prefixes.append(prompt)
+    return prefixes
+
+def _past_key_values_size(past_key_values)->int:
+    return sum(tensor.nelement()*tensor.element_size() for layer in past_key_values for tensor in layer)
+
+def _slice_past_key_values(past_key_values,length:int):
+    return tuple(tuple(tensor[:,:,:length,:].clone() for tensor in layer) for layer in past_key_values)
     
 class HF_Gpu_Adapter(ModelAdapter):
     def __init__(self,base_model:str,
@@ -132,7 +340,13 @@ class HF_Gpu_Adapter(ModelAdapter):
                  max_length:int=2000,
                  model_prototype:Type[AutoModel]=LlamaForCausalLM,
                  tokenizer_prototype:Type[AutoTokenizer]=LlamaTokenizer,
-                 tokenizer_name:Optional[str]=None
+                 tokenizer_name:Optional[str]=None,
+                 prefix_cache_mb:int=0,
+                 device:str="cuda",
+                 max_batch_size:int=1,
+                 draft_model:Optional[str]=None,
+                 num_draft_tokens:int=4,
+                 registry:Optional[ModelRegistry]=None
                  ) -> None:
         self.base_model = base_model
         self.use_peft = use_peft
@@ -143,15 +357,37 @@ class HF_Gpu_Adapter(ModelAdapter):
         self.model_prototype = model_prototype
         self.tokenizer_prototype = tokenizer_prototype
         self.tokenizer_name = tokenizer_name if (tokenizer_name and len(tokenizer_name) > 0 ) else base_model
-        self.stop_reason = None
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.engine:Optional[BatchedGenerationEngine] = None
+        self.draft_model = draft_model if (draft_model and len(draft_model) > 0) else None
+        self.num_draft_tokens = num_draft_tokens
+        self.registry = registry
+        self.speculative:Optional[SpeculativeDecoder] = None
+        #Keeps the kv-cache of common prompt prefixes, so only the new part of the prompt has to be evaluated
+        self.prefix_cache = PrefixStateCache(max_size=prefix_cache_mb*1024*1024,size_of=_past_key_values_size) if prefix_cache_mb > 0 else None
         
         
-        if not torch.cuda.is_available():
+        if device == "cuda" and not torch.cuda.is_available():
             raise Exception("No GPU available! Please use the CPU or OpenAI models!")
      
         
     def info(self)->ModelInfo:
-        return ModelInfo(name="Huggingface",model=self.adapter_model if self.use_peft else self.base_model, accelerator="GPU")
+        return ModelInfo(name="Huggingface",model=self.adapter_model if self.use_peft else self.base_model, accelerator="GPU" if self.device == "cuda" else "CPU")
+    
+    def settings(self)->Dict[str,Any]:
+        settings = {
+            "device":self.device,
+            "use_8bit":self.use_8bit,
+            "apply_optimizations":self.apply_optimications,
+            "max_batch_size":self.max_batch_size,
+            "draft_model":self.draft_model,
+            "prefix_cache":self.prefix_cache is not None,
+        }
+        if self.speculative is not None:
+            #A low acceptance rate means the draft model costs more than it saves
+            settings["speculative_decoding"] = self.speculative.stats()
+        return settings
        
     def apply_optimizations(self):
         #enable flash attention and tf32 computations
@@ -164,40 +400,112 @@ class HF_Gpu_Adapter(ModelAdapter):
     def default_config(self)->GenerationConfig:
         return GenerationConfig(top_p=0.9,num_beams=1,repetition_penalty=1.1,max_new_tokens=256,use_cache=True)
     
+    def _resolve(self,name:str)->str:
+        return self.registry.resolve_snapshot(name) if self.registry is not None else name
+    
+    def _load_model(self,name:str):
+        name = self._resolve(name)
+        if self.device == "cuda":
+            return self.model_prototype.from_pretrained(name,
+                                                        torch_dtype=torch.float16,
+                                                        device_map="auto",
+                                                        load_in_8bit=self.use_8bit)
+        return self.model_prototype.from_pretrained(name).to(self.device)
+        
     def load(self):
         if self.apply_optimications:
             self.apply_optimizations()
             
-        self.model = self.model_prototype.from_pretrained(self.base_model,
-                                                      torch_dtype=torch.float16,
-                                                      device_map="auto",
-                                                      load_in_8bit=self.use_8bit)
+        self.model = self._load_model(self.base_model)
         
         if self.use_peft:
             if not CAN_RUN_PEFT:
                 "Peft is not available! Please use the gpu container!"
-            self.model = PeftModel.from_pretrained(self.model, self.adapter_model, device_map={'': 0})
+            self.model = PeftModel.from_pretrained(self.model, self._resolve(self.adapter_model), device_map={'': 0})
             
         self.model = self.model.eval()
         
         if self.apply_optimications:
             self.model = torch.compile(self.model,mode="max-autotune")
             
-        self.tokenizer = self.tokenizer_prototype.from_pretrained(self.tokenizer_name)
+        self.tokenizer = self.tokenizer_prototype.from_pretrained(self._resolve(self.tokenizer_name))
         self.tokenizer.max_length = self.max_length
+        
+        if self.draft_model:
+            #Speculative decoding replaces the batched engine, both decode the sequences themselves
+            if self.max_batch_size > 1:
+                logging.warning(f"CHAT_BATCH_SIZE={self.max_batch_size} is ignored, speculative decoding with DRAFT_CHAT_MODEL generates one sequence at a time!")
+            self.speculative = SpeculativeDecoder(self.model,self._load_model(self.draft_model).eval(),self.tokenizer,device=self.device,num_draft_tokens=self.num_draft_tokens)
+        elif self.max_batch_size > 1:
+            self.engine = BatchedGenerationEngine(self.model,self.tokenizer,device=self.device,max_batch_size=self.max_batch_size)
+        
+    def count_tokens(self,text:str)->int:
+        return len(self.tokenizer(text,add_special_tokens=False)["input_ids"])
+    
+    def prompt_budget(self,generationConfig:GenerationConfig)->Optional[int]:
+        return self.max_length-PROMPT_MARGIN
+        
+    def _prefix_boundaries(self,messages:List[ChatMessage],token_ids:List[int])->List[int]:
+        """
+        Token counts of the prompt prefixes which tokenize to the same ids as the start of the full prompt.
+        """
+        boundaries=[]
+        for prefix in build_llm_prompt_prefixes(messages):
+            prefix_ids = self.tokenizer(prefix)["input_ids"]
+            if len(prefix_ids) < len(token_ids) and prefix_ids == token_ids[:len(prefix_ids)]:
+                boundaries.append(len(prefix_ids))
+        return boundaries
             
+    def prefill(self,messages:List[ChatMessage]):
+        if self.prefix_cache is None or len(messages) == 0:
+            return
+        prefixes = build_llm_prompt_prefixes(messages)
+        token_ids = self.tokenizer(prefixes[-1])["input_ids"]
+        if self.prefix_cache.contains(token_ids):
+            return
+        cached_length,past_key_values = self.prefix_cache.lookup(token_ids,self._prefix_boundaries(messages,token_ids))
+        with torch.no_grad():
+            output = self.model(input_ids=torch.tensor([token_ids[cached_length:]],device=self.device),past_key_values=past_key_values,use_cache=True)
+        self.prefix_cache.put(token_ids,_slice_past_key_values(output.past_key_values,len(token_ids)))
+    
+    def _prepare_inputs(self,messages:List[ChatMessage])->Dict:
+        """
+        Tokenizes the prompt and evaluates it up to the last token, reusing the cached kv-state of the longest known prefix.
+        `generate` only feeds the last token if `past_key_values` are passed.
+        """
+        prompt=build_llm_prompt(messages)
+        input_ids = self.tokenizer(prompt, return_tensors="pt")["input_ids"].to(self.device)
+        if self.prefix_cache is None or input_ids.shape[1] < 2:
+            return {"input_ids":input_ids}
+        
+        token_ids = input_ids[0].tolist()
+        boundaries = self._prefix_boundaries(messages,token_ids)
+        cached_length,past_key_values = self.prefix_cache.lookup(token_ids,boundaries)
+        end = len(token_ids)-1
+        with torch.no_grad():
+            if cached_length < end:
+                output = self.model(input_ids=input_ids[:,cached_length:end],past_key_values=past_key_values,use_cache=True)
+                past_key_values = output.past_key_values
+        for boundary in boundaries:
+            if boundary > cached_length and not self.prefix_cache.contains(token_ids[:boundary]):
+                self.prefix_cache.put(token_ids[:boundary],_slice_past_key_values(past_key_values,boundary))
+        logging.debug(f"Prefix cache: reused {cached_length} of {len(token_ids)} prompt tokens ({self.prefix_cache.hits} hits, {self.prefix_cache.misses} misses)")
+        return {"input_ids":input_ids,"past_key_values":past_key_values}
             
-    def generate(self,messages:List[Dict[str,str]],generationConfig:GenerationConfig,stop_words:List[str]=[])->str:
+    def generate(self,messages:List[Dict[str,str]],generationConfig:GenerationConfig,stop_words:List[str]=[])->Tuple[str,Optional[str]]:
+        if self._decodes_sequences:
+            sequence = self._submit(messages,generationConfig,stop_words)
+            return "".join(sequence.stream),sequence.stop_reason
+        
         prompt=build_llm_prompt(messages)
-        #These are only used here for the stopword detection
+        #These are only used here for the stopword detection, nobody consumes the stream
         manual_stop = ManualStopCondition()
-        streamer = GeneratorStreamer(self.tokenizer,manual_stop,stop_words=stop_words)
+        streamer = GeneratorStreamer(self.tokenizer,manual_stop,stop_words=stop_words,max_buffer=None,max_new_tokens=generationConfig.max_new_tokens)
         
         with torch.no_grad():
-            input = self.tokenizer(prompt, return_tensors="pt")
-            input_ids = input["input_ids"].to("cuda")
+            inputs = self._prepare_inputs(messages)
             generation_output = self.model.generate(
-                    input_ids=input_ids,
+                    **inputs,
                     generation_config=generationConfig,
                     return_dict_in_generate=True,
                     output_scores=False,
@@ -207,60 +515,159 @@ class HF_Gpu_Adapter(ModelAdapter):
             generated_tokens = generation_output.sequences[0]
             generated_text = self.tokenizer.decode(generated_tokens, skip_special_tokens=True)
             
-        if manual_stop.should_stop.is_set():
-            self.stop_reason="Stopword detected!"
-        else:
-            self.stop_reason="Max Tokens!"
-            
-        return generated_text[len(prompt):]
+        return generated_text[len(prompt):],streamer.stream.stop_reason
     
-    def generate_streaming(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Generator[str,None,None]:
-        
-        prompt=build_llm_prompt(messages)
+    def _run_generation(self,streamer:GeneratorStreamer,messages:List[ChatMessage],**kwargs):
+        try:
+            with torch.no_grad():
+                inputs = self._prepare_inputs(messages)
+                self.model.generate(streamer=streamer,**inputs,**kwargs)
+        except Exception as e:
+            logging.exception(e)
+            streamer.stream.end("Error!")
+        finally:
+            streamer.stream.end()
+    
+    def _start_generation(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Tuple[GeneratorStreamer,ManualStopCondition]:
         manual_stop = ManualStopCondition()
-        streamer = GeneratorStreamer(self.tokenizer,manual_stop,stop_words=stop_words)
+        streamer = GeneratorStreamer(self.tokenizer,manual_stop,stop_words=stop_words,max_new_tokens=generationConfig.max_new_tokens)
         
-        with torch.no_grad():
-            input = self.tokenizer(prompt, return_tensors="pt")
-            input_ids = input["input_ids"].to("cuda")
-            thread = threading.Thread(target=self.model.generate,
-                    kwargs={
-                        "input_ids":input_ids,
-                        "generation_config":generationConfig,
-                        "streamer":streamer,
-                        "stopping_criteria":StoppingCriteriaList([manual_stop])              
-                    },
-                    daemon=True)
-            thread.start()
+        thread = threading.Thread(target=self._run_generation,
+                kwargs={
+                    "streamer":streamer,
+                    "messages":messages,
+                    "generation_config":generationConfig,
+                    "stopping_criteria":StoppingCriteriaList([manual_stop])              
+                },
+                daemon=True)
+        thread.start()
+        return streamer,manual_stop
+    
+    @property
+    def _decodes_sequences(self)->bool:
+        return self.engine is not None or self.speculative is not None
+    
+    def _submit(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->BatchedSequence:
+        decoder = self.speculative if self.speculative is not None else self.engine
+        return decoder.submit(lambda: self._prepare_inputs(messages),generationConfig,stop_words)
+    
+    def generate_streaming(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Generator[str,None,None]:
+        if self._decodes_sequences:
+            sequence = self._submit(messages,generationConfig,stop_words)
+            yield from sequence.stream
+            return
+        
+        streamer,_ = self._start_generation(messages,generationConfig,stop_words)
             
         yield from streamer
             
-        if manual_stop.should_stop.is_set():
-            self.stop_reason="Stopword detected!"
-        else:
-            self.stop_reason="Max Tokens!"
+    def stream(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->TokenStream:
+        if self._decodes_sequences:
+            return self._submit(messages,generationConfig,stop_words).stream
+        streamer,_ = self._start_generation(messages,generationConfig,stop_words)
+        return streamer.stream
     
 class Cpu_Adapter(ModelAdapter): 
-    def __init__(self,hf_token:str=None,repository:str="Sosaka/Alpaca-native-4bit-ggml",filename:str="ggml-alpaca-7b-q4.bin",max_length:int=2048,threads:int=8,kv_16:bool=True,mmap:bool=True) -> None:
+    def __init__(self,hf_token:str=None,repository:str="Sosaka/Alpaca-native-4bit-ggml",filename:str="ggml-alpaca-7b-q4.bin",max_length:int=2048,threads:int=8,kv_16:bool=True,mmap:bool=True,instances:int=1,calibrate_threads:bool=False,calibration_file:str="cache/thread_calibration.json",registry:Optional[ModelRegistry]=None) -> None:
         self.max_length = max_length
         self.threads=threads
+        self.calibrate_threads=calibrate_threads
+        self.calibration_file=calibration_file
+        self.registry=registry
+        self.instances=max(1,instances)
         self.hf_token=hf_token
         self.repository=repository
         self.filename = filename
         self.kv_16=kv_16
         self.mmap=mmap
+        self.tokenizer_model:Optional[Llama]=None
+        self.tokenizer_lock=threading.Lock()
            
     def info(self)->ModelInfo:
         return ModelInfo(name="llm-rs",model=self.repository, accelerator="CPU")
+    
+    def settings(self)->Dict[str,Any]:
+        return {"threads":self.threads,"instances":self.instances,"kv_16":self.kv_16,"mmap":self.mmap,"max_length":self.max_length}
          
     def default_config(self)->GenerationConfig:
         return GenerationConfig(top_p=0.9,top_k=40,temperature=0.8,repetition_penalty=1.1,max_new_tokens=256)
     
+    def warmup(self):
+        #Every instance of the pool has its own session to initialize
+        for model in self.pool.instances:
+            model.generate(prompt=build_llm_prompt([ChatMessage(role="user",content="Hello")]),generation_config=RSGenerationConfig(max_new_tokens=1))
+    
+    def is_deterministic(self,generationConfig:GenerationConfig)->bool:
+        #llm-rs ignores `do_sample` and always samples, only top_k=1 is greedy
+        return generationConfig.top_k == 1
+    
+    def _session_config(self,threads:int,precision:Precision)->SessionConfig:
+        return SessionConfig(threads=threads,context_length=self.max_length,keys_memory_type=precision,values_memory_type=precision,prefer_mmap=self.mmap)
+    
+    def _measure_threads(self,threads:int,precision:Precision)->float:
+        """
+        Tokens per second of all instances generating the calibration prompt at the same time with `threads` split across them.
+        """
+        models = [Llama(str(self.ggjt_model),session_config=self._session_config(instance_threads,precision),verbose=False) for instance_threads in split_threads(threads,self.instances)]
+        prompt = build_llm_prompt([ChatMessage(role="user",content=CALIBRATION_PROMPT)])
+        for model in models:
+            #Untimed, the first generation pages in the weights
+            model.generate(prompt=prompt,generation_config=RSGenerationConfig(max_new_tokens=1))
+        
+        tokens = [0]*len(models)
+        def generate(index:int):
+            def count(token:str):
+                tokens[index] += 1
+            models[index].generate(prompt=prompt,generation_config=RSGenerationConfig(top_k=1,seed=42,max_new_tokens=CALIBRATION_TOKENS),callback=count)
+        started = time.perf_counter()
+        workers = [threading.Thread(target=generate,args=(index,),daemon=True) for index in range(len(models))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return sum(tokens)/(time.perf_counter()-started)
+    
+    def _calibrated_threads(self,precision:Precision)->int:
+        calibration = ThreadCalibration(self.calibration_file)
+        model_key = f"{self.repository}/{self.filename}:kv16={self.kv_16}:instances={self.instances}"
+        threads,tokens_per_second = calibration.calibrate(model_key,lambda threads:self._measure_threads(threads,precision),thread_candidates(self.instances,self.threads))
+        if tokens_per_second:
+            logging.info(f"Calibrated the cpu model to {threads} threads: {', '.join(f'{candidate}: {speed:.2f} tokens/s' for candidate,speed in tokens_per_second.items())}")
+        else:
+            logging.info(f"Using the calibrated thread count {threads} of this host from {self.calibration_file}")
+        return threads
+    
     def load(self):
-        self.ggjt_model = hf_hub_download(repo_id=self.repository, filename=self.filename,token=self.hf_token)  
+        if self.registry is not None:
+            self.ggjt_model = self.registry.resolve_file(self.repository,self.filename)
+        else:
+            self.ggjt_model = hf_hub_download(repo_id=self.repository, filename=self.filename,token=self.hf_token)  
         precision = Precision.FP16 if self.kv_16 else Precision.FP32
-        self.session_config = SessionConfig(threads=self.threads,context_length=self.max_length,keys_memory_type=precision,values_memory_type=precision,prefer_mmap=self.mmap)   
-        self.model = Llama(str(self.ggjt_model),session_config=self.session_config,verbose=True)
+        if self.calibrate_threads:
+            self.threads = self._calibrated_threads(precision)
+        if self.instances > 1 and not self.mmap:
+            logging.warning(f"CPU_MODEL_MMAP is disabled, each of the {self.instances} model instances loads its own copy of the weights!")
+        #Memory mapped instances share the weights in the page cache, only the kv-caches are allocated per instance
+        models = []
+        for threads in split_threads(self.threads,self.instances):
+            models.append(Llama(str(self.ggjt_model),session_config=self._session_config(threads,precision),verbose=len(models) == 0))
+        self.pool = ModelPool(models)
+        if self.mmap:
+            #Token counting runs next to the generations, a separate instance shares the mapped weights and only has a tiny context
+            self.tokenizer_model = Llama(str(self.ggjt_model),session_config=SessionConfig(threads=1,context_length=64,prefer_mmap=True),verbose=False)
+        logging.info(f"Loaded {self.pool.size} llm-rs instances with {split_threads(self.threads,self.instances)} threads")
+        
+    def count_tokens(self,text:str)->int:
+        if self.tokenizer_model is not None:
+            with self.tokenizer_lock:
+                return len(self.tokenizer_model.tokenize(text))
+        #Without mmap another instance would load another copy of the weights, so a free instance of the pool is used
+        with self.pool.acquire() as model:
+            return len(model.tokenize(text))
+    
+    def prompt_budget(self,generationConfig:GenerationConfig)->Optional[int]:
+        #The context of llm-rs has to hold the prompt and the generated tokens
+        return self.max_length-(generationConfig.max_new_tokens or 0)-PROMPT_MARGIN
     
     
     def _hf_to_rs_config(self,generationConfig:GenerationConfig)->RSGenerationConfig:
@@ -273,24 +680,41 @@ class Cpu_Adapter(ModelAdapter):
         )
         
         
-    def generate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->str:
-        words = list(self.generate_streaming(messages,generationConfig,stop_words=stop_words))
-        return "".join(words)
+    def generate(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Tuple[str,Optional[str]]:
+        prompt=build_llm_prompt(messages)
+        streamer = CPUStreamer(self.pool,config=self._hf_to_rs_config(generationConfig),prompt=prompt,stop_words=stop_words)
+        streamer.start()
+        words = list(streamer)
+        return "".join(words),streamer.stream.stop_reason
     
     def generate_streaming(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->Generator[str,None,None]:
         prompt=build_llm_prompt(messages)
         config = self._hf_to_rs_config(generationConfig)
         
-        streamer = CPUStreamer(self.model,config=config,prompt=prompt,stop_words=stop_words)
+        streamer = CPUStreamer(self.pool,config=config,prompt=prompt,stop_words=stop_words)
         streamer.start()
         yield from streamer
         
+    def stream(self,messages:List[ChatMessage],generationConfig:GenerationConfig,stop_words:List[str]=[])->TokenStream:
+        prompt=build_llm_prompt(messages)
+        config = self._hf_to_rs_config(generationConfig)
+        
+        streamer = CPUStreamer(self.pool,config=config,prompt=prompt,stop_words=stop_words)
+        streamer.start()
+        return streamer.stream
+        
 
         
-def adapter_factory(configuration:Configuration)->ModelAdapter:
+def adapter_factory(configuration:Configuration,registry:Optional[ModelRegistry]=None)->ModelAdapter:
     model_to_use = configuration["chatmodel"]
     if model_to_use == "OPENAI":
-        return ChatGPT_Adapter(configuration["open_ai_token"])
+        return ChatGPT_Adapter(
+            token=configuration["open_ai_token"],
+            base_url=configuration["openai_base_url"],
+            max_concurrency=configuration["openai_max_concurrency"],
+            max_retries=configuration["openai_max_retries"],
+            context_length=configuration["openai_context_length"]
+        )
     elif model_to_use == "GPU":
         return HF_Gpu_Adapter(
             base_model=configuration["base_chat_model"],
@@ -298,7 +722,13 @@ def adapter_factory(configuration:Configuration)->ModelAdapter:
             adapter_model=configuration["adapter_chat_model"],
             use_8bit=configuration["use_8bit"],
             apply_optimications=configuration["chat_apply_optimizations"],
-            max_length=configuration["chat_max_length"]
+            max_length=configuration["chat_max_length"],
+            prefix_cache_mb=configuration["chat_prefix_cache_mb"],
+            max_batch_size=configuration["chat_batch_size"],
+            device=configuration["chat_device"],
+            draft_model=configuration["draft_chat_model"],
+            num_draft_tokens=configuration["draft_tokens"],
+            registry=registry
         )
     elif model_to_use == "CPU":
         return Cpu_Adapter(
@@ -308,7 +738,11 @@ def adapter_factory(configuration:Configuration)->ModelAdapter:
             filename=configuration["cpu_model_filename"],
             max_length=configuration["chat_max_length"],
             kv_16=configuration["cpu_model_kv_16"],
-            mmap=configuration["cpu_model_mmap"]
+            mmap=configuration["cpu_model_mmap"],
+            instances=configuration["cpu_model_instances"],
+            calibrate_threads=configuration["cpu_model_calibrate_threads"],
+            calibration_file=configuration["cpu_model_calibration_file"],
+            registry=registry
             )
     else:
         raise Exception("Unknown model type: " + model_to_use)
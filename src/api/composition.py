@@ -2,21 +2,93 @@ from dependency_injector import containers, providers
 
 from .routers.utils import RequestLimiter
 from haystack.document_stores import ElasticsearchDocumentStore
-from haystack.nodes import TransformersReader,EmbeddingRetriever,BM25Retriever
+from haystack.nodes import TransformersReader,EmbeddingRetriever,BM25Retriever,PreProcessor
+from .custom_nodes.narrowing_nodes import build_narrowing_node
+from .custom_nodes.token_cache_nodes import CachedTokenEmbeddingRetriever,build_token_cache_node,disable_token_cache_indexing,TOKEN_CACHE_META_KEY
 from .pipelines import SearchPipeline, ExtractiveQAPipeline
 from .routers import HealthRouter,PipelineRouter,QueryRouter,DocumentRouter,ChatRouter
 from .chat_models import adapter_factory
+from .metrics import MetricsRegistry
+from .scheduling import ChatScheduler
+from .response_cache import ChatResponseCache
+from .executors import ModelExecutors,EventLoopLagMonitor
+from .loading import ModelLoader
+from .model_registry import ModelRegistry
+from .ingestion import DocumentIngestor
+from .telemetry import GenerationTelemetry
+from .rag import load_rag_templates
+from .context_compression import ContextCompressor
+from .digests import DigestJob
+from .custom_nodes.digest_nodes import build_digest_builder
+from haystack.schema import Document
+
+def build_model_loader(metrics:MetricsRegistry,chat_model,embedding_retriever,reader)->ModelLoader:
+    """
+    Registers the model backed components, which are passed as providers and only built once the loader starts.
+    """
+    def load_chat_model():
+        model = chat_model()
+        model.load()
+        return model
+    
+    loader = ModelLoader(metrics)
+    loader.register("chat",load_chat_model,lambda model:model.warmup())
+    loader.register("embedding",embedding_retriever,lambda retriever:retriever.embed_queries(["warmup"]))
+    loader.register("reader",reader,lambda reader:reader.predict(query="warmup",documents=[Document(content="This passage warms up the reader.")],top_k=1))
+    return loader
+
+def build_document_store(**kwargs)->ElasticsearchDocumentStore:
+    """
+    The token cache is only read by the reindexing, it is neither indexed nor returned by queries.
+    """
+    document_store = ElasticsearchDocumentStore(excluded_meta_data=[TOKEN_CACHE_META_KEY],**kwargs)
+    disable_token_cache_indexing(document_store)
+    return document_store
+
+def build_context_compressor(embedding_retriever,chat_model)->ContextCompressor:
+    """
+    Compresses with the embedding model of the retriever (passed as provider, it loads in the background) and the tokenizer of the chat model.
+    """
+    return ContextCompressor(embed=lambda texts:embedding_retriever().embed_queries(texts),count_tokens=chat_model.count_tokens)
+
 class Container(containers.DeclarativeContainer):
 
     config = providers.Configuration()
+    
+    metrics = providers.Singleton(
+        MetricsRegistry
+    )
+
+    executors = providers.Singleton(
+        ModelExecutors,
+        metrics=metrics,
+        workers=providers.Dict(
+            chat=config.chat_concurrency,
+            reader=config.reader_workers,
+            embedding=config.embedding_workers,
+        )
+    )
+    
+    lag_monitor = providers.Singleton(
+        EventLoopLagMonitor,
+        metrics=metrics,
+        threshold=config.event_loop_lag_threshold
+    )
 
     limiter=providers.Singleton(
         RequestLimiter,
         limit=config.concurency_limit
     )
     
-    document_store = providers.Singleton(
-        ElasticsearchDocumentStore,
+    model_registry = providers.Singleton(
+        ModelRegistry,
+        root=config.model_registry_dir,
+        offline=config.model_offline,
+        token=config.hf_token,
+    )
+    
+    document_store = providers.ThreadSafeSingleton(
+        build_document_store,
         host=config.elasticsearch_host,
         port=config.elasticsearch_port,
         username=config.elasticsearch_username,
@@ -25,79 +97,182 @@ class Container(containers.DeclarativeContainer):
         similarity=config.similarity,
     )
     
-    bm25_retriever = providers.Singleton(
+    bm25_retriever = providers.ThreadSafeSingleton(
         BM25Retriever,
         document_store=document_store
     )
     
-    embedding_retriever = providers.Singleton(
-        EmbeddingRetriever,
-        embedding_model=config.embedding_model,
+    embedding_retriever = providers.ThreadSafeSingleton(
+        CachedTokenEmbeddingRetriever,
+        embedding_model=model_registry.provided.resolve_snapshot.call(config.embedding_model),
         document_store=document_store,
         use_gpu=config.use_gpu,
         use_auth_token=config.hf_token,
     )
     
-    qa_reader = providers.Singleton(
+    qa_reader = providers.ThreadSafeSingleton(
         TransformersReader,
-        model_name_or_path = config.extractive_qa_model,
+        model_name_or_path = model_registry.provided.resolve_snapshot.call(config.extractive_qa_model),
         use_gpu=config.use_gpu,
         use_auth_token=config.hf_token,
         max_seq_len=512,
         context_window_size=150,
     )
     
-    search_pipeline = providers.Singleton(
+    token_cache_node = providers.ThreadSafeSingleton(
+        build_token_cache_node,
+        embedding_retriever=embedding_retriever,
+    )
+    
+    narrowing_node = providers.ThreadSafeSingleton(
+        build_narrowing_node,
+        enabled=config.reader_context_narrowing,
+        max_words=config.reader_context_words,
+        mode=config.reader_context_narrowing_mode,
+        embedding_retriever=embedding_retriever,
+    )
+    
+    digest_builder = providers.ThreadSafeSingleton(
+        build_digest_builder,
+        embedding_retriever=embedding_retriever.provider,
+        max_words=config.digest_max_words,
+    )
+    
+    digest_job = providers.Singleton(
+        DigestJob,
+        document_store=document_store,
+        builder=digest_builder.provider,
+        metrics=metrics,
+        executors=executors,
+    )
+    
+    search_pipeline = providers.ThreadSafeSingleton(
         SearchPipeline,
         bm25_retreiver=bm25_retriever,
         embedding_retriever=embedding_retriever,
     )
     
-    extractive_qa_pipeline = providers.Singleton(
+    extractive_qa_pipeline = providers.ThreadSafeSingleton(
         ExtractiveQAPipeline,
         bm25_retreiver=bm25_retriever,
         embedding_retriever=embedding_retriever,
         reader=qa_reader,
+        narrowing_node=narrowing_node,
+    )
+    
+    chatmodel=providers.ThreadSafeSingleton(
+        adapter_factory,
+        configuration=config,
+        registry=model_registry
+    )
+    
+    model_loader = providers.Singleton(
+        build_model_loader,
+        metrics=metrics,
+        chat_model=chatmodel.provider,
+        embedding_retriever=embedding_retriever.provider,
+        reader=qa_reader.provider,
     )
     
     health_router = providers.Factory(
-        HealthRouter
+        HealthRouter,
+        metrics=metrics,
+        loader=model_loader
     )
     
     pipeline_router = providers.Factory(
         PipelineRouter,
-        search_pipeline=search_pipeline,
-        extractive_qa_pipeline=extractive_qa_pipeline,
+        search_pipeline=search_pipeline.provider,
+        extractive_qa_pipeline=extractive_qa_pipeline.provider,
+        loader=model_loader,
     )
     
     query_router = providers.Factory(
         QueryRouter,
         document_store=document_store,
-        search_pipeline=search_pipeline,
-        extractive_qa_pipeline=extractive_qa_pipeline,
+        search_pipeline=search_pipeline.provider,
+        extractive_qa_pipeline=extractive_qa_pipeline.provider,
         limiter=limiter,
-        embedding_retriever=embedding_retriever,
+        embedding_retriever=embedding_retriever.provider,
+        token_cache_node=token_cache_node.provider,
+        executors=executors,
+        loader=model_loader,
+        digest_job=digest_job,
+    )
+    
+    preprocessor = providers.ThreadSafeSingleton(
+        PreProcessor,
+        clean_empty_lines=True,
+        clean_whitespace=True,
+        split_by="word",
+        split_length=config.ingest_split_length,
+        split_overlap=0,
+        split_respect_sentence_boundary=True,
+        progress_bar=False,
+    )
+    
+    document_ingestor = providers.Singleton(
+        DocumentIngestor,
+        document_store=document_store,
+        preprocessor=preprocessor.provider,
+        metrics=metrics,
     )
     
     document_router = providers.Factory(
         DocumentRouter,
-        document_store=document_store
+        document_store=document_store,
+        ingestor=document_ingestor,
+        embedding_retriever=embedding_retriever.provider,
+        token_cache_node=token_cache_node.provider,
+        digest_builder=digest_builder.provider,
+        executors=executors,
+        loader=model_loader,
     )
     
-    chat_limiter=providers.Singleton(
-        RequestLimiter,
-        limit=2
+    chat_scheduler=providers.Singleton(
+        ChatScheduler,
+        metrics=metrics,
+        slots=config.chat_concurrency,
+        max_queue=config.chat_max_queue,
+        max_wait=config.chat_max_wait,
     )
         
-    chatmodel=providers.Singleton(
-        adapter_factory,
-        configuration=config
+    chat_response_cache=providers.Singleton(
+        ChatResponseCache,
+        max_entries=config.chat_response_cache_size,
+        spill_dir=config.chat_response_cache_dir,
+    )
+    
+    generation_telemetry=providers.Singleton(
+        GenerationTelemetry,
+        metrics=metrics
+    )
+    
+    rag_templates=providers.Singleton(
+        load_rag_templates,
+        path=config.rag_templates_file
+    )
+    
+    context_compressor=providers.Singleton(
+        build_context_compressor,
+        embedding_retriever=embedding_retriever.provider,
+        chat_model=chatmodel
     )
     
     chat_router = providers.Factory(
         ChatRouter,
         chat_model=chatmodel,
-        limiter=chat_limiter
+        scheduler=chat_scheduler,
+        metrics=metrics,
+        response_cache=chat_response_cache,
+        executors=executors,
+        loader=model_loader,
+        extractive_qa_pipeline=extractive_qa_pipeline.provider,
+        rag_templates=rag_templates,
+        context_compressor=context_compressor,
+        telemetry=generation_telemetry,
+        context_tokens=config.rag_context_tokens,
+        heartbeat_interval=config.chat_heartbeat_interval
     )
     
     
\ No newline at end of file
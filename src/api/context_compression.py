@@ -0,0 +1,68 @@
+from dataclasses import dataclass
+from typing import Callable,List,Optional,Sequence
+import numpy as np
+from .sentences import split_sentences
+
+@dataclass
+class CompressedContexts:
+    contexts:List[str]
+    original_tokens:int
+    tokens:int
+
+    @property
+    def ratio(self)->float:
+        """
+        Share of the context tokens which were kept.
+        """
+        return self.tokens/self.original_tokens if self.original_tokens > 0 else 1.0
+
+
+class ContextCompressor():
+    """
+    Shrinks the contexts of a rag prompt to a token budget by keeping the sentences most similar to the question.
+    Sentences containing the answer of the reader are kept first, the kept sentences stay in their original order
+    and skipped sentences are replaced by `gap_marker`.
+    """
+    def __init__(self,embed:Callable[[List[str]],np.ndarray],count_tokens:Callable[[str],int],gap_marker:str=" ... ") -> None:
+        self.embed = embed
+        self.count_tokens = count_tokens
+        self.gap_marker = gap_marker
+
+    def compress(self,question:str,contexts:List[str],answer_offsets:Sequence[Optional[Sequence[int]]],budget:int)->CompressedContexts:
+        sentences = [(i,start,end) for i,context in enumerate(contexts) for start,end in split_sentences(context)]
+        texts = [contexts[i][start:end] for i,start,end in sentences]
+        counts = [self.count_tokens(text) for text in texts]
+        original_tokens = sum(counts)
+        if original_tokens <= budget or len(sentences) == 0:
+            return CompressedContexts(contexts=list(contexts),original_tokens=original_tokens,tokens=original_tokens)
+
+        embeddings = np.asarray(self.embed([question]+texts),dtype=np.float32)
+        embeddings /= np.maximum(np.linalg.norm(embeddings,axis=1,keepdims=True),1e-12)
+        similarities = embeddings[1:]@embeddings[0]
+
+        def contains_answer(index:int)->bool:
+            i,start,end = sentences[index]
+            offsets = answer_offsets[i] if i < len(answer_offsets) else None
+            return offsets is not None and start < offsets[1] and offsets[0] < end
+
+        order = sorted(range(len(sentences)),key=lambda index:(not contains_answer(index),-similarities[index]))
+        kept = set()
+        tokens = 0
+        for index in order:
+            if tokens+counts[index] <= budget:
+                kept.add(index)
+                tokens += counts[index]
+
+        compressed = []
+        for i in range(len(contexts)):
+            parts = []
+            previous = None
+            for index,(context_index,_,_) in enumerate(sentences):
+                if context_index != i or index not in kept:
+                    continue
+                if previous is not None:
+                    parts.append(" " if previous == index-1 else self.gap_marker)
+                parts.append(texts[index])
+                previous = index
+            compressed.append("".join(parts))
+        return CompressedContexts(contexts=compressed,original_tokens=original_tokens,tokens=tokens)
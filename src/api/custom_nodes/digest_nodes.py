@@ -0,0 +1,71 @@
+from haystack.nodes.base import BaseComponent
+from haystack.nodes import EmbeddingRetriever
+from haystack.schema import MultiLabel, Document
+from typing import Optional,List,Dict,Tuple,Any,Union,Callable
+from ..digests import DigestBuilder
+
+class DigestNode(BaseComponent):
+    """
+    A node which stores an extractive digest of each document in its meta, used in indexing pipelines to build the digests at ingest time.
+    Documents already in the store get theirs from the `DigestJob`.
+    """
+    outgoing_edges = 1
+    def __init__(self,builder:DigestBuilder):
+        super().__init__()
+        self.builder = builder
+
+    def run(
+        self,
+        query: Optional[str] = None,
+        file_paths: Optional[List[str]] = None,
+        labels: Optional[MultiLabel] = None,
+        documents: Optional[List[Document]] = None,
+        meta: Optional[dict] = None,
+    ) -> Tuple[Dict, str]:
+
+        if documents:
+            self.builder.digest_documents(documents)
+
+        output = {
+            "query":query,
+            "file_paths":file_paths,
+            "labels":labels,
+            "documents":documents,
+            "meta":meta,
+        }
+        return output, "output_1"
+
+    def run_batch(
+        self,
+        queries: Optional[Union[str, List[str]]] = None,
+        file_paths: Optional[List[str]] = None,
+        labels: Optional[Union[MultiLabel, List[MultiLabel]]] = None,
+        documents: Optional[Union[List[Document], List[List[Document]]]] = None,
+        meta: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+        params: Optional[dict] = None,
+        debug: Optional[bool] = None,
+    ):
+        if documents:
+            if isinstance(documents[0],Document):
+                self.builder.digest_documents(documents)
+            else:
+                for doc_list in documents:
+                    self.builder.digest_documents(doc_list)
+
+        output = {
+            "queries":queries,
+            "file_paths":file_paths,
+            "labels":labels,
+            "documents":documents,
+            "meta":meta,
+            "params":params,
+            "debug":debug,
+        }
+        return output, "output_1"
+
+
+def build_digest_builder(embedding_retriever:Callable[[],EmbeddingRetriever],max_words:int)->DigestBuilder:
+    """
+    Creates a `DigestBuilder` which embeds the sentences with the embedding model of the retriever (passed as provider, it loads in the background).
+    """
+    return DigestBuilder(embed=lambda texts:embedding_retriever().embed_queries(texts),max_words=max_words)
@@ -0,0 +1,294 @@
+from haystack.nodes.base import BaseComponent
+from haystack.nodes import EmbeddingRetriever
+from typing import Optional,List,Dict,Tuple,Any,Literal,Union
+from haystack.schema import MultiLabel, Document, Answer, Span
+from dataclasses import dataclass
+import numpy as np
+import re
+from ..sentences import split_sentences
+
+WORD_PATTERN = re.compile(r"\w+")
+NARROWING_MODES = ("lexical","embedding")
+STOP_WORDS = {
+    "a","an","the","is","are","was","were","be","been","of","in","on","at","to","for","by","with","from","and","or",
+    "what","who","whom","which","when","where","why","how","does","do","did","it","its","this","that","as","into",
+}
+
+@dataclass
+class NarrowedSpan:
+    """
+    A span of the original document which was kept in the narrowed document.
+    """
+    narrowed_start:int
+    original_start:int
+    length:int
+
+@dataclass
+class NarrowedContext:
+    original:Document
+    spans:List[NarrowedSpan]
+
+    def to_original(self,position:int)->int:
+        """
+        Maps a character position in the narrowed document back to the original document.
+        """
+        for span in reversed(self.spans):
+            if position >= span.narrowed_start:
+                return span.original_start + min(position - span.narrowed_start, span.length)
+        return position
+
+
+def _terms(text:str)->set:
+    return {word for word in WORD_PATTERN.findall(text.lower()) if word not in STOP_WORDS}
+
+
+class ContextNarrowingNode(BaseComponent):
+    """
+    Cuts the documents down to windows around the sentences most similar to the query before they reach the reader.
+    The kept spans are passed along as `narrowed_contexts`, so the `ContextRestoringNode` can map the answers back to the original documents.
+    """
+    outgoing_edges = 1
+    def __init__(self,
+                 max_words:int=100,
+                 window_sentences:int=1,
+                 mode:Literal["lexical","embedding"]="lexical",
+                 embedding_retriever:Optional[EmbeddingRetriever]=None):
+        super().__init__()
+        if mode not in NARROWING_MODES:
+            raise ValueError(f"Unknown narrowing mode '{mode}', use one of {', '.join(NARROWING_MODES)}!")
+        if mode == "embedding" and embedding_retriever is None:
+            raise ValueError("The embedding mode needs an embedding retriever!")
+        self.max_words = max_words
+        self.window_sentences = window_sentences
+        self.mode = mode
+        self.embedding_retriever = embedding_retriever
+
+    def _score_sentences(self,query:str,sentences:List[str])->List[float]:
+        if self.mode == "embedding":
+            embeddings = self.embedding_retriever.embed_queries([query]+sentences)
+            query_embedding, sentence_embeddings = embeddings[0], embeddings[1:]
+            norms = np.linalg.norm(sentence_embeddings,axis=1) * np.linalg.norm(query_embedding)
+            return list(sentence_embeddings @ query_embedding / np.maximum(norms,1e-8))
+
+        query_terms = _terms(query)
+        if len(query_terms) == 0:
+            return [0.0]*len(sentences)
+        return [len(query_terms & _terms(sentence))/len(query_terms) for sentence in sentences]
+
+    def narrow(self,query:str,document:Document)->Optional[NarrowedContext]:
+        """
+        Returns the kept spans of the document or None if the document should be passed on unchanged.
+        """
+        if document.content_type != "text" or len(document.content.split()) <= self.max_words:
+            return None
+
+        sentence_spans = split_sentences(document.content)
+        sentences = [document.content[start:end] for start,end in sentence_spans]
+        scores = self._score_sentences(query,sentences)
+        if max(scores) <= 0:
+            return None
+
+        #Greedily add the windows around the best sentences until the word budget is used up
+        kept = set()
+        words = 0
+        for index in sorted(range(len(sentences)),key=lambda i:scores[i],reverse=True):
+            if scores[index] <= 0:
+                break
+            window = range(max(0,index-self.window_sentences),min(len(sentences),index+self.window_sentences+1))
+            window_words = sum(len(sentences[i].split()) for i in window if i not in kept)
+            if len(kept) > 0 and words + window_words > self.max_words:
+                break
+            kept.update(window)
+            words += window_words
+
+        #Merge neighbouring sentences into continuous spans of the original document
+        spans:List[NarrowedSpan] = []
+        narrowed_length = 0
+        previous = None
+        for index in sorted(kept):
+            start,end = sentence_spans[index]
+            if previous is not None and previous == index-1:
+                spans[-1].length = end - spans[-1].original_start
+            else:
+                if len(spans) > 0:
+                    narrowed_length = spans[-1].narrowed_start + spans[-1].length + 1
+                spans.append(NarrowedSpan(narrowed_start=narrowed_length,original_start=start,length=end-start))
+            previous = index
+        return NarrowedContext(original=document,spans=spans)
+
+    def run(
+        self,
+        query: Optional[str] = None,
+        file_paths: Optional[List[str]] = None,
+        labels: Optional[MultiLabel] = None,
+        documents: Optional[List[Document]] = None,
+        meta: Optional[dict] = None,
+    ) -> Tuple[Dict, str]:
+
+        narrowed_contexts:Dict[str,NarrowedContext] = {}
+        narrowed_documents = []
+        words_before = 0
+        words_after = 0
+        for doc in documents or []:
+            narrowed = self.narrow(query,doc) if query else None
+            if narrowed is None:
+                narrowed_documents.append(doc)
+                continue
+
+            content = "\n".join(doc.content[span.original_start:span.original_start+span.length] for span in narrowed.spans)
+            narrowed_documents.append(Document(id=doc.id,content=content,content_type=doc.content_type,meta=doc.meta,score=doc.score))
+            narrowed_contexts[doc.id] = narrowed
+            words_before += len(doc.content.split())
+            words_after += len(content.split())
+
+        output = {
+            "query":query,
+            "file_paths":file_paths,
+            "labels":labels,
+            "documents":narrowed_documents,
+            "meta":meta,
+            "narrowed_contexts":narrowed_contexts,
+            "_debug":{"narrowed_documents":len(narrowed_contexts),"words_before":words_before,"words_after":words_after},
+        }
+        return output, "output_1"
+
+    def run_batch(
+        self,
+        queries: Optional[Union[str, List[str]]] = None,
+        file_paths: Optional[List[str]] = None,
+        labels: Optional[Union[MultiLabel, List[MultiLabel]]] = None,
+        documents: Optional[Union[List[Document], List[List[Document]]]] = None,
+        meta: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+        params: Optional[dict] = None,
+        debug: Optional[bool] = None,
+    ):
+        queries = [queries] if isinstance(queries,str) else list(queries or [])
+        if not documents:
+            document_lists = [[] for _ in queries]
+        elif isinstance(documents[0],Document):
+            #Like the readers, every query runs on the whole list
+            document_lists = [documents]*len(queries)
+        else:
+            document_lists = documents
+            #A single query runs on every list
+            if len(queries) == 1:
+                queries = queries*len(document_lists)
+        if len(queries) != len(document_lists):
+            raise ValueError("The number of queries and document lists must match!")
+
+        #The documents are narrowed per query, the lists and contexts stay aligned with the queries
+        narrowed_documents = []
+        narrowed_contexts = []
+        total_debug = {"narrowed_documents":0,"words_before":0,"words_after":0}
+        for query,doc_list in zip(queries,document_lists):
+            output,_ = self.run(query=query,documents=doc_list)
+            narrowed_documents.append(output["documents"])
+            narrowed_contexts.append(output["narrowed_contexts"])
+            for key in total_debug:
+                total_debug[key] += output["_debug"][key]
+
+        output = {
+            "queries":queries,
+            "file_paths":file_paths,
+            "labels":labels,
+            "documents":narrowed_documents,
+            "meta":meta,
+            "params":params,
+            "debug":debug,
+            "narrowed_contexts":narrowed_contexts,
+            "_debug":total_debug,
+        }
+        return output, "output_1"
+
+
+class ContextRestoringNode(BaseComponent):
+    """
+    Maps the answers of a reader which ran on narrowed documents back to the original documents
+    and restores the original documents in the output.
+    """
+    outgoing_edges = 1
+    def __init__(self,context_window_size:int=150):
+        super().__init__()
+        self.context_window_size = context_window_size
+
+    def _restore_answer(self,answer:Answer,narrowed:NarrowedContext)->Answer:
+        content = narrowed.original.content
+        offsets_in_document = []
+        for span in answer.offsets_in_document or []:
+            start = narrowed.to_original(span.start)
+            #The end is exclusive, map the last character of the answer to stay inside of its span
+            end = narrowed.to_original(max(span.start,span.end-1))+1 if span.end > span.start else start
+            offsets_in_document.append(Span(start=start,end=end))
+
+        if len(offsets_in_document) > 0:
+            start,end = offsets_in_document[0].start,offsets_in_document[0].end
+            context_start = max(0,start-self.context_window_size)
+            context_end = min(len(content),end+self.context_window_size)
+            answer.context = content[context_start:context_end]
+            answer.offsets_in_context = [Span(start=start-context_start,end=end-context_start)]
+            answer.offsets_in_document = offsets_in_document
+        return answer
+
+    def run(
+        self,
+        query: Optional[str] = None,
+        answers: Optional[List[Answer]] = None,
+        documents: Optional[List[Document]] = None,
+        narrowed_contexts: Optional[Dict[str,NarrowedContext]] = None,
+    ) -> Tuple[Dict, str]:
+        narrowed_contexts = narrowed_contexts or {}
+        restored_answers = []
+        for answer in answers or []:
+            document_id = answer.document_ids[0] if answer.document_ids else None
+            if document_id in narrowed_contexts:
+                answer = self._restore_answer(answer,narrowed_contexts[document_id])
+            restored_answers.append(answer)
+
+        restored_documents = [narrowed_contexts[doc.id].original if doc.id in narrowed_contexts else doc for doc in documents or []]
+        output = {
+            "query":query,
+            "answers":restored_answers,
+            "documents":restored_documents,
+            "narrowed_contexts":None,
+        }
+        return output, "output_1"
+
+    def run_batch(
+        self,
+        queries: Optional[Union[str, List[str]]] = None,
+        answers: Optional[List[List[Answer]]] = None,
+        documents: Optional[Union[List[Document], List[List[Document]]]] = None,
+        narrowed_contexts: Optional[List[Dict[str,NarrowedContext]]] = None,
+    ):
+        answers = answers or []
+        if documents and isinstance(documents[0],Document):
+            document_lists = [documents]*len(answers)
+        else:
+            document_lists = documents or [[] for _ in answers]
+        narrowed_contexts = narrowed_contexts or [{} for _ in answers]
+
+        restored_answers = []
+        restored_documents = []
+        for answer_list,doc_list,contexts in zip(answers,document_lists,narrowed_contexts):
+            output,_ = self.run(answers=answer_list,documents=doc_list,narrowed_contexts=contexts)
+            restored_answers.append(output["answers"])
+            restored_documents.append(output["documents"])
+
+        output = {
+            "queries":queries,
+            "answers":restored_answers,
+            "documents":restored_documents,
+            "narrowed_contexts":None,
+        }
+        return output, "output_1"
+
+
+def build_narrowing_node(enabled:bool,max_words:int,mode:str,embedding_retriever:EmbeddingRetriever)->Optional[ContextNarrowingNode]:
+    """
+    Creates the `ContextNarrowingNode` if the narrowing is enabled. An unknown mode fails even if it is disabled, a typo shouldn't go unnoticed.
+    """
+    if mode not in NARROWING_MODES:
+        raise ValueError(f"Unknown narrowing mode '{mode}', use one of {', '.join(NARROWING_MODES)}!")
+    if not enabled:
+        return None
+    return ContextNarrowingNode(max_words=max_words,mode=mode,embedding_retriever=embedding_retriever if mode == "embedding" else None)
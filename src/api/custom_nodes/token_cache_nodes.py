@@ -0,0 +1,242 @@
+from haystack.nodes.base import BaseComponent
+from haystack.nodes import EmbeddingRetriever
+from haystack.schema import MultiLabel, Document, Answer
+from haystack.document_stores import BaseDocumentStore
+from typing import Optional,List,Dict,Tuple,Any,Union
+from transformers import PreTrainedTokenizerBase
+import numpy as np
+import hashlib
+import logging
+import re
+import torch
+
+TOKEN_CACHE_META_KEY="token_cache"
+
+logger = logging.getLogger(__name__)
+
+def tokenizer_cache_key(tokenizer:PreTrainedTokenizerBase)->str:
+    """
+    Builds a key from the name and the vocabulary of a tokenizer. The vocabulary hash acts as the version,
+    so a retrained tokenizer under the same name does not pick up stale ids.
+    """
+    cached_key = getattr(tokenizer,"_token_cache_key",None)
+    if cached_key:
+        return cached_key
+
+    vocab = sorted(tokenizer.get_vocab().items())
+    version = hashlib.md5("".join(f"{token}:{id}" for token,id in vocab).encode("utf-8")).hexdigest()[:8]
+    #Elasticsearch interprets dots in field names as object paths
+    name = re.sub(r"[^A-Za-z0-9_\-]","_",tokenizer.name_or_path)
+    key = f"{name}@{version}"
+    tokenizer._token_cache_key = key
+    return key
+
+
+def get_cached_token_ids(document:Document,tokenizer:PreTrainedTokenizerBase)->Optional[List[int]]:
+    """
+    Returns the cached token ids of a document for the given tokenizer or None if they are missing.
+    """
+    token_cache = document.meta.get(TOKEN_CACHE_META_KEY) if document.meta else None
+    if not token_cache:
+        return None
+    return token_cache.get(tokenizer_cache_key(tokenizer))
+
+
+def strip_token_cache(documents:List[Union[Document,Answer]])->List[Union[Document,Answer]]:
+    """
+    Removes the token cache from the meta of documents or answers, to keep api responses small.
+    """
+    for doc in documents:
+        if doc.meta and TOKEN_CACHE_META_KEY in doc.meta:
+            del doc.meta[TOKEN_CACHE_META_KEY]
+    return documents
+
+
+class TokenCacheNode(BaseComponent):
+    """
+    A node which tokenizes the content of documents with every configured tokenizer and stores the token ids in the meta of the document.
+    Can be used in indexing pipelines or via `cache_document_tokens` on an existing document store.
+    """
+    outgoing_edges = 1
+    def __init__(self,tokenizers:List[PreTrainedTokenizerBase]):
+        super().__init__()
+        self.tokenizers = tokenizers
+
+    def cache_tokens(self,documents:List[Document])->List[Document]:
+        text_documents = [doc for doc in documents if doc.content_type == "text"]
+        if len(text_documents) == 0:
+            return documents
+
+        contents = [doc.content for doc in text_documents]
+        for tokenizer in self.tokenizers:
+            key = tokenizer_cache_key(tokenizer)
+            encoded = tokenizer(contents,add_special_tokens=True,truncation=False)["input_ids"]
+            for doc,ids in zip(text_documents,encoded):
+                if TOKEN_CACHE_META_KEY not in doc.meta or not doc.meta[TOKEN_CACHE_META_KEY]:
+                    doc.meta[TOKEN_CACHE_META_KEY]={}
+                doc.meta[TOKEN_CACHE_META_KEY][key]=ids
+        return documents
+
+    def run(
+        self,
+        query: Optional[str] = None,
+        file_paths: Optional[List[str]] = None,
+        labels: Optional[MultiLabel] = None,
+        documents: Optional[List[Document]] = None,
+        meta: Optional[dict] = None,
+    ) -> Tuple[Dict, str]:
+
+        if documents:
+            self.cache_tokens(documents)
+
+        output = {
+            "query":query,
+            "file_paths":file_paths,
+            "labels":labels,
+            "documents":documents,
+            "meta":meta,
+        }
+        return output, "output_1"
+
+    def run_batch(
+        self,
+        queries: Optional[Union[str, List[str]]] = None,
+        file_paths: Optional[List[str]] = None,
+        labels: Optional[Union[MultiLabel, List[MultiLabel]]] = None,
+        documents: Optional[Union[List[Document], List[List[Document]]]] = None,
+        meta: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
+        params: Optional[dict] = None,
+        debug: Optional[bool] = None,
+    ):
+        if documents:
+            if len(documents)>0:
+                #Check if the first element is a docuemnt
+                first = documents[0]
+                if isinstance(first,Document):
+                    self.cache_tokens(documents)
+                else:
+                    for doc_list in documents:
+                        self.cache_tokens(doc_list)
+
+        output = {
+            "queries":queries,
+            "file_paths":file_paths,
+            "labels":labels,
+            "documents":documents,
+            "meta":meta,
+            "params":params,
+            "debug":debug,
+        }
+
+        return output, "output_1"
+
+
+def cache_document_tokens(document_store:BaseDocumentStore,node:TokenCacheNode,filters:Optional[dict]=None,batch_size:int=1000)->int:
+    """
+    Runs the `TokenCacheNode` over all documents in the store and writes them back. Returns the number of updated documents.
+    """
+    updated = 0
+    batch:List[Document] = []
+
+    def flush():
+        nonlocal updated
+        node.cache_tokens(batch)
+        document_store.write_documents(batch,batch_size=batch_size,duplicate_documents="overwrite")
+        updated += len(batch)
+        batch.clear()
+
+    for doc in document_store.get_all_documents_generator(filters=filters,return_embedding=True,batch_size=batch_size):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush()
+    if len(batch) > 0:
+        flush()
+    return updated
+
+
+class CachedTokenEmbeddingRetriever(EmbeddingRetriever):
+    """
+    EmbeddingRetriever which uses the token ids cached by the `TokenCacheNode` when embedding documents.
+    Documents without cached ids (or with meta fields which would get embedded) are tokenized as usual.
+    Only sentence-transformers models are supported, other model formats fall back to the default behaviour.
+    """
+
+    @property
+    def _sentence_transformer(self):
+        model = getattr(self.embedding_encoder,"embedding_model",None)
+        if model is None or not hasattr(model,"tokenizer") or not hasattr(model,"max_seq_length"):
+            return None
+        return model
+
+    def _can_use_cache(self,doc:Document)->bool:
+        if doc.content_type != "text":
+            return False
+        return not any(key in doc.meta and doc.meta[key] for key in (self.embed_meta_fields or []))
+
+    def _embed_token_ids(self,token_ids:List[List[int]])->np.ndarray:
+        model = self._sentence_transformer
+        max_length = model.max_seq_length
+        embeddings = []
+        for start in range(0,len(token_ids),self.batch_size):
+            batch = []
+            for ids in token_ids[start:start+self.batch_size]:
+                #Keep the closing special token if the sequence has to be truncated
+                if len(ids) > max_length:
+                    ids = ids[:max_length-1]+ids[-1:]
+                batch.append({"input_ids":ids})
+            features = model.tokenizer.pad(batch,padding=True,return_tensors="pt")
+            features = {key:value.to(model.device) for key,value in features.items()}
+            with torch.no_grad():
+                output = model(features)["sentence_embedding"]
+            embeddings.append(output.detach().cpu().numpy())
+        return np.concatenate(embeddings)
+
+    def embed_documents(self, documents: List[Document]) -> np.ndarray:
+        model = self._sentence_transformer
+        if model is None:
+            return super().embed_documents(documents)
+
+        cached_positions = []
+        cached_ids = []
+        uncached_positions = []
+        for i,doc in enumerate(documents):
+            ids = get_cached_token_ids(doc,model.tokenizer) if self._can_use_cache(doc) else None
+            if ids:
+                cached_positions.append(i)
+                cached_ids.append(ids)
+            else:
+                uncached_positions.append(i)
+
+        if len(cached_positions) == 0:
+            return super().embed_documents(documents)
+
+        logger.info(f"Embedding {len(cached_positions)} documents from cached tokens, {len(uncached_positions)} documents have to be tokenized.")
+        cached_embeddings = self._embed_token_ids(cached_ids)
+        embeddings = np.zeros((len(documents),cached_embeddings.shape[1]),dtype=cached_embeddings.dtype)
+        embeddings[cached_positions] = cached_embeddings
+        if len(uncached_positions) > 0:
+            embeddings[uncached_positions] = super().embed_documents([documents[i] for i in uncached_positions])
+        return embeddings
+
+
+def build_token_cache_node(embedding_retriever:EmbeddingRetriever)->TokenCacheNode:
+    """
+    Creates a `TokenCacheNode` for the tokenizer of the embedding model. The reader tokenizes the question together with the passage
+    (with offsets and overflow windows), which can't be rebuilt from cached ids, so its tokenizer isn't cached.
+    """
+    tokenizers = []
+    embedding_model = getattr(embedding_retriever.embedding_encoder,"embedding_model",None)
+    if embedding_model is not None and hasattr(embedding_model,"tokenizer"):
+        tokenizers.append(embedding_model.tokenizer)
+    return TokenCacheNode(tokenizers=tokenizers)
+
+
+def disable_token_cache_indexing(document_store:BaseDocumentStore):
+    """
+    Maps the token cache as a disabled object, elasticsearch keeps it in the source but doesn't index the thousands of ids per document.
+    Must run before the first document with a token cache is written, an index which already mapped it dynamically has to be reindexed.
+    """
+    try:
+        document_store.client.indices.put_mapping(index=document_store.index,body={"properties":{TOKEN_CACHE_META_KEY:{"type":"object","enabled":False}}})
+    except Exception as e:
+        logger.warning(f"Could not disable the indexing of the token cache in '{document_store.index}', it is probably indexed already: {e}")
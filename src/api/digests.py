@@ -0,0 +1,200 @@
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any,Callable,Dict,List,Optional
+import numpy as np
+from .sentences import split_sentences
+from .metrics import MetricsRegistry
+from .executors import ModelExecutors
+
+DIGEST_META_KEY = "digest"
+
+logger = logging.getLogger(__name__)
+
+def get_digest(meta:Optional[Dict[str,Any]])->Optional[str]:
+    """
+    The digest stored in the meta of a document, None if it has none.
+    """
+    digest = meta.get(DIGEST_META_KEY) if meta else None
+    return digest.get("text") if isinstance(digest,dict) else None
+
+
+class DigestBuilder():
+    """
+    Builds compact extractive digests of documents: the sentences closest to the mean embedding of all sentences of the document,
+    up to `max_words` words, in their original order with `gap_marker` where sentences were skipped.
+    The digest is stored in the meta of the document together with a version, so rebuilding with other settings can be detected.
+    """
+    def __init__(self,embed:Callable[[List[str]],np.ndarray],max_words:int=60,gap_marker:str=" ... ") -> None:
+        self.embed = embed
+        self.max_words = max_words
+        self.gap_marker = gap_marker
+
+    @property
+    def version(self)->str:
+        return f"centroid-{self.max_words}"
+
+    def has_digest(self,document)->bool:
+        digest = document.meta.get(DIGEST_META_KEY) if document.meta else None
+        return isinstance(digest,dict) and digest.get("version") == self.version
+
+    def build(self,contents:List[str])->List[str]:
+        """
+        Digests of the contents, the sentences of all contents are embedded in one call.
+        """
+        sentences = [[content[start:end] for start,end in split_sentences(content)] for content in contents]
+        long = [i for i,content in enumerate(contents) if len(content.split()) > self.max_words and len(sentences[i]) > 1]
+        digests = list(contents)
+        if len(long) == 0:
+            return digests
+
+        embeddings = np.asarray(self.embed([sentence for i in long for sentence in sentences[i]]),dtype=np.float32)
+        embeddings /= np.maximum(np.linalg.norm(embeddings,axis=1,keepdims=True),1e-12)
+        offset = 0
+        for i in long:
+            document_embeddings = embeddings[offset:offset+len(sentences[i])]
+            offset += len(sentences[i])
+            similarities = document_embeddings@document_embeddings.mean(axis=0)
+
+            kept = []
+            words = 0
+            for index in sorted(range(len(sentences[i])),key=lambda index:-similarities[index]):
+                sentence_words = len(sentences[i][index].split())
+                if len(kept) > 0 and words+sentence_words > self.max_words:
+                    continue
+                kept.append(index)
+                words += sentence_words
+
+            parts = []
+            previous = None
+            for index in sorted(kept):
+                if previous is not None:
+                    parts.append(" " if previous == index-1 else self.gap_marker)
+                parts.append(sentences[i][index])
+                previous = index
+            digests[i] = "".join(parts)
+        return digests
+
+    def digest_documents(self,documents:List[Any])->List[Any]:
+        """
+        Stores the digest of each text document in its meta.
+        """
+        text_documents = [doc for doc in documents if doc.content_type == "text"]
+        if len(text_documents) == 0:
+            return documents
+        for doc,digest in zip(text_documents,self.build([doc.content for doc in text_documents])):
+            if doc.meta is None:
+                doc.meta = {}
+            doc.meta[DIGEST_META_KEY] = {"text":digest,"version":self.version}
+        return documents
+
+
+IDLE = "idle"
+RUNNING = "running"
+STOPPED = "stopped"
+FINISHED = "finished"
+FAILED = "failed"
+
+@dataclass
+class DigestJobStatus:
+    state:str = IDLE
+    processed:int = 0
+    updated:int = 0
+    skipped:int = 0
+    seconds:float = 0.0
+    error:Optional[str] = None
+
+
+class DigestJob():
+    """
+    Builds the missing digests of the documents in the store on a background thread and writes them back batch by batch.
+    Documents which already have a digest of the current version are skipped, so a stopped or failed run resumes
+    where it left off when it is started again. The digests of each batch are built on the `embedding` executor,
+    so the job shares the embedding model with the api requests instead of competing with them.
+    """
+    def __init__(self,document_store,builder:Callable[[],DigestBuilder],metrics:MetricsRegistry,executors:ModelExecutors) -> None:
+        self.document_store = document_store
+        self.builder = builder
+        self.metrics = metrics
+        self.executors = executors
+        self.lock = threading.Lock()
+        self.stop_requested = threading.Event()
+        self.finished = threading.Event()
+        self.finished.set()
+        self._status = DigestJobStatus()
+
+    def _finish(self,**changes):
+        """
+        Sets the terminal state together with `finished`, a `start` can't slip in between and have its run reported as done.
+        """
+        with self.lock:
+            for key,value in changes.items():
+                setattr(self._status,key,value)
+            self.finished.set()
+
+    def _write(self,builder:DigestBuilder,batch:List[Any],batch_size:int):
+        started = time.perf_counter()
+        self.executors.submit("embedding",builder.digest_documents,batch).result()
+        self.document_store.write_documents(batch,batch_size=batch_size,duplicate_documents="overwrite")
+        elapsed = time.perf_counter()-started
+        self.metrics.increment("digested_documents",len(batch))
+        self.metrics.observe("digest_documents_per_second",len(batch)/max(elapsed,1e-6))
+        with self.lock:
+            self._status.updated += len(batch)
+        batch.clear()
+
+    def _run(self,filters:Optional[dict],batch_size:int,overwrite:bool):
+        started = time.perf_counter()
+        try:
+            builder = self.builder()
+            batch = []
+            for doc in self.document_store.get_all_documents_generator(filters=filters,return_embedding=True,batch_size=batch_size):
+                if self.stop_requested.is_set():
+                    break
+                with self.lock:
+                    self._status.processed += 1
+                    self._status.seconds = time.perf_counter()-started
+                if doc.content_type != "text" or (not overwrite and builder.has_digest(doc)):
+                    with self.lock:
+                        self._status.skipped += 1
+                    continue
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    self._write(builder,batch,batch_size)
+            if len(batch) > 0:
+                self._write(builder,batch,batch_size)
+            logger.info(f"Digests: Updated {self._status.updated} documents in {time.perf_counter()-started:.2f}s")
+            self._finish(state=STOPPED if self.stop_requested.is_set() else FINISHED,seconds=time.perf_counter()-started)
+        except BaseException as e:
+            logger.exception(e)
+            self._finish(state=FAILED,error=str(e),seconds=time.perf_counter()-started)
+
+    def start(self,filters:Optional[dict]=None,batch_size:int=500,overwrite:bool=False)->bool:
+        """
+        Starts a run unless one is already running, returns whether it was started.
+        """
+        with self.lock:
+            if self._status.state == RUNNING:
+                return False
+            self._status = DigestJobStatus(state=RUNNING)
+            self.stop_requested.clear()
+            self.finished.clear()
+        threading.Thread(target=self._run,args=(filters,batch_size,overwrite),daemon=True,name="digest-job").start()
+        return True
+
+    def stop(self):
+        """
+        Stops the running job after the current batch, already written digests are kept.
+        """
+        self.stop_requested.set()
+
+    def wait(self,timeout:Optional[float]=None)->bool:
+        """
+        Blocks until the current run ended, returns False on timeout.
+        """
+        return self.finished.wait(timeout)
+
+    def status(self)->DigestJobStatus:
+        with self.lock:
+            return DigestJobStatus(**vars(self._status))
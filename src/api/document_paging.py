@@ -0,0 +1,182 @@
+import json
+import base64
+import logging
+from typing import Any,Dict,Iterable,List,Optional,Tuple,Union
+import numpy as np
+from haystack.schema import Document
+from haystack.document_stores import BaseDocumentStore
+from haystack.document_stores.filter_utils import LogicalFilterClause
+from elasticsearch.exceptions import NotFoundError
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_FIELDS = ("id","content","content_type","meta","score","embedding")
+
+class InvalidCursor(Exception):
+    pass
+
+class CursorExpired(Exception):
+    pass
+
+
+def encode_cursor(state:Dict[str,Any])->str:
+    return base64.urlsafe_b64encode(json.dumps(state,separators=(",",":")).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor:str)->Dict[str,Any]:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError,UnicodeError) as e:
+        raise InvalidCursor(f"Malformed cursor: {e}")
+    if not isinstance(state,dict) or "pit" not in state or "after" not in state:
+        raise InvalidCursor("Malformed cursor!")
+    return state
+
+
+def validate_fields(fields:Optional[List[str]]):
+    """
+    Fields are the attributes of a document or `meta.<key>` for single meta values.
+    """
+    for field in fields or []:
+        if field not in DOCUMENT_FIELDS and not (field.startswith("meta.") and len(field) > 5):
+            raise ValueError(f"Unknown document field '{field}', use one of {', '.join(DOCUMENT_FIELDS)} or meta.<key>")
+
+
+def project_document(document:Document,fields:Optional[List[str]]=None)->Dict[str,Any]:
+    """
+    Json compatible dict of a document with only the requested fields, the id is always included. Empty values are left out.
+    """
+    data = document.to_dict()
+    data.pop("id_hash_keys",None)
+    if isinstance(data.get("embedding"),np.ndarray):
+        data["embedding"] = data["embedding"].tolist()
+    if fields:
+        meta = data.get("meta") or {}
+        projected = {"id":data["id"]}
+        for field in fields:
+            if field.startswith("meta."):
+                key = field[5:]
+                if key in meta:
+                    projected.setdefault("meta",{})[key] = meta[key]
+            elif field in data:
+                projected[field] = data[field]
+        data = projected
+    return {key:value for key,value in data.items() if value is not None}
+
+
+class DocumentPager():
+    """
+    Cursor based pagination over the elasticsearch document store. A query opens a point in time and pages through it
+    with `search_after`, so every page of a cursor sees the same documents (even while documents are written) and reading
+    a page costs the same no matter how deep it is. The cursor carries the point in time, the position and the filters;
+    it expires if it isn't used for `keep_alive`.
+    """
+    def __init__(self,document_store:BaseDocumentStore,keep_alive:str="5m",excluded_meta:Optional[List[str]]=None) -> None:
+        self.document_store = document_store
+        self.keep_alive = keep_alive
+        #Large meta values which are never returned, e.g. the token cache
+        self.excluded_meta = excluded_meta or []
+
+    @property
+    def client(self):
+        return self.document_store.client
+
+    def _query(self,filters:Optional[Dict[str,Any]])->Dict[str,Any]:
+        if not filters:
+            return {"match_all":{}}
+        return {"bool":{"filter":LogicalFilterClause.parse(filters).convert_to_elasticsearch()}}
+
+    def _source(self,fields:Optional[List[str]],return_embedding:bool)->Union[Dict[str,Any],bool]:
+        """
+        Pushes the projection down to elasticsearch, meta values are stored as top level fields of the source.
+        """
+        store = self.document_store
+        excludes = list(self.excluded_meta)
+        if not return_embedding:
+            excludes.append(store.embedding_field)
+        if not fields or "meta" in fields:
+            return {"excludes":excludes}
+        includes = []
+        for field in fields:
+            if field == "content":
+                includes.append(store.content_field)
+            elif field == "content_type":
+                includes.append("content_type")
+            elif field == "embedding" and return_embedding:
+                includes.append(store.embedding_field)
+            elif field == "meta.name":
+                includes.append(store.name_field)
+            elif field.startswith("meta."):
+                includes.append(field[5:])
+        #Without any stored field only the ids are needed
+        return {"includes":includes,"excludes":excludes} if includes else False
+
+    def _to_document(self,hit:Dict[str,Any])->Document:
+        #Mirrors the conversion of the document store, fields which were projected away stay empty
+        store = self.document_store
+        source = hit.get("_source",{})
+        meta = {key:value for key,value in source.items() if key not in (store.content_field,"content_type","id_hash_keys",store.embedding_field)}
+        name = meta.pop(store.name_field,None)
+        if name:
+            meta["name"] = name
+        embedding = source.get(store.embedding_field)
+        return Document.from_dict({
+            "id":hit["_id"],
+            "content":source.get(store.content_field,""),
+            "content_type":source.get("content_type","text"),
+            "meta":meta,
+            "embedding":np.asarray(embedding,dtype=np.float32) if embedding else None,
+        })
+
+    def page(self,filters:Optional[Dict[str,Any]]=None,limit:int=100,cursor:Optional[str]=None,
+             fields:Optional[List[str]]=None,return_embedding:bool=False)->Tuple[List[Document],Optional[str]]:
+        """
+        Returns a page of up to `limit` documents and the cursor of the next page, which is None after the last page.
+        A cursor continues the query it was created by, its `filters` are used instead of the given ones.
+        """
+        if cursor:
+            state = decode_cursor(cursor)
+        else:
+            pit = self.client.open_point_in_time(index=self.document_store.index,keep_alive=self.keep_alive)["id"]
+            state = {"pit":pit,"after":None,"filters":filters}
+
+        body = {
+            "size":limit,
+            "query":self._query(state.get("filters")),
+            "pit":{"id":state["pit"],"keep_alive":self.keep_alive},
+            #The implicit tiebreaker of a point in time, the cheapest stable order
+            "sort":["_shard_doc"],
+            "_source":self._source(fields,return_embedding),
+        }
+        if state["after"] is not None:
+            body["search_after"] = state["after"]
+        try:
+            result = self.client.search(body=body)
+        except NotFoundError as e:
+            raise CursorExpired(f"The cursor expired, restart the query without a cursor: {e}")
+
+        hits = result["hits"]["hits"]
+        pit = result.get("pit_id",state["pit"])
+        documents = [self._to_document(hit) for hit in hits]
+        if len(hits) < limit:
+            self._close(pit)
+            return documents,None
+        return documents,encode_cursor({"pit":pit,"after":hits[-1]["sort"],"filters":state.get("filters")})
+
+    def _close(self,pit:str):
+        try:
+            self.client.close_point_in_time(body={"id":pit})
+        except Exception as e:
+            #It expires on its own
+            logger.debug(f"Could not close the point in time: {e}")
+
+
+def stream_documents(document_store:BaseDocumentStore,filters:Optional[Dict[str,Any]]=None,fields:Optional[List[str]]=None,
+                     return_embedding:bool=False,batch_size:int=1000,excluded_meta:Optional[List[str]]=None)->Iterable[str]:
+    """
+    All matching documents as ndjson lines, read lazily in batches of `batch_size` by the document generator of the store.
+    """
+    for document in document_store.get_all_documents_generator(filters=filters,return_embedding=return_embedding,batch_size=batch_size):
+        for key in excluded_meta or []:
+            if document.meta and key in document.meta:
+                del document.meta[key]
+        yield json.dumps(project_document(document,fields),default=str)+"\n"
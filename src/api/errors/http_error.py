@@ -1,6 +1,10 @@
 from fastapi import HTTPException
 from starlette.requests import Request
 from starlette.responses import JSONResponse
+from ..loading import ComponentNotReady
 
 async def http_error_handler(_: Request, exc: HTTPException) -> JSONResponse:
-    return JSONResponse({"errors": [exc.detail]}, status_code=exc.status_code)
\ No newline at end of file
+    return JSONResponse({"errors": [exc.detail]}, status_code=exc.status_code)
+
+async def not_ready_error_handler(_: Request, exc: ComponentNotReady) -> JSONResponse:
+    return JSONResponse({"errors": [str(exc)]}, status_code=503, headers={"Retry-After": "10"})
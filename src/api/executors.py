@@ -0,0 +1,108 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from concurrent.futures import Future,ThreadPoolExecutor
+from typing import Any,Callable,Dict,Optional
+from .metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+class ModelExecutors():
+    """
+    Size-limited thread pools per model type (e.g. chat, reader, embedding). Blocking model calls are awaited from the event loop
+    instead of running on it, and one type of model can't occupy the threads of the others.
+    """
+    def __init__(self,metrics:MetricsRegistry,workers:Dict[str,int]) -> None:
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.pools = {kind:ThreadPoolExecutor(max_workers=max(1,count),thread_name_prefix=f"{kind}-executor") for kind,count in workers.items()}
+        self.pending = {kind:0 for kind in workers}
+
+    def _update_pending(self,kind:str,change:int):
+        with self.lock:
+            self.pending[kind] += change
+            self.metrics.set_gauge(f"{kind}_executor_pending",self.pending[kind])
+
+    def submit(self,kind:str,func:Callable,*args,**kwargs)->Future:
+        """
+        Queues `func` on the pool of the model type, for callers on other threads (e.g. background jobs) which wait on the future.
+        """
+        if kind not in self.pools:
+            raise ValueError(f"Unknown executor '{kind}'!")
+        submitted = time.perf_counter()
+        def timed():
+            self.metrics.observe(f"{kind}_executor_wait_seconds",time.perf_counter()-submitted)
+            return func(*args,**kwargs)
+
+        self._update_pending(kind,1)
+        future = self.pools[kind].submit(timed)
+        future.add_done_callback(lambda _:self._update_pending(kind,-1))
+        return future
+
+    async def run(self,kind:str,func:Callable,*args,**kwargs)->Any:
+        """
+        Runs `func` on the pool of the model type and waits for its result without blocking the event loop.
+        """
+        return await asyncio.wrap_future(self.submit(kind,func,*args,**kwargs))
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=False,cancel_futures=True)
+
+
+class EventLoopLagMonitor():
+    """
+    Measures how late the event loop wakes up from a short sleep. A watchdog thread logs the stack of the event loop thread
+    if it didn't respond for longer than `threshold` seconds, which points at the blocking call.
+    """
+    def __init__(self,metrics:MetricsRegistry,interval:float=0.5,threshold:float=0.1) -> None:
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold
+        self.task:Optional[asyncio.Task] = None
+        self.loop_thread_id:Optional[int] = None
+        self.last_beat = time.perf_counter()
+        self.stopped = threading.Event()
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.last_beat = time.perf_counter()
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0,loop.time()-started-self.interval)
+            self.metrics.observe("event_loop_lag_seconds",lag)
+            if lag > self.threshold:
+                self.metrics.increment("event_loop_blocked")
+                logger.warning(f"Event loop was blocked for {lag:.3f}s")
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.threshold):
+            beat = self.last_beat
+            if beat == reported or time.perf_counter()-beat <= self.interval+self.threshold:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame))
+                logger.warning(f"Event loop is blocked, it is currently running:\n{stack}")
+
+    def start(self):
+        """
+        Starts the monitor, must be called from the event loop.
+        """
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.stopped.clear()
+        self.task = asyncio.get_running_loop().create_task(self._measure())
+        threading.Thread(target=self._watch,daemon=True,name="event-loop-watchdog").start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,183 @@
+import json
+import time
+import logging
+from dataclasses import dataclass,field
+from typing import Any,AsyncIterator,Awaitable,Callable,List,Optional,Set,Tuple,Union
+from haystack.schema import Document
+from haystack.document_stores import BaseDocumentStore
+from .metrics import MetricsRegistry
+
+SOURCE_ID_META_KEY = "source_id"
+
+logger = logging.getLogger(__name__)
+
+Enricher = Callable[[List[Document]],Any]
+
+class InvalidStream(Exception):
+    pass
+
+@dataclass
+class IngestBatchStats:
+    documents:int = 0
+    chunks:int = 0
+    skipped:int = 0
+    seconds:float = 0.0
+    documents_per_second:float = 0.0
+
+
+@dataclass
+class IngestResult:
+    documents:int = 0
+    chunks:int = 0
+    skipped:int = 0
+    failed:int = 0
+    seconds:float = 0.0
+    errors:List[str] = field(default_factory=list)
+    batches:List[IngestBatchStats] = field(default_factory=list)
+
+    def add(self,stats:IngestBatchStats):
+        self.documents += stats.documents
+        self.chunks += stats.chunks
+        self.skipped += stats.skipped
+        self.batches.append(stats)
+
+    def fail(self,line_number:int,error:Exception,max_errors:int=100):
+        self.failed += 1
+        #The count keeps going, but a broken file must not grow the response without bound
+        if len(self.errors) < max_errors:
+            self.errors.append(f"Line {line_number}: {error}")
+
+
+def chunk_id(source_id:str,index:int)->str:
+    """
+    The first chunk of a document keeps its id and marks the document as completely written, the others are numbered.
+    """
+    return source_id if index == 0 else f"{source_id}#{index}"
+
+
+def parse_document(line:Union[str,bytes])->Document:
+    """
+    A document of an ndjson line: `{"content": "...", "meta": {...}, "id": "..."}`, only the content is required.
+    """
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"Invalid json: {e}")
+    if not isinstance(data,dict) or not isinstance(data.get("content"),str) or not data["content"].strip():
+        raise ValueError("Every document needs a non empty text `content`")
+    meta = data.get("meta") or {}
+    if not isinstance(meta,dict):
+        raise ValueError("The `meta` of a document must be an object")
+    if data.get("id") is not None:
+        meta = {**meta,SOURCE_ID_META_KEY:str(data["id"])}
+    return Document(content=data["content"],meta=meta)
+
+
+async def ndjson_lines(chunks:AsyncIterator[bytes],max_line_bytes:int=16*1024*1024)->AsyncIterator[Tuple[int,bytes]]:
+    """
+    The numbered non empty lines of an ndjson byte stream, lines may span several chunks. They are decoded by the json parser,
+    so an invalid line fails on its own.
+    """
+    buffer = b""
+    line_number = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines,buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number,line
+        if len(buffer) > max_line_bytes:
+            raise InvalidStream(f"Line {line_number+1} is longer than {max_line_bytes} bytes!")
+    if buffer.strip():
+        yield line_number+1,buffer
+
+
+def embed_documents(retriever)->Enricher:
+    def enrich(documents:List[Document]):
+        for document,embedding in zip(documents,retriever.embed_documents(documents)):
+            document.embedding = embedding
+    return enrich
+
+
+class DocumentIngestor():
+    """
+    Writes batches of new documents to the store: splits them with the preprocessor, runs the enrichers (embedding, token cache,
+    digests) on the chunks and bulk writes them. Documents with an id are resumable, their chunks get ids derived from it and
+    the first chunk is written last, so a document whose id is in the store was written completely and is skipped when it is sent again.
+    """
+    def __init__(self,document_store:BaseDocumentStore,preprocessor:Callable[[],Any],metrics:MetricsRegistry,write_batch_size:int=500) -> None:
+        self.document_store = document_store
+        self.preprocessor = preprocessor
+        self.metrics = metrics
+        self.write_batch_size = write_batch_size
+
+    def _written_sources(self,documents:List[Document])->Set[str]:
+        ids = [doc.meta[SOURCE_ID_META_KEY] for doc in documents if SOURCE_ID_META_KEY in doc.meta]
+        if len(ids) == 0:
+            return set()
+        return {doc.id for doc in self.document_store.get_documents_by_id(ids,batch_size=len(ids))}
+
+    def _chunks(self,document:Document,split:bool)->List[Document]:
+        chunks = self.preprocessor().process([document]) if split else [document]
+        source_id = document.meta.get(SOURCE_ID_META_KEY)
+        if source_id is not None:
+            for index,chunk in enumerate(chunks):
+                chunk.id = chunk_id(source_id,index)
+        return chunks
+
+    def write_batch(self,documents:List[Document],split:bool=True,enrichers:Optional[List[Enricher]]=None)->IngestBatchStats:
+        started = time.perf_counter()
+        written = self._written_sources(documents)
+        new_documents = [doc for doc in documents if doc.meta.get(SOURCE_ID_META_KEY) not in written]
+
+        first_chunks,other_chunks = [],[]
+        for document in new_documents:
+            chunks = self._chunks(document,split)
+            first_chunks.extend(chunks[:1])
+            other_chunks.extend(chunks[1:])
+        chunks = other_chunks+first_chunks
+        if len(chunks) > 0:
+            for enrich in enrichers or []:
+                enrich(chunks)
+            #A bulk write can fail halfway, the first chunks only mark documents as complete once all their other chunks are written
+            if len(other_chunks) > 0:
+                self.document_store.write_documents(other_chunks,batch_size=self.write_batch_size,duplicate_documents="overwrite")
+            self.document_store.write_documents(first_chunks,batch_size=self.write_batch_size,duplicate_documents="overwrite")
+
+        elapsed = time.perf_counter()-started
+        stats = IngestBatchStats(
+            documents=len(new_documents),
+            chunks=len(chunks),
+            skipped=len(documents)-len(new_documents),
+            seconds=elapsed,
+            documents_per_second=len(new_documents)/max(elapsed,1e-6),
+        )
+        self.metrics.increment("ingested_documents",stats.documents)
+        self.metrics.observe("ingest_documents_per_second",stats.documents_per_second)
+        logger.info(f"Ingestion: Wrote {stats.documents} documents as {stats.chunks} chunks in {elapsed:.2f}s, skipped {stats.skipped}")
+        return stats
+
+
+async def ingest_ndjson(chunks:AsyncIterator[bytes],write_batch:Callable[[List[Document]],Awaitable[IngestBatchStats]],batch_size:int=100)->IngestResult:
+    """
+    Parses the ndjson stream and writes it in batches of `batch_size` documents. The next batch is only read once the previous one is
+    written, so a fast client is slowed down by the transport instead of filling the memory of the api. Invalid lines are counted and skipped.
+    """
+    started = time.perf_counter()
+    result = IngestResult()
+    batch:List[Document] = []
+    async for line_number,line in ndjson_lines(chunks):
+        try:
+            batch.append(parse_document(line))
+        except ValueError as e:
+            result.fail(line_number,e)
+            continue
+        if len(batch) >= batch_size:
+            result.add(await write_batch(batch))
+            batch = []
+    if len(batch) > 0:
+        result.add(await write_batch(batch))
+    result.seconds = time.perf_counter()-started
+    return result
+
@@ -0,0 +1,121 @@
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any,Callable,Dict,List,Optional
+from .metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+@dataclass
+class ComponentStatus:
+    state:str = LOADING
+    error:Optional[str] = None
+    load_seconds:Optional[float] = None
+    warmup_seconds:Optional[float] = None
+
+
+class ComponentNotReady(Exception):
+    def __init__(self,name:str,status:ComponentStatus) -> None:
+        reason = f": {status.error}" if status.error else ""
+        super().__init__(f"The {name} model is {status.state}{reason}")
+        self.name = name
+        self.status = status
+
+
+class ModelLoader():
+    """
+    Loads the models of the api concurrently on background threads, so the server starts accepting requests right away.
+    Each component is `loading`, then `warming` while a first inference runs, then `ready` or `failed`.
+    Requests which need a component call `require`, which raises `ComponentNotReady` until it is ready.
+    """
+    def __init__(self,metrics:MetricsRegistry) -> None:
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.components:Dict[str,Callable[[],Any]] = {}
+        self.warmups:Dict[str,Optional[Callable[[Any],None]]] = {}
+        self.statuses:Dict[str,ComponentStatus] = {}
+        self.finished:Dict[str,threading.Event] = {}
+        self.started = False
+
+    def register(self,name:str,load:Callable[[],Any],warmup:Optional[Callable[[Any],None]]=None):
+        """
+        `load` builds the component, `warmup` receives the result and runs a small inference with it.
+        """
+        with self.lock:
+            self.components[name] = load
+            self.warmups[name] = warmup
+            self.statuses[name] = ComponentStatus()
+            self.finished[name] = threading.Event()
+
+    def _set_state(self,name:str,**changes):
+        with self.lock:
+            for key,value in changes.items():
+                setattr(self.statuses[name],key,value)
+        if "state" in changes:
+            self.metrics.set_gauge(f"{name}_ready",1 if changes["state"] == READY else 0)
+
+    def _load(self,name:str):
+        try:
+            started = time.perf_counter()
+            component = self.components[name]()
+            load_seconds = time.perf_counter()-started
+            self._set_state(name,state=WARMING,load_seconds=load_seconds)
+            self.metrics.observe(f"{name}_load_seconds",load_seconds)
+
+            warmup = self.warmups[name]
+            if warmup is not None:
+                started = time.perf_counter()
+                warmup(component)
+                self._set_state(name,warmup_seconds=time.perf_counter()-started)
+            self._set_state(name,state=READY)
+            logger.info(f"Loaded the {name} model in {load_seconds:.2f}s")
+        except Exception as e:
+            logger.exception(e)
+            self._set_state(name,state=FAILED,error=str(e))
+        finally:
+            self.finished[name].set()
+
+    def start(self):
+        """
+        Starts loading all registered components, each on its own thread.
+        """
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            names = list(self.components)
+        for name in names:
+            threading.Thread(target=self._load,args=(name,),daemon=True,name=f"load-{name}").start()
+
+    def status(self)->Dict[str,ComponentStatus]:
+        with self.lock:
+            return {name:ComponentStatus(**vars(status)) for name,status in self.statuses.items()}
+
+    def is_ready(self,*names:str)->bool:
+        with self.lock:
+            names = names or tuple(self.statuses)
+            return all(self.statuses[name].state == READY for name in names)
+
+    def require(self,*names:str):
+        with self.lock:
+            for name in names:
+                status = self.statuses[name]
+                if status.state != READY:
+                    raise ComponentNotReady(name,ComponentStatus(**vars(status)))
+
+    def wait(self,names:Optional[List[str]]=None,timeout:Optional[float]=None)->bool:
+        """
+        Blocks until the components finished loading (successfully or not), returns False on timeout.
+        """
+        deadline = None if timeout is None else time.perf_counter()+timeout
+        for name in names or list(self.finished):
+            remaining = None if deadline is None else max(0.0,deadline-time.perf_counter())
+            if not self.finished[name].wait(remaining):
+                return False
+        return True
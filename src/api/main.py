@@ -6,6 +6,11 @@ root = str(Path(__file__).parent.parent)
 
 if root not in sys.path:
     sys.path.insert(0, root)
+
+#Read by the huggingface libraries when they are imported, in offline mode all models come from the model registry
+if os.getenv("MODEL_OFFLINE","").lower() in ("yes", "true", "t", "1"):
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
     
 import logging
 import uvicorn
@@ -19,8 +24,10 @@ logging.getLogger("haystack").setLevel(logging.INFO)
 from dependency_injector.wiring import Provide, inject
 
 from api.composition import Container
+from api.executors import ModelExecutors,EventLoopLagMonitor
+from api.loading import ModelLoader,ComponentNotReady
 from api.routers import HealthRouter,PipelineRouter,QueryRouter,DocumentRouter,ChatRouter
-from api.errors.http_error import http_error_handler
+from api.errors.http_error import http_error_handler,not_ready_error_handler
 
 from fastapi import FastAPI, HTTPException, APIRouter
 from starlette.middleware.cors import CORSMiddleware
@@ -47,6 +54,9 @@ def App(
     document_router:DocumentRouter=Provide[Container.document_router],
     query_router:QueryRouter=Provide[Container.query_router],
     chat_router:ChatRouter=Provide[Container.chat_router],
+    executors:ModelExecutors=Provide[Container.executors],
+    lag_monitor:EventLoopLagMonitor=Provide[Container.lag_monitor],
+    model_loader:ModelLoader=Provide[Container.model_loader],
     ):
     
     from haystack import __version__ as haystack_version
@@ -57,6 +67,11 @@ def App(
     )
     
     app.add_exception_handler(HTTPException, http_error_handler)
+    app.add_exception_handler(ComponentNotReady, not_ready_error_handler)
+    app.add_event_handler("startup", model_loader.start)
+    app.add_event_handler("startup", lag_monitor.start)
+    app.add_event_handler("shutdown", lag_monitor.stop)
+    app.add_event_handler("shutdown", executors.shutdown)
        
     router = APIRouter()
     router.include_router(query_router.router)
@@ -82,28 +97,58 @@ if __name__ == "__main__":
         container.config.extractive_qa_model.from_env("EXTRACTIVE_QA_MODEL",default="LLukas22/all-MiniLM-L12-v2-qa-en")
         container.config.use_gpu.from_env("USE_GPU",as_=parse_bool,default=False)
         container.config.use_8bit.from_env("USE_8BIT",as_=parse_bool,default=False)
+        container.config.reader_context_narrowing.from_env("READER_CONTEXT_NARROWING",as_=parse_bool,default=False)
+        container.config.reader_context_words.from_env("READER_CONTEXT_WORDS",as_=int,default=100)
+        container.config.reader_context_narrowing_mode.from_env("READER_CONTEXT_NARROWING_MODE",default="lexical")
+        container.config.reader_workers.from_env("READER_WORKERS",as_=int,default=2)
+        container.config.embedding_workers.from_env("EMBEDDING_WORKERS",as_=int,default=2)
+        container.config.event_loop_lag_threshold.from_env("EVENT_LOOP_LAG_THRESHOLD",as_=float,default=0.1)
         container.config.concurency_limit.from_env("CONCURENCY_LIMIT",as_=int,default=5)
         container.config.debug.from_env("DEBUG",as_=parse_bool,default=True)
+        container.config.model_registry_dir.from_env("MODEL_REGISTRY_DIR",default="cache/models")
+        container.config.model_offline.from_env("MODEL_OFFLINE",as_=parse_bool,default=False)
         
         container.config.chatmodel.from_env("CHATMODEL",as_=parse_chatmodel,default="CPU")
         container.config.chat_max_length.from_env("CHAT_MAX_INPUT_LENGTH",as_=int,default=2000)
+        container.config.chat_concurrency.from_env("CHAT_CONCURRENCY",as_=int,default=1)
+        container.config.chat_max_queue.from_env("CHAT_MAX_QUEUE",as_=int,default=32)
+        container.config.chat_max_wait.from_env("CHAT_MAX_WAIT",as_=float,default=300)
+        container.config.chat_heartbeat_interval.from_env("CHAT_HEARTBEAT_INTERVAL",as_=float,default=15)
+        container.config.chat_response_cache_size.from_env("CHAT_RESPONSE_CACHE_SIZE",as_=int,default=256)
+        container.config.chat_response_cache_dir.from_env("CHAT_RESPONSE_CACHE_DIR",default="cache/chat_responses")
+        container.config.rag_templates_file.from_env("RAG_TEMPLATES_FILE",default="")
+        container.config.rag_context_tokens.from_env("RAG_CONTEXT_TOKENS",as_=int,default=512)
+        container.config.digest_max_words.from_env("DIGEST_MAX_WORDS",as_=int,default=60)
+        container.config.ingest_split_length.from_env("INGEST_SPLIT_LENGTH",as_=int,default=250)
         
         #OpenAI Vars
         container.config.open_ai_token.from_env("OPENAI_TOKEN",default=None)
+        container.config.openai_base_url.from_env("OPENAI_BASE_URL",default="https://api.openai.com/v1")
+        container.config.openai_max_concurrency.from_env("OPENAI_MAX_CONCURRENCY",as_=int,default=4)
+        container.config.openai_max_retries.from_env("OPENAI_MAX_RETRIES",as_=int,default=5)
+        container.config.openai_context_length.from_env("OPENAI_CONTEXT_LENGTH",as_=int,default=4096)
         
         #GPU Vars
         container.config.base_chat_model.from_env("BASE_CHAT_MODEL",default="decapoda-research/llama-7b-hf")
         container.config.use_peft.from_env("USE_PEFT",as_=parse_bool,default=True)
         container.config.adapter_chat_model.from_env("ADAPTER_CHAT_MODEL",default="tloen/alpaca-lora-7b")
+        container.config.chat_device.from_env("CHAT_DEVICE",default="cuda")
+        container.config.draft_chat_model.from_env("DRAFT_CHAT_MODEL",default="")
+        container.config.draft_tokens.from_env("DRAFT_TOKENS",as_=int,default=4)
         
+        container.config.chat_batch_size.from_env("CHAT_BATCH_SIZE",as_=int,default=1)
+        container.config.chat_prefix_cache_mb.from_env("CHAT_PREFIX_CACHE_MB",as_=int,default=0)
         container.config.chat_apply_optimizations.from_env("ADAPTER_APPLY_OPTIMIZATIONS",as_=parse_bool,default=True)
         
         #CPU Vars
         container.config.cpu_model_repo.from_env("CPU_MODEL_REPO",default="LLukas22/alpaca-native-7B-4bit-ggjt")
         container.config.cpu_model_filename.from_env("CPU_MODEL_FILENAME",default="ggjt-model.bin")
         container.config.cpu_model_threads.from_env("CPU_MODEL_THREADS",as_=int,default=8)
+        container.config.cpu_model_instances.from_env("CPU_MODEL_INSTANCES",as_=int,default=1)
         container.config.cpu_model_kv_16.from_env("CPU_MODEL_KV_16",as_=parse_bool,default=True)
         container.config.cpu_model_mmap.from_env("CPU_MODEL_MMAP",as_=parse_bool,default=True)
+        container.config.cpu_model_calibrate_threads.from_env("CPU_MODEL_CALIBRATE_THREADS",as_=parse_bool,default=False)
+        container.config.cpu_model_calibration_file.from_env("CPU_MODEL_CALIBRATION_FILE",default="cache/thread_calibration.json")
         container.wire(modules=[__name__])
         
     
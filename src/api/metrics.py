@@ -0,0 +1,74 @@
+import time
+import threading
+import collections
+from typing import Dict,Any,Deque,Tuple,Optional
+
+class MetricsRegistry():
+    """
+    In-process registry for counters, gauges and observations which are exposed over the health router.
+    Observations keep a rolling window of the most recent values to calculate percentiles and rates.
+    """
+    def __init__(self,window:int=1000,rate_interval:float=300) -> None:
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.window = window
+        self.rate_interval = rate_interval
+        self.counters:Dict[str,int] = {}
+        self.gauges:Dict[str,float] = {}
+        self.observations:Dict[str,Deque[Tuple[float,float]]] = {}
+        self.observation_counts:Dict[str,int] = {}
+
+    def increment(self,name:str,value:int=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + value
+
+    def get(self,name:str)->int:
+        with self.lock:
+            return self.counters.get(name,0)
+
+    def set_gauge(self,name:str,value:float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self,name:str,value:float):
+        with self.lock:
+            if name not in self.observations:
+                self.observations[name] = collections.deque(maxlen=self.window)
+            self.observations[name].append((time.time(),value))
+            self.observation_counts[name] = self.observation_counts.get(name,0) + 1
+
+    def _summarize(self,name:str,values:Deque[Tuple[float,float]])->Dict[str,float]:
+        now = time.time()
+        ordered = sorted(value for _,value in values)
+        def percentile(p:float)->float:
+            return ordered[min(len(ordered)-1,int(round(p*(len(ordered)-1))))]
+        recent = sum(1 for timestamp,_ in values if timestamp >= now-self.rate_interval)
+        interval = min(self.rate_interval,max(now-self.started_at,1e-6))
+        return {
+            "count":self.observation_counts[name],
+            "mean":sum(ordered)/len(ordered),
+            "p50":percentile(0.5),
+            "p90":percentile(0.9),
+            "p99":percentile(0.99),
+            "max":ordered[-1],
+            "per_minute":recent/interval*60,
+        }
+
+    def summary(self,name:str)->Optional[Dict[str,float]]:
+        """
+        Percentiles and rate of one observation, None if nothing was observed yet.
+        """
+        with self.lock:
+            values = self.observations.get(name)
+            if not values:
+                return None
+            return self._summarize(name,values)
+
+    def snapshot(self)->Dict[str,Any]:
+        with self.lock:
+            return {
+                "uptime_seconds":time.time()-self.started_at,
+                "counters":dict(self.counters),
+                "gauges":dict(self.gauges),
+                "observations":{name:self._summarize(name,values) for name,values in self.observations.items() if len(values) > 0},
+            }
@@ -0,0 +1,54 @@
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Dict,Generic,Iterator,List,Optional,TypeVar
+
+T = TypeVar("T")
+
+def split_threads(threads:int,instances:int)->List[int]:
+    """
+    Splits a thread budget as evenly as possible across model instances, every instance gets at least one thread.
+    """
+    instances = max(1,instances)
+    base,remainder = divmod(max(threads,instances),instances)
+    return [base+1 if i < remainder else base for i in range(instances)]
+
+
+class ModelPool(Generic[T]):
+    """
+    A fixed set of model instances, each used by a single generation at a time.
+    Generations wait until an instance is free, so with as many scheduler slots as instances every admitted chat gets one immediately.
+    """
+    def __init__(self,instances:List[T]) -> None:
+        if len(instances) == 0:
+            raise ValueError("A model pool needs at least one instance!")
+        self.instances = instances
+        self.free:"queue.Queue[T]" = queue.Queue()
+        for instance in instances:
+            self.free.put(instance)
+        self.lock = threading.Lock()
+        self.waiting = 0
+
+    @property
+    def size(self)->int:
+        return len(self.instances)
+
+    @contextmanager
+    def acquire(self,timeout:Optional[float]=None)->Iterator[T]:
+        with self.lock:
+            self.waiting += 1
+        try:
+            instance = self.free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No free model instance!")
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        try:
+            yield instance
+        finally:
+            self.free.put(instance)
+
+    def stats(self)->Dict[str,int]:
+        with self.lock:
+            return {"instances":self.size,"busy":self.size-self.free.qsize(),"waiting":self.waiting}
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass,field,asdict
+from typing import Dict,List,Optional,Set
+from huggingface_hub import hf_hub_download,snapshot_download
+
+logger = logging.getLogger(__name__)
+
+#Weights of other frameworks, the models are only loaded with torch or llm-rs
+IGNORED_PATTERNS = ["*.h5","*.msgpack","*.onnx","*.ot","*.tflite","*.mlmodel","*.tar.gz"]
+
+class ModelNotAvailable(Exception):
+    pass
+
+
+@dataclass
+class ManifestFile:
+    size:int
+    sha256:str
+
+
+@dataclass
+class ManifestEntry:
+    """
+    A resolved model: the path of its snapshot (or single file), relative to the registry if it is inside of it,
+    and the size and checksum of every file in it.
+    """
+    path:str
+    files:Dict[str,ManifestFile] = field(default_factory=dict)
+    resolved_at:float = 0.0
+    verified_at:Optional[float] = None
+    corrupt:bool = False
+
+
+def _sha256(path:str)->str:
+    digest = hashlib.sha256()
+    with open(path,"rb") as f:
+        for block in iter(lambda:f.read(1024*1024),b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _snapshot_files(path:str)->List[str]:
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(directory,name) for directory,_,names in os.walk(path) for name in names)
+
+
+class ModelRegistry():
+    """
+    Local registry of the models the api loads. The first resolve of a model downloads it from the huggingface hub into `root`
+    and records its path and file checksums in `root/manifest.json`. Later resolves only check the manifest and the file sizes,
+    so a start with all models present makes no network calls. The checksums are verified on a background thread afterwards,
+    a model which fails the verification is downloaded again on the next start, or refused in offline mode.
+    """
+    def __init__(self,root:str,offline:bool=False,token:Optional[str]=None) -> None:
+        self.root = root
+        self.offline = offline
+        self.token = token or None
+        self.lock = threading.Lock()
+        os.makedirs(self.root,exist_ok=True)
+        self.entries:Dict[str,ManifestEntry] = self._read_manifest()
+        #Models whose checksums were computed or verified by this process
+        self.verified:Set[str] = set()
+
+    @property
+    def manifest_path(self)->str:
+        return os.path.join(self.root,"manifest.json")
+
+    def _read_manifest(self)->Dict[str,ManifestEntry]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path,"r",encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError,ValueError) as e:
+            logger.warning(f"Could not read the model manifest {self.manifest_path}: {e}")
+            return {}
+        entries = {}
+        for name,entry in manifest.items():
+            files = {file:ManifestFile(**info) for file,info in entry.pop("files",{}).items()}
+            entries[name] = ManifestEntry(files=files,**entry)
+        return entries
+
+    def _write_manifest(self):
+        #Called with the lock held, written to a temporary file first so a crash can't leave a truncated manifest behind
+        temporary = f"{self.manifest_path}.tmp"
+        with open(temporary,"w",encoding="utf-8") as f:
+            json.dump({name:asdict(entry) for name,entry in self.entries.items()},f,indent=2)
+        os.replace(temporary,self.manifest_path)
+
+    def _path(self,entry:ManifestEntry,file:str="")->str:
+        #Relative paths keep the registry valid if it is mounted at another location
+        path = os.path.join(self.root,entry.path)
+        return os.path.join(path,file) if file else path
+
+    def _is_present(self,entry:ManifestEntry)->bool:
+        """
+        Cheap check without reading the files: every file of the manifest exists with its recorded size.
+        """
+        if entry.corrupt or len(entry.files) == 0:
+            return False
+        for file,info in entry.files.items():
+            path = self._path(entry,file)
+            if not os.path.isfile(path) or os.path.getsize(path) != info.size:
+                return False
+        return True
+
+    def _record(self,name:str,path:str)->ManifestEntry:
+        files = {}
+        for file in _snapshot_files(path):
+            relative = os.path.relpath(file,path) if os.path.isdir(path) else ""
+            files[relative] = ManifestFile(size=os.path.getsize(file),sha256=_sha256(file))
+        inside = os.path.commonpath([os.path.abspath(path),os.path.abspath(self.root)]) == os.path.abspath(self.root)
+        entry = ManifestEntry(path=os.path.relpath(path,self.root) if inside else path,files=files,resolved_at=time.time(),verified_at=time.time())
+        with self.lock:
+            self.entries[name] = entry
+            self.verified.add(name)
+            self._write_manifest()
+        return entry
+
+    def _resolve(self,name:str,download)->str:
+        with self.lock:
+            entry = self.entries.get(name)
+            verify = name not in self.verified
+            self.verified.add(name)
+        if entry is not None and self._is_present(entry):
+            if verify:
+                threading.Thread(target=self.verify,args=(name,),daemon=True,name=f"verify-{name}").start()
+            return self._path(entry)
+        if self.offline:
+            reason = "failed its checksum verification" if entry is not None and entry.corrupt else "is not in the local model registry"
+            raise ModelNotAvailable(f"The model {name} {reason} and the api runs in offline mode!")
+
+        logger.info(f"Downloading {name} into the model registry")
+        started = time.perf_counter()
+        path = download(entry is not None and entry.corrupt)
+        self._record(name,path)
+        logger.info(f"Registered {name} in {time.perf_counter()-started:.2f}s")
+        return path
+
+    def resolve_snapshot(self,repo_id:str,revision:Optional[str]=None)->str:
+        """
+        Local directory of a model repository. Local paths are returned unchanged.
+        """
+        if os.path.exists(repo_id):
+            return repo_id
+        name = f"{repo_id}@{revision}" if revision else repo_id
+        return self._resolve(name,lambda force:snapshot_download(repo_id,revision=revision,cache_dir=os.path.join(self.root,"hub"),ignore_patterns=IGNORED_PATTERNS,token=self.token,force_download=force))
+
+    def resolve_file(self,repo_id:str,filename:str,revision:Optional[str]=None)->str:
+        """
+        Local path of a single file of a model repository, e.g. a ggml model.
+        """
+        name = f"{repo_id}/{filename}@{revision}" if revision else f"{repo_id}/{filename}"
+        return self._resolve(name,lambda force:hf_hub_download(repo_id=repo_id,filename=filename,revision=revision,cache_dir=os.path.join(self.root,"hub"),token=self.token,force_download=force))
+
+    def verify(self,name:str)->bool:
+        """
+        Compares the checksums of the files of a model with the manifest. A mismatch marks the model as corrupt.
+        """
+        with self.lock:
+            entry = self.entries[name]
+        started = time.perf_counter()
+        valid = True
+        for file,info in entry.files.items():
+            path = self._path(entry,file)
+            if not os.path.isfile(path) or _sha256(path) != info.sha256:
+                logger.error(f"Model registry: {path} of {name} doesn't match its checksum!")
+                valid = False
+                break
+        with self.lock:
+            entry.verified_at = time.time() if valid else None
+            entry.corrupt = not valid
+            self._write_manifest()
+        if valid:
+            logger.info(f"Model registry: Verified {name} in {time.perf_counter()-started:.2f}s")
+        return valid
+
+    def manifest(self)->Dict[str,ManifestEntry]:
+        with self.lock:
+            return dict(self.entries)
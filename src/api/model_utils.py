@@ -1,6 +1,5 @@
-import time 
-import queue
 import threading
+import logging
 import collections.abc
 
 from transformers.generation.streamers import BaseStreamer
@@ -12,6 +11,10 @@ import torch
 
 from llm_rs import Llama,SessionConfig,Precision
 from llm_rs import GenerationConfig as RSGenerationConfig
+from .streaming import TokenStream,StopWordMatcher,IncrementalDetokenizer
+from .model_pool import ModelPool
+
+logger = logging.getLogger(__name__)
 
 class ManualStopCondition(StoppingCriteria):
     """
@@ -35,13 +38,12 @@ class TextStreamer(BaseStreamer):
         self.decode_kwargs = decode_kwargs
 
         # variables used in the streaming process
-        self.token_cache = []
-        self.print_len = 0
+        self.detokenizer = IncrementalDetokenizer(tokenizer,**decode_kwargs)
         self.next_tokens_are_prompt = True
 
     def put(self, value):
         """
-        Recives tokens, decodes them, and prints them to stdout as soon as they form entire words.
+        Recives tokens, decodes them incrementally, and prints the new text to stdout.
         """
         if len(value.shape) > 1 and value.shape[0] > 1:
             raise ValueError("TextStreamer only supports batch size 1")
@@ -52,34 +54,13 @@ class TextStreamer(BaseStreamer):
             self.next_tokens_are_prompt = False
             return
 
-        # Add the new token to the cache and decodes the entire thing.
-        self.token_cache.extend(value.tolist())
-        text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
-
-        # After the symbol for a new line, we flush the cache.
-        if text.endswith("\n"):
-            printable_text = text[self.print_len :]
-            self.token_cache = []
-            self.print_len = 0
-        # Otherwise, prints until the last space char (simple heuristic to avoid printing incomplete words,
-        # which may change with the subsequent token -- there are probably smarter ways to do this!)
-        else:
-            printable_text = text[self.print_len : text.rfind(" ") + 1]
-            self.print_len += len(printable_text)
-
+        # Only decodes a small window around the new tokens, the cost per token stays constant
+        printable_text = self.detokenizer.put(value.tolist())
         self.on_finalized_text(printable_text)
 
     def end(self):
         """Flushes any remaining cache and prints a newline to stdout."""
-        # Flush the cache, if it exists
-        if len(self.token_cache) > 0:
-            text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
-            printable_text = text[self.print_len :]
-            self.token_cache = []
-            self.print_len = 0
-        else:
-            printable_text = ""
-
+        printable_text = self.detokenizer.flush()
         self.next_tokens_are_prompt = True
         self.on_finalized_text(printable_text, stream_end=True)
 
@@ -87,73 +68,118 @@ class TextStreamer(BaseStreamer):
         """Prints the new text to stdout. If the stream is ending, also prints a newline."""
         print(text, flush=True, end="" if not stream_end else None)
         
-#see https://stackoverflow.com/questions/42983569/how-to-write-a-generator-class
 class GeneratorStreamer(TextStreamer):
     """
-    Base class from which `.generate()` streamers should inherit.
+    Streamer which passes the decoded text of `.generate()` into a `TokenStream`.
     """
-    def __init__(self, tokenizer: "AutoTokenizer",stop_condition:ManualStopCondition,skip_prompt:bool=True,stop_words:List[str]=None) -> None:
+    def __init__(self, tokenizer: "AutoTokenizer",stop_condition:ManualStopCondition,skip_prompt:bool=True,stop_words:List[str]=None,max_buffer:Optional[int]=64,max_new_tokens:Optional[int]=None) -> None:
         super().__init__(tokenizer,skip_prompt)
         self.finished=False
         self.stop_condition=stop_condition
-        self.generated_text = queue.Queue()
-        self.total_generated_text=""
+        self.stream=TokenStream(max_buffer=max_buffer)
         self.stop_words=stop_words if stop_words else []
+        self.stop_word_matcher=StopWordMatcher(self.stop_words)
+        self.max_new_tokens=max_new_tokens
+        self.stop_reason:Optional[str]=None
+        
+    def put(self, value):
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.stream.prompt_tokens = value.shape[-1]
+        else:
+            self.stream.completion_tokens = (self.stream.completion_tokens or 0) + value.shape[-1]
+        super().put(value)
               
     def on_finalized_text(self, token: str, stream_end: bool = False):
-        self.total_generated_text+=token
-        for stop_word in self.stop_words:
-            if stop_word in self.total_generated_text:
-                self.finished=True
-                self.stop_condition.stop()
-                break
+        if self.stream.cancelled and not self.finished:
+            #The consumer is gone, e.g. the client disconnected
+            self.finished=True
+            self.stop_reason="Cancelled!"
+            self.stop_condition.stop()
             
-        if not self.finished:    
-            self.generated_text.put(token)
+        if not self.finished:
+            released,stopped = self.stop_word_matcher.feed(token)
             if stream_end:
+                released += self.stop_word_matcher.flush()
+            if len(released) > 0 and not self.stream.put(released):
+                stopped = True
+            if stopped:
                 self.finished=True
-            
-    def __iter__(self)->str:
-        while not self.finished or not self.generated_text.empty():
-            if self.generated_text.empty():
-                time.sleep(0.1)
-            else:
-                next_word = self.generated_text.get()
-                yield next_word
-                
+                self.stop_reason="Stopword detected!"
+                self.stop_condition.stop()
                 
+        if stream_end:
+            self.finished=True
+            if self.stop_reason is None:
+                #generate() either ran into max_new_tokens or the model emitted the end of sequence token
+                reached_max = self.max_new_tokens is None or (self.stream.completion_tokens or 0) >= self.max_new_tokens
+                self.stop_reason="Max Tokens!" if reached_max else "End of sequence!"
+            self.stream.end(self.stop_reason)
+            
+    def __iter__(self):
+        yield from self.stream
+        self.stream.log_stats(logger,"GeneratorStreamer")
+        
+    def __aiter__(self):
+        return self.stream.__aiter__()
                 
                 
 class CPUStreamer():
-        def __init__(self,model:Llama,config:RSGenerationConfig,prompt:str,stop_words:List[str]=[]) -> None:
-            self.model = model
+        def __init__(self,pool:ModelPool[Llama],config:RSGenerationConfig,prompt:str,stop_words:List[str]=[],max_buffer:int=64) -> None:
+            self.pool = pool
             self.config = config
             self.prompt = prompt
             self.stop_words = stop_words
-            self.generated_text = ""
+            self.stop_word_matcher = StopWordMatcher(stop_words)
             self.result = None
-            self.generated_tokens = queue.Queue()
+            self.stream = TokenStream(max_buffer=max_buffer)
             
             self.thread = threading.Thread(target=self._run,daemon=True)
             
+        def _stop_reason(self)->str:
+            if self.stream.cancelled:
+                return "Cancelled!"
+            if self.stop_word_matcher.stopped:
+                return "Stopword detected!"
+            if self.result is not None and "EndToken" in str(self.result.stop_reason):
+                return "End of sequence!"
+            return "Max Tokens!"
+            
         def _run(self):
-            self.result = self.model.generate(prompt=self.prompt,generation_config=self.config,callback= self._callback)
+            try:
+                with self.pool.acquire() as model:
+                    if self.stream.cancelled:
+                        return
+                    self.stream.prompt_tokens = len(model.tokenize(self.prompt))
+                    self.stream.completion_tokens = 0
+                    self.result = model.generate(prompt=self.prompt,generation_config=self.config,callback= self._callback)
+                    self.stream.prompt_eval_seconds = self.result.times.prompt_feeding/1000
+                remaining = self.stop_word_matcher.flush()
+                if len(remaining) > 0:
+                    self.stream.put(remaining)
+                self.stream.end(self._stop_reason())
+            except Exception as e:
+                logger.exception(e)
+                self.stream.end("Error!")
+            finally:
+                self.stream.end()
             
         def _callback(self,token:str)->Optional[bool]:
-            self.generated_text += token
-            for stop_word in self.stop_words:
-                if stop_word in self.generated_text:
-                    return True
+            if self.stream.cancelled:
+                return True
             
-            self.generated_tokens.put(token)
+            self.stream.completion_tokens += 1
+            released,stopped = self.stop_word_matcher.feed(token)
+            if len(released) > 0 and not self.stream.put(released):
+                return True
+            if stopped:
+                return True
                 
         def start(self):
             self.thread.start()  
             
         def __iter__(self):
-            while self.thread.is_alive() or not self.generated_tokens.empty():
-                if self.generated_tokens.empty():
-                    time.sleep(0.1)
-                else:
-                    next_word = self.generated_tokens.get()
-                    yield next_word
\ No newline at end of file
+            yield from self.stream
+            self.stream.log_stats(logger,"CPUStreamer")
+            
+        def __aiter__(self):
+            return self.stream.__aiter__()
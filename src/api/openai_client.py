@@ -0,0 +1,130 @@
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any,AsyncIterator,Dict,Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = {429,500,502,503,504}
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms":0.001,"s":1,"m":60,"h":3600}
+
+class OpenAIError(Exception):
+    def __init__(self,status_code:Optional[int],message:str) -> None:
+        super().__init__(f"OpenAI API error {status_code}: {message}" if status_code else message)
+        self.status_code = status_code
+
+
+def parse_duration(value:Optional[str])->Optional[float]:
+    """
+    Parses the `Retry-After` header (seconds) and the `x-ratelimit-reset-*` headers (e.g. "1m30s", "250ms") into seconds.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = DURATION_PATTERN.findall(value)
+    if len(matches) == 0:
+        return None
+    return sum(float(amount)*DURATION_UNITS[unit] for amount,unit in matches)
+
+
+class OpenAIClient():
+    """
+    Async client for the chat completions API with a pooled http connection, a cap on concurrent requests and retries with backoff.
+    A rate limit response pauses all requests until the limit resets, instead of letting every request run into it.
+    """
+    def __init__(self,token:str,base_url:str="https://api.openai.com/v1",max_concurrency:int=4,max_retries:int=5,timeout:float=60,max_backoff:float=30) -> None:
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization":f"Bearer {token}"},
+            timeout=httpx.Timeout(timeout,connect=10),
+            limits=httpx.Limits(max_connections=max_concurrency,max_keepalive_connections=max_concurrency),
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.blocked_until = 0.0
+        self.retries = 0
+
+    def _backoff(self,attempt:int)->float:
+        return min(self.max_backoff,0.5*2**attempt)*(0.5+random.random()/2)
+
+    def _retry_delay(self,attempt:int,response:httpx.Response)->float:
+        for header in ("retry-after","x-ratelimit-reset-requests","x-ratelimit-reset-tokens"):
+            delay = parse_duration(response.headers.get(header))
+            if delay is not None:
+                return min(self.max_backoff,delay)
+        return self._backoff(attempt)
+
+    async def _wait_for_rate_limit(self):
+        delay = self.blocked_until-time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def _post(self,path:str,payload:Dict[str,Any],stream:bool)->AsyncIterator[httpx.Response]:
+        attempt = 0
+        while True:
+            await self._wait_for_rate_limit()
+            async with self.semaphore:
+                error = None
+                try:
+                    response = await self.client.send(self.client.build_request("POST",path,json=payload),stream=stream)
+                except httpx.TransportError as e:
+                    response,error = None,e
+
+                if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                    try:
+                        if response.status_code >= 400:
+                            await response.aread()
+                            raise OpenAIError(response.status_code,response.text)
+                        yield response
+                    finally:
+                        await response.aclose()
+                    return
+
+                if response is not None:
+                    delay = self._retry_delay(attempt,response)
+                    await response.aread()
+                    await response.aclose()
+                    if response.status_code == 429:
+                        self.blocked_until = max(self.blocked_until,time.monotonic()+delay)
+                    error = OpenAIError(response.status_code,response.text)
+                else:
+                    delay = self._backoff(attempt)
+
+            if attempt >= self.max_retries:
+                raise error if isinstance(error,OpenAIError) else OpenAIError(None,str(error))
+            attempt += 1
+            self.retries += 1
+            logger.warning(f"OpenAI request failed ({error}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def chat(self,payload:Dict[str,Any])->Dict[str,Any]:
+        async with self._post("/chat/completions",payload,stream=False) as response:
+            return response.json()
+
+    async def chat_stream(self,payload:Dict[str,Any])->AsyncIterator[Dict[str,Any]]:
+        """
+        Yields the parsed server-sent chunks. Requests are only retried until the response started.
+        """
+        async with self._post("/chat/completions",{**payload,"stream":True},stream=True) as response:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+
+    async def aclose(self):
+        await self.client.aclose()
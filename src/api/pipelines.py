@@ -3,6 +3,7 @@ from haystack import Pipeline
 from haystack.nodes import TransformersReader,EmbeddingRetriever,BM25Retriever,JoinDocuments
 from haystack.schema import MultiLabel, Document
 from .custom_nodes.tagging_nodes import DocumentTaggingNode
+from .custom_nodes.narrowing_nodes import ContextNarrowingNode,ContextRestoringNode
 
 class CustomPipeline():
     """
@@ -48,6 +49,11 @@ class SearchPipeline(CustomPipeline):
     
      
 class ExtractiveQAPipeline(SearchPipeline):
-    def __init__(self,bm25_retreiver:BM25Retriever,embedding_retriever:EmbeddingRetriever,reader:TransformersReader) -> None:
+    def __init__(self,bm25_retreiver:BM25Retriever,embedding_retriever:EmbeddingRetriever,reader:TransformersReader,narrowing_node:Optional[ContextNarrowingNode]=None) -> None:
         super().__init__(bm25_retreiver=bm25_retreiver,embedding_retriever=embedding_retriever)
-        self.pipeline.add_node(component=reader, name="Reader", inputs=["Join"])
\ No newline at end of file
+        if narrowing_node:
+            self.pipeline.add_node(component=narrowing_node, name="Narrowing", inputs=["Join"])
+            self.pipeline.add_node(component=reader, name="Reader", inputs=["Narrowing"])
+            self.pipeline.add_node(component=ContextRestoringNode(context_window_size=reader.context_window_size), name="Restoring", inputs=["Reader"])
+        else:
+            self.pipeline.add_node(component=reader, name="Reader", inputs=["Join"])
\ No newline at end of file
@@ -0,0 +1,60 @@
+import hashlib
+import threading
+import collections
+from typing import Any,Callable,List,Optional,Tuple,Sequence
+
+def hash_tokens(token_ids:Sequence[int])->str:
+    return hashlib.sha1(",".join(map(str,token_ids)).encode("utf-8")).hexdigest()
+
+
+class PrefixStateCache():
+    """
+    LRU cache of model states (e.g. the kv-cache) after evaluating a prompt prefix, keyed by the hash of the prefix tokens.
+    Entries are evicted once the summed size of all states exceeds `max_size`.
+    """
+    def __init__(self,max_size:int,size_of:Callable[[Any],int]) -> None:
+        self.max_size = max_size
+        self.size_of = size_of
+        self.lock = threading.Lock()
+        self.entries:"collections.OrderedDict[str,Tuple[int,Any,int]]" = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self,prefix:Sequence[int],state:Any):
+        """
+        Stores the state after evaluating `prefix`.
+        """
+        size = self.size_of(state)
+        if size > self.max_size:
+            return
+        key = hash_tokens(prefix)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (len(prefix),state,size)
+            self.size += size
+            while self.size > self.max_size:
+                _,(_,_,evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def contains(self,prefix:Sequence[int])->bool:
+        with self.lock:
+            return hash_tokens(prefix) in self.entries
+
+    def lookup(self,token_ids:Sequence[int],boundaries:List[int])->Tuple[int,Optional[Any]]:
+        """
+        Finds the longest cached prefix of `token_ids` ending at one of the `boundaries`.
+        Returns the length of the prefix and its state or (0,None) on a miss.
+        """
+        with self.lock:
+            for boundary in sorted(boundaries,reverse=True):
+                key = hash_tokens(token_ids[:boundary])
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    length,state,_ = self.entries[key]
+                    return length,state
+            self.misses += 1
+            return 0,None
@@ -0,0 +1,101 @@
+import hashlib
+import threading
+import collections
+from dataclasses import dataclass
+from typing import Callable,List,Optional
+from schemas.chat import ChatMessage
+
+@dataclass
+class PackedMessages:
+    messages:List[ChatMessage]
+    tokens:int
+    dropped:int = 0
+    truncated:int = 0
+
+    @property
+    def trimmed(self)->bool:
+        return self.dropped > 0 or self.truncated > 0
+
+
+class PromptPacker():
+    """
+    Fits chat messages into a token budget. System messages and the last `keep_last` messages are always kept,
+    older turns are dropped oldest first. If the kept messages still don't fit, they are truncated to their last words,
+    older turns first, then the system messages and the newest message last.
+    Token counts are cached per formatted message, so each message is only tokenized once over the course of a chat.
+    """
+    def __init__(self,count_tokens:Callable[[str],int],format_message:Callable[[ChatMessage],str],keep_last:int=2,cache_size:int=4096) -> None:
+        self.count_tokens = count_tokens
+        self.format_message = format_message
+        self.keep_last = keep_last
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.cache:"collections.OrderedDict[str,int]" = collections.OrderedDict()
+
+    def count(self,message:ChatMessage)->int:
+        text = self.format_message(message)
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        tokens = self.count_tokens(text)
+        with self.lock:
+            self.cache[key] = tokens
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return tokens
+
+    def _truncate(self,message:ChatMessage,budget:int)->Optional[ChatMessage]:
+        """
+        The message reduced to as many of its last words as fit into `budget` tokens, None if not even one word fits.
+        """
+        words = message.content.split(" ")
+        low,high = 0,len(words)
+        while low < high:
+            middle = (low+high+1)//2
+            candidate = ChatMessage(role=message.role,content=" ".join(words[len(words)-middle:]))
+            if self.count(candidate) <= budget:
+                low = middle
+            else:
+                high = middle-1
+        if low == 0:
+            return None
+        return ChatMessage(role=message.role,content=" ".join(words[len(words)-low:]))
+
+    def pack(self,messages:List[ChatMessage],budget:int)->PackedMessages:
+        counts = [self.count(message) for message in messages]
+        total = sum(counts)
+        if total <= budget:
+            return PackedMessages(messages=list(messages),tokens=total)
+
+        last = len(messages)-1
+        protected = {i for i,message in enumerate(messages) if message.role == "system"} | set(range(max(0,len(messages)-self.keep_last),len(messages)))
+        kept = {}
+        dropped = 0
+        for i,message in enumerate(messages):
+            if total > budget and i not in protected:
+                total -= counts[i]
+                dropped += 1
+            else:
+                kept[i] = message
+
+        truncated = 0
+        truncation_order = [i for i in kept if i != last and messages[i].role != "system"]
+        truncation_order += [i for i in kept if messages[i].role == "system" and i != last] + [last]
+        for i in truncation_order:
+            if total <= budget:
+                break
+            message = self._truncate(kept[i],budget-(total-counts[i]))
+            if message is None and i != last:
+                del kept[i]
+                total -= counts[i]
+                dropped += 1
+                continue
+            if message is None:
+                message = ChatMessage(role=kept[i].role,content="")
+            kept[i] = message
+            total += self.count(message)-counts[i]
+            truncated += 1
+
+        return PackedMessages(messages=[kept[i] for i in sorted(kept)],tokens=total,dropped=dropped,truncated=truncated)
@@ -0,0 +1,69 @@
+import re
+import json
+from dataclasses import dataclass
+from typing import Dict,List,Optional
+from schemas.chat import ChatMessage
+
+PLACEHOLDER_PATTERN = re.compile(r"\{(question|contexts|hints)\}")
+
+@dataclass
+class RagPromptTemplate:
+    """
+    Prompt of a retrieval augmented chat. The message contents can contain `{question}`, `{contexts}` and `{hints}`,
+    each context is rendered with `context` (`{index}`, `{content}`, `{hint}`) and each hint with `hint` (`{index}`, `{answer}`).
+    Leading messages without placeholders are the same for every question, their state can be prepared while retrieval runs.
+    """
+    messages:List[Dict[str,str]]
+    context:str = 'Context {index}: "{content}"'
+    hint:str = 'Hint for context {index}: "{answer}"'
+    separator:str = "\n"
+    hints_header:str = ""
+
+    def static_messages(self)->List[ChatMessage]:
+        static = []
+        for message in self.messages:
+            if PLACEHOLDER_PATTERN.search(message["content"]):
+                break
+            static.append(ChatMessage(**message))
+        return static
+
+    def build(self,question:str,contexts:List[str],answers:List[str],include_answer_spans:bool=False)->List[ChatMessage]:
+        hints = [self.hint.format(index=i+1,answer=answer) for i,answer in enumerate(answers)] if include_answer_spans else []
+        rendered_contexts = [self.context.format(index=i+1,content=context,hint=hints[i] if i < len(hints) else "") for i,context in enumerate(contexts)]
+        values = {
+            "question":question,
+            "contexts":self.separator.join(rendered_contexts),
+            "hints":self.hints_header+self.separator.join(hints) if hints else "",
+        }
+        return [ChatMessage(role=message["role"],content=PLACEHOLDER_PATTERN.sub(lambda match:values[match.group(1)],message["content"])) for message in self.messages]
+
+
+DEFAULT_RAG_TEMPLATES:Dict[str,RagPromptTemplate] = {
+    "alpaca":RagPromptTemplate(
+        messages=[
+            {"role":"system","content":"### Instruction:\nTry to answer the following question concise and well formulated in a few sentences using only the given informations. Explain your answer."},
+            {"role":"system","content":"Question:\"{question}\"\n{hints}\n\n### Input:\n{contexts}\n\n### Response:"},
+        ],
+        hints_header="Here are some hints for the answer:\n",
+    ),
+    "chatgpt":RagPromptTemplate(
+        messages=[
+            {"role":"system","content":"You will be given a question and multiple contexts. Try to answer the question concise and well formulated in a few sentences using only the provided information. The contexts most likely contain the answer but its not assured."},
+            {"role":"user","content":"Question:{question}\nContexts:{contexts}"},
+        ],
+        context='Context {index}:"{content}"{hint}',
+        hint='\nHint for context {index}: "{answer}"\n',
+        separator="",
+    ),
+}
+
+def load_rag_templates(path:Optional[str]=None)->Dict[str,RagPromptTemplate]:
+    """
+    The default templates, extended or overridden by the templates in the json file at `path` ({name: {"messages": [...], ...}}).
+    """
+    templates = dict(DEFAULT_RAG_TEMPLATES)
+    if path:
+        with open(path,"r",encoding="utf-8") as f:
+            for name,template in json.load(f).items():
+                templates[name] = RagPromptTemplate(**template)
+    return templates
@@ -0,0 +1,126 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import collections
+from dataclasses import dataclass,asdict
+from typing import Any,Dict,List,Optional,Iterator
+
+logger = logging.getLogger(__name__)
+
+CHUNK_PATTERN = re.compile(r"\s*\S+\s*|\s+")
+
+@dataclass
+class CachedResponse:
+    content:str
+    stop_reason:Optional[str] = None
+
+
+def response_cache_key(model:Dict[str,Any],messages:List[Dict[str,str]],config:Dict[str,Any],stop_words:List[str])->str:
+    """
+    Hash of everything which determines the output of a greedy generation. Message contents are stripped like in the prompt.
+    """
+    payload = {
+        "model":model,
+        "messages":[{"role":message["role"],"content":message["content"].strip()} for message in messages],
+        "config":config,
+        "stop_words":sorted(stop_words),
+    }
+    return hashlib.sha256(json.dumps(payload,sort_keys=True,default=str).encode("utf-8")).hexdigest()
+
+
+def replay_chunks(content:str)->Iterator[str]:
+    """
+    Splits a cached response into word sized chunks to replay it as a stream.
+    """
+    for match in CHUNK_PATTERN.finditer(content):
+        yield match.group()
+
+
+class ChatResponseCache():
+    """
+    LRU cache of chat responses. Entries evicted from memory are spilled to `spill_dir` as json files,
+    which is bounded to `max_disk_entries` files, and are moved back into memory on their next hit.
+    The spilled keys are tracked in memory, the directory is only listed once to pick up the files of a previous run.
+    """
+    def __init__(self,max_entries:int=256,spill_dir:Optional[str]=None,max_disk_entries:int=4096) -> None:
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.max_disk_entries = max_disk_entries
+        self.lock = threading.Lock()
+        self.entries:"collections.OrderedDict[str,CachedResponse]" = collections.OrderedDict()
+        self.spilled:"collections.OrderedDict[str,str]" = collections.OrderedDict()
+        if self.spill_dir:
+            os.makedirs(self.spill_dir,exist_ok=True)
+            files = [os.path.join(self.spill_dir,name) for name in os.listdir(self.spill_dir) if name.endswith(".json")]
+            for path in sorted(files,key=os.path.getmtime):
+                self.spilled[os.path.basename(path)[:-len(".json")]] = path
+            self._evict_spilled()
+
+    @property
+    def enabled(self)->bool:
+        return self.max_entries > 0
+
+    def _path(self,key:str)->str:
+        return os.path.join(self.spill_dir,f"{key}.json")
+
+    def _evict_spilled(self):
+        while len(self.spilled) > self.max_disk_entries:
+            _,path = self.spilled.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Could not remove a spilled chat response: {e}")
+
+    def _spill(self,key:str,response:CachedResponse):
+        if not self.spill_dir:
+            return
+        path = self._path(key)
+        try:
+            with open(path,"w",encoding="utf-8") as f:
+                json.dump(asdict(response),f)
+        except OSError as e:
+            logger.warning(f"Could not spill a cached chat response to disk: {e}")
+            return
+        self.spilled[key] = path
+        self.spilled.move_to_end(key)
+        self._evict_spilled()
+
+    def _load(self,key:str)->Optional[CachedResponse]:
+        path = self.spilled.pop(key,None)
+        if path is None:
+            return None
+        try:
+            with open(path,"r",encoding="utf-8") as f:
+                response = CachedResponse(**json.load(f))
+            os.remove(path)
+            return response
+        except (OSError,ValueError,TypeError):
+            return None
+
+    def _insert(self,key:str,response:CachedResponse):
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted_key,evicted = self.entries.popitem(last=False)
+            self._spill(evicted_key,evicted)
+
+    def get(self,key:str)->Optional[CachedResponse]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            response = self._load(key)
+            if response is not None:
+                self._insert(key,response)
+            return response
+
+    def put(self,key:str,response:CachedResponse):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._insert(key,response)
@@ -1,22 +1,50 @@
-from typing import Dict, Any
-from .utils import RequestLimiter
+from typing import Dict, Any, Optional, List, Callable, AsyncIterator, Tuple
+import json
+import asyncio
+from contextlib import aclosing
 from ._router import BaseRouter
 from ..chat_models import ModelAdapter
-from schemas.chat import ChatRequest, ChatResponse, DefaultConfigResponse,ModelInfo
+from ..prompt_packing import PackedMessages
+from ..executors import ModelExecutors
+from ..loading import ModelLoader
+from ..metrics import MetricsRegistry
+from ..scheduling import ChatScheduler,ChatTicket,QueueFullError,QueueTimeoutError
+from ..response_cache import ChatResponseCache,CachedResponse,response_cache_key,replay_chunks
+from ..rag import RagPromptTemplate
+from ..context_compression import ContextCompressor
+from ..digests import get_digest
+from ..telemetry import GenerationTelemetry,GenerationRecord
+from ..pipelines import ExtractiveQAPipeline
+from ..custom_nodes.token_cache_nodes import strip_token_cache
+from schemas.chat import ChatRequest, ChatResponse, DefaultConfigResponse,ModelInfo,ChatStreamFinal,ChatMessage,RagChatRequest,RagSource,GenerationTelemetryResponse
 from transformers import GenerationConfig
+from fastapi import HTTPException, Request
 from fastapi.responses import StreamingResponse
 
+EVENT_MEDIA_TYPES = ("application/x-ndjson","text/event-stream")
+
 class ChatRouter(BaseRouter):
-    def __init__(self,chat_model:ModelAdapter,limiter:RequestLimiter):
+    def __init__(self,chat_model:ModelAdapter,scheduler:ChatScheduler,metrics:MetricsRegistry,response_cache:ChatResponseCache,executors:ModelExecutors,loader:ModelLoader,extractive_qa_pipeline:Callable[[],ExtractiveQAPipeline],rag_templates:Dict[str,RagPromptTemplate],context_compressor:ContextCompressor,telemetry:GenerationTelemetry,context_tokens:int=512,heartbeat_interval:float=15):
         super().__init__("/chat")
+        self.heartbeat_interval = heartbeat_interval
         self.chat_model = chat_model
-        self.limiter = limiter
-        self.chat_model.load()
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.response_cache = response_cache
+        self.executors = executors
+        self.loader = loader
+        self.extractive_qa_pipeline = extractive_qa_pipeline
+        self.rag_templates = rag_templates
+        self.context_compressor = context_compressor
+        self.context_tokens = context_tokens
+        self.telemetry = telemetry
         self.router.add_api_route("/info", self.info, methods=["GET"],response_model=ModelInfo)
         self.router.add_api_route("/default_config", self.default_config, methods=["GET"],response_model= DefaultConfigResponse)
         self.router.add_api_route("/availability", self.check_availability, methods=["GET"])
+        self.router.add_api_route("/telemetry", self.get_telemetry, methods=["GET"],response_model=GenerationTelemetryResponse)
         self.router.add_api_route("/prompt", self.prompt, methods=["POST"], response_model=ChatResponse)
         self.router.add_api_route("/prompt_streaming", self.prompt_streaming, methods=["POST"], response_model=StreamingResponse)
+        self.router.add_api_route("/rag_streaming", self.rag_streaming, methods=["POST"], response_model=StreamingResponse)
         
     def _get_config(self,config:dict)->GenerationConfig:
         generation_config=None
@@ -27,35 +55,383 @@ class ChatRouter(BaseRouter):
            
         return generation_config
     
-    async def prompt(self,request: ChatRequest)->ChatResponse:
+    def _client_id(self,http_request:Request)->str:
+        client_id = http_request.headers.get("X-Client-Id")
+        if client_id:
+            return client_id
+        return http_request.client.host if http_request.client else "unknown"
+    
+    def _cache_key(self,messages:List[ChatMessage],config:GenerationConfig,stop_words:List[str])->Optional[str]:
+        """
+        Key of the response in the response cache, None if the response can't be cached because the generation samples.
+        """
+        if not self.response_cache.enabled or not self.chat_model.is_deterministic(config):
+            return None
+        return response_cache_key(self.chat_model.info().dict(),[m.dict() for m in messages],config.to_diff_dict(),stop_words)
+    
+    def _cached_response(self,key:Optional[str])->Optional[CachedResponse]:
+        if key is None:
+            return None
+        cached = self.response_cache.get(key)
+        self.metrics.increment("chat_response_cache_hits" if cached is not None else "chat_response_cache_misses")
+        return cached
+    
+    def _pack_messages(self,messages:List[ChatMessage],config:GenerationConfig)->PackedMessages:
+        packed = self.chat_model.pack_messages(messages,config)
+        if packed.trimmed:
+            self.metrics.increment("chat_trimmed_prompts")
+            self.logger.info(f"Chat: Prompt exceeded the token budget, dropped {packed.dropped} and truncated {packed.truncated} messages ({packed.tokens} tokens left)")
+        return packed
+    
+    def _submit(self,request:ChatRequest|RagChatRequest,http_request:Request)->ChatTicket:
+        #Cached responses can be served while the model is still loading, generations can't
+        self.loader.require("chat")
+        try:
+            return self.scheduler.submit(self._client_id(http_request),priority=request.priority)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    
+    def _check_capacity(self):
+        """
+        Rejects a streaming request before its response starts if the queue is full. The ticket itself is only submitted once the response
+        is iterated, a response which never starts (e.g. the client disconnected before) must not hold a place in the queue.
+        """
+        self.loader.require("chat")
+        if not self.scheduler.has_capacity():
+            self.metrics.increment("chat_rejected_requests")
+            raise HTTPException(status_code=503, detail="The chat queue is full.")
+    
+    async def prompt(self,request: ChatRequest,http_request: Request)->ChatResponse:
         """
         Prompts the chat model with the given messages and returns the response
         """
         config=self._get_config(request.config)
         stop_words = request.stop_words if request.stop_words else []
-        with self.limiter.run():
-            message = self.chat_model.generate(request.messages,config,stop_words)
-            
-            return {"content":message}
+        cache_key = self._cache_key(request.messages,config,stop_words)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            return {"content":cached.content}
+        
+        ticket = self._submit(request,http_request)
+        try:
+            async for _ in self.scheduler.wait(ticket):
+                pass
+            packed = await self.executors.run("chat",self._pack_messages,request.messages,config)
+            if self.chat_model.supports_async:
+                message,stop_reason = await self.chat_model.agenerate(packed.messages,config,stop_words)
+            else:
+                message,stop_reason = await self.executors.run("chat",self.chat_model.generate,packed.messages,config,stop_words)
+            self.telemetry.record(GenerationRecord(queue_wait_seconds=ticket.wait_time,prompt_tokens=packed.tokens or None,stop_reason=stop_reason))
+            if cache_key is not None:
+                self.response_cache.put(cache_key,CachedResponse(content=message,stop_reason=stop_reason))
+            return {"content":message,"dropped_messages":packed.dropped,"truncated_messages":packed.truncated}
+        except QueueTimeoutError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        finally:
+            self.scheduler.release(ticket)
      
         
-    async def prompt_streaming(self,request: ChatRequest)->StreamingResponse:
+    def _event_format(self,http_request:Request)->Tuple[Optional[str],Callable[...,str]]:
         """
-        Streaming version of the prompt endpoint
+        The negotiated event media type (None for raw text) and a function which serializes an event in it.
+        """
+        accept = http_request.headers.get("accept","")
+        stream_format = next((media_type for media_type in EVENT_MEDIA_TYPES if media_type in accept),None)
+        def event(type:str,**kwargs)->str:
+            data = json.dumps({"type":type,**kwargs})
+            if stream_format == "text/event-stream":
+                return f"event: {type}\ndata: {data}\n\n"
+            return data+"\n"
+        return stream_format,event
+    
+    async def _replay_cached(self,cached:CachedResponse,stream_format:Optional[str],event:Callable[...,str])->AsyncIterator[str]:
+        for chunk in replay_chunks(cached.content):
+            yield event("delta",text=chunk) if stream_format else chunk
+        if stream_format:
+            yield event("final",**ChatStreamFinal(stop_reason=cached.stop_reason,cached=True).dict())
+    
+    async def _generation_events(self,messages:List[ChatMessage],config:GenerationConfig,stop_words:List[str],stream_format:Optional[str],event:Callable[...,str],cache_key:Optional[str],ticket:ChatTicket)->AsyncIterator[str]:
+        """
+        Packs the messages into the context, streams the generation, records its telemetry and caches the response. Must be called once the ticket started.
+        """
+        stream = None
+        try:
+            packed = await self.executors.run("chat",self._pack_messages,messages,config)
+            if stream_format and packed.trimmed:
+                yield event("context",tokens=packed.tokens,dropped_messages=packed.dropped,truncated_messages=packed.truncated)
+            stream = self.chat_model.stream(packed.messages,config,stop_words)
+            chunks = []
+            async for chunk in stream.heartbeat(self.heartbeat_interval):
+                if chunk is None:
+                    if stream_format:
+                        yield event("heartbeat")
+                    continue
+                chunks.append(chunk)
+                yield event("delta",text=chunk) if stream_format else chunk
+            stream.log_stats(self.logger,"Chat")
+            record = GenerationRecord.from_stream(stream,queue_wait_seconds=ticket.wait_time)
+            self.telemetry.record(record)
+            if stream_format:
+                yield event("final",**self._final_event(record).dict())
+            if cache_key is not None and not stream.cancelled:
+                self.response_cache.put(cache_key,CachedResponse(content="".join(chunks),stop_reason=stream.stop_reason))
+        finally:
+            #Starlette cancels the response task if the client disconnects
+            if stream is not None and not stream.ended:
+                stream.cancel()
+                self.metrics.increment("chat_cancelled_generations")
+                self.logger.info("Chat: Client disconnected, stopped the generation")
+    
+    async def prompt_streaming(self,request: ChatRequest,http_request: Request)->StreamingResponse:
+        """
+        Streaming version of the prompt endpoint.
+        Clients accepting `application/x-ndjson` or `text/event-stream` receive json events: `queue` positions until the generation starts,
+        `context` if the history was trimmed, `delta` text chunks, `heartbeat`s while the model is silent,
+        a `final` event with the stop reason, token counts and timings, or an `error`. Other clients receive the raw text.
         """
         config=self._get_config(request.config)
         stop_words = request.stop_words if request.stop_words else []
-        with self.limiter.run():
-            generator = self.chat_model.generate_streaming(request.messages,config,stop_words)
-            return StreamingResponse(content=generator,media_type="text")
+        stream_format,event = self._event_format(http_request)
+        media_type = stream_format or "text"
+        
+        cache_key = self._cache_key(request.messages,config,stop_words)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            return StreamingResponse(content=self._replay_cached(cached,stream_format,event),media_type=media_type)
+        
+        self._check_capacity()
         
+        async def stream_chunks():
+            try:
+                ticket = self.scheduler.submit(self._client_id(http_request),priority=request.priority)
+            except QueueFullError as e:
+                if stream_format:
+                    yield event("error",detail=str(e))
+                return
+            try:
+                async for position in self.scheduler.wait(ticket):
+                    if stream_format:
+                        yield event("queue",position=position)
+                async with aclosing(self._generation_events(request.messages,config,stop_words,stream_format,event,cache_key,ticket)) as events:
+                    async for chunk in events:
+                        yield chunk
+            except QueueTimeoutError as e:
+                if stream_format:
+                    yield event("error",detail=str(e))
+            finally:
+                self.scheduler.release(ticket)
+            
+        return StreamingResponse(content=stream_chunks(),media_type=media_type)
+    
+    def _retrieve(self,request:RagChatRequest)->Tuple[List[RagSource],List[str],List[Optional[str]]]:
+        """
+        Runs the extractive qa pipeline, returns the sources of the best answers and the content and digest of their documents.
+        """
+        result = self.extractive_qa_pipeline().run(query=request.question,params={
+            "BM25":{"top_k":request.top_k_retriever},
+            "Embedding":{"top_k":request.top_k_retriever},
+            "Reader":{"top_k":request.top_k_reader},
+        })
+        documents = {document.id:document for document in strip_token_cache(result.get("documents",[]))}
+        sources,contexts,digests = [],[],[]
+        for answer in strip_token_cache(result.get("answers",[])):
+            if len(sources) >= request.documents:
+                break
+            document = documents.get(answer.document_ids[0]) if answer.document_ids else None
+            if document is None or not answer.answer:
+                continue
+            sources.append(RagSource(
+                document_id=document.id,
+                answer=answer.answer,
+                score=answer.score,
+                context=answer.context,
+                offsets_in_context=[answer.offsets_in_context[0].start,answer.offsets_in_context[0].end] if answer.offsets_in_context else None,
+                offsets_in_document=[answer.offsets_in_document[0].start,answer.offsets_in_document[0].end] if answer.offsets_in_document else None,
+                meta=document.meta or {},
+                content=document.content,
+            ))
+            contexts.append(document.content)
+            digests.append(get_digest(document.meta))
+        return sources,contexts,digests
+    
+    def _estimate_prompt_seconds(self,tokens:int)->Optional[float]:
+        """
+        Time the model needs to evaluate `tokens` prompt tokens, estimated from the prompt evaluation of recent generations.
+        """
+        summary = self.telemetry.summary("prompt_seconds_per_token")
+        return summary["p50"]*tokens if summary else None
+    
+    def _context_budget(self,request:RagChatRequest)->int:
+        return request.context_tokens if request.context_tokens is not None else self.context_tokens
+    
+    def _apply_digests(self,request:RagChatRequest,contexts:List[str],digests:List[Optional[str]],answer_offsets:List[Optional[List[int]]])->Optional[Dict[str,Any]]:
+        """
+        Replaces contexts in place by the digests of their documents, starting with the lowest ranked one, until they fit the context token budget.
+        The answer offsets of replaced contexts are cleared. Returns the stats if any context was replaced.
+        The contexts are only changed once all of them were counted, if counting fails they stay complete.
+        """
+        budget = self._context_budget(request)
+        if budget <= 0 or not any(digests):
+            return None
+        counts = [self.chat_model.count_tokens(context) for context in contexts]
+        original_tokens = tokens = sum(counts)
+        replaced = []
+        for i in reversed(range(len(contexts))):
+            if tokens <= budget:
+                break
+            if not digests[i]:
+                continue
+            digest_tokens = self.chat_model.count_tokens(digests[i])
+            if digest_tokens >= counts[i]:
+                continue
+            replaced.append(i)
+            tokens -= counts[i]-digest_tokens
+        if len(replaced) == 0:
+            return None
+        for i in replaced:
+            contexts[i] = digests[i]
+            answer_offsets[i] = None
+        self.metrics.increment("rag_digested_contexts",len(replaced))
+        return {"documents":len(replaced),"original_tokens":original_tokens,"tokens":tokens}
+    
+    def _compress(self,request:RagChatRequest,contexts:List[str],answer_offsets:List[Optional[List[int]]])->Optional[Dict[str,Any]]:
+        """
+        Shrinks the contexts in place to the context token budget, returns the compression stats if anything was removed.
+        """
+        budget = self._context_budget(request)
+        if budget <= 0:
+            return None
+        compressed = self.context_compressor.compress(request.question,contexts,answer_offsets,budget)
+        if compressed.tokens >= compressed.original_tokens:
+            return None
+        contexts[:] = compressed.contexts
+        savings = self._estimate_prompt_seconds(compressed.original_tokens-compressed.tokens)
+        self.metrics.observe("rag_compression_ratio",compressed.ratio)
+        if savings is not None:
+            self.metrics.observe("rag_ttft_savings_seconds",savings)
+        return {"original_tokens":compressed.original_tokens,"tokens":compressed.tokens,"ratio":compressed.ratio,"estimated_ttft_savings":savings}
+    
+    def _prefill(self,messages:List[ChatMessage]):
+        #Only an optimization, the generation works without it
+        try:
+            self.chat_model.prefill(messages)
+        except Exception as e:
+            self.logger.warning(f"Chat: Could not prefill the prompt template: {e}")
+    
+    async def rag_streaming(self,request: RagChatRequest,http_request: Request)->StreamingResponse:
+        """
+        Answers a question from the documents: retrieves and reads them, builds the prompt from a template and streams the generation.
+        Streams the same events as `prompt_streaming`, preceded by a `sources` event with the documents used as context,
+        a `digests` event if contexts were replaced by the digests of their documents to fit the context token budget
+        and a `compression` event if they were reduced to their most relevant sentences to fit it.
+        If a chat slot is idle, the static part of the prompt is evaluated while the retrieval runs. The place in the chat queue is only taken
+        once the prompt is built.
+        """
+        self.loader.require("embedding","reader")
+        template_name = request.template or self.chat_model.rag_template
+        if template_name not in self.rag_templates:
+            raise HTTPException(status_code=422, detail=f"Unknown prompt template '{template_name}'!")
+        template = self.rag_templates[template_name]
+        config=self._get_config(request.config)
+        stop_words = request.stop_words if request.stop_words else []
+        stream_format,event = self._event_format(http_request)
+        self._check_capacity()
+        
+        async def stream_chunks():
+            retrieval = asyncio.ensure_future(self.executors.run("reader",self._retrieve,request))
+            #The prefill runs without a ticket, only a chat slot which is idle anyway is used for it
+            prefill = asyncio.ensure_future(self.executors.run("chat",self._prefill,template.static_messages())) if self.scheduler.has_idle_slot() else None
+            ticket = None
+            try:
+                try:
+                    sources,contexts,digests = await retrieval
+                except Exception as e:
+                    self.logger.exception(e)
+                    if stream_format:
+                        yield event("error",detail="The document search failed.")
+                    return
+                if stream_format:
+                    yield event("sources",sources=[source.dict() for source in sources])
+                if len(sources) == 0:
+                    if stream_format:
+                        yield event("error",detail="No documents found which answer the question.")
+                    return
+                
+                answer_offsets = [source.offsets_in_document for source in sources]
+                try:
+                    digested = await self.executors.run("embedding",self._apply_digests,request,contexts,digests,answer_offsets)
+                except Exception as e:
+                    self.logger.warning(f"Chat: Could not replace contexts by their digests, using them in full: {e}")
+                    digested = None
+                if stream_format and digested is not None:
+                    yield event("digests",**digested)
+                try:
+                    compression = await self.executors.run("embedding",self._compress,request,contexts,answer_offsets)
+                except Exception as e:
+                    self.logger.warning(f"Chat: Could not compress the contexts, using them in full: {e}")
+                    compression = None
+                if stream_format and compression is not None:
+                    yield event("compression",**compression)
+                
+                messages = template.build(request.question,contexts,[source.answer for source in sources],request.include_answer_spans)
+                cache_key = self._cache_key(messages,config,stop_words)
+                cached = self._cached_response(cache_key)
+                if cached is not None:
+                    async for chunk in self._replay_cached(cached,stream_format,event):
+                        yield chunk
+                    return
+                
+                #The slot is only requested once the prompt is ready, it doesn't idle while the documents are searched
+                try:
+                    ticket = self.scheduler.submit(self._client_id(http_request),priority=request.priority)
+                except QueueFullError as e:
+                    if stream_format:
+                        yield event("error",detail=str(e))
+                    return
+                async for position in self.scheduler.wait(ticket):
+                    if stream_format:
+                        yield event("queue",position=position)
+                if prefill is not None:
+                    await prefill
+                async with aclosing(self._generation_events(messages,config,stop_words,stream_format,event,cache_key,ticket)) as events:
+                    async for chunk in events:
+                        yield chunk
+            except QueueTimeoutError as e:
+                if stream_format:
+                    yield event("error",detail=str(e))
+            finally:
+                retrieval.cancel()
+                if prefill is not None:
+                    prefill.cancel()
+                if ticket is not None:
+                    self.scheduler.release(ticket)
+            
+        return StreamingResponse(content=stream_chunks(),media_type=stream_format or "text")
+    
+    def _final_event(self,record:GenerationRecord)->ChatStreamFinal:
+        return ChatStreamFinal(
+            stop_reason=record.stop_reason,
+            prompt_tokens=record.prompt_tokens,
+            completion_tokens=record.completion_tokens,
+            queue_wait_seconds=record.queue_wait_seconds,
+            prompt_eval_seconds=record.prompt_eval_seconds,
+            time_to_first_token=record.time_to_first_token,
+            tokens_per_second=record.tokens_per_second,
+        )
+        
+    
+    async def get_telemetry(self)->GenerationTelemetryResponse:
+        """
+        Rolling percentiles of the queue wait, prompt tokens, prompt evaluation time, time to first token and tokens per second of recent generations,
+        the stop reasons and the speed related settings of the chat model, e.g. to compare thread counts or `CPU_MODEL_KV_16`.
+        """
+        return GenerationTelemetryResponse(model=self.chat_model.info(),settings=self.chat_model.settings(),**self.telemetry.snapshot())
     
     async def check_availability(self)->bool:
         """
-        Check if the chat model is available
+        Check if the chat model can accept another request
         """
-        with self.limiter.run():
-            return True   
+        return self.loader.is_ready("chat") and self.scheduler.has_capacity()
         
     async def info(self)->str:
         """
@@ -1,21 +1,44 @@
-from typing import List
-from haystack.schema import Document
+from typing import List, Callable
+from dataclasses import asdict
+from fastapi import HTTPException, Request, Query
+from fastapi.responses import StreamingResponse
 from haystack.document_stores import BaseDocumentStore
-from schemas.query import FilterRequest
+from haystack.nodes import EmbeddingRetriever
+from schemas.query import FilterRequest,GetDocumentsRequest,DocumentPage,WriteDocumentsResponse
 from ._router  import BaseRouter
+from ..custom_nodes.token_cache_nodes import TOKEN_CACHE_META_KEY,TokenCacheNode
+from ..document_paging import DocumentPager,InvalidCursor,CursorExpired,project_document,stream_documents,validate_fields
+from ..ingestion import DocumentIngestor,InvalidStream,ingest_ndjson,embed_documents
+from ..digests import DigestBuilder
+from ..executors import ModelExecutors
+from ..loading import ModelLoader
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
 
 class DocumentRouter(BaseRouter):
-    def __init__(self,document_store:BaseDocumentStore):
+    def __init__(self,document_store:BaseDocumentStore,ingestor:DocumentIngestor,embedding_retriever:Callable[[],EmbeddingRetriever],token_cache_node:Callable[[],TokenCacheNode],digest_builder:Callable[[],DigestBuilder],executors:ModelExecutors,loader:ModelLoader):
         super().__init__("/documents")
         self.document_store = document_store
-        self.router.add_api_route("/get", self.get_documents, methods=["POST"], response_model=List[Document], response_model_exclude_none=True)
+        self.pager = DocumentPager(document_store,excluded_meta=[TOKEN_CACHE_META_KEY])
+        self.ingestor = ingestor
+        self.embedding_retriever = embedding_retriever
+        self.token_cache_node = token_cache_node
+        self.digest_builder = digest_builder
+        self.executors = executors
+        self.loader = loader
+        self.router.add_api_route("/get", self.get_documents, methods=["POST"], response_model=DocumentPage, response_model_exclude_none=True)
+        self.router.add_api_route("/write", self.write_documents, methods=["POST"], response_model=WriteDocumentsResponse)
         self.router.add_api_route("/delete", self.delete_documents, methods=["POST"], response_model=bool)
 
-    def get_documents(self,filters: FilterRequest):
+    def get_documents(self,request: GetDocumentsRequest,http_request: Request):
         """
         This endpoint allows you to retrieve documents contained in your document store.
-        You can filter the documents to retrieve by metadata (like the document's name),
-        or provide an empty JSON object to clear the document store.
+        You can filter the documents to retrieve by metadata (like the document's name).
+        The documents are returned in pages of `limit` documents, pass the `next_cursor` of a page to get the next one
+        (it is empty after the last page). `fields` selects the returned fields, embeddings are only returned with `return_embedding`.
+
+        Clients accepting `application/x-ndjson` instead receive all matching documents as a stream with one document per line,
+        read from the store in batches of `limit`.
 
         Example of filters:
         `'{"filters": {{"name": ["some", "more"], "category": ["only_one"]}}'`
@@ -23,11 +46,71 @@ class DocumentRouter(BaseRouter):
         To get all documents you should provide an empty dict, like:
         `'{"filters": {}}'`
         """
-        docs = self.document_store.get_all_documents(filters=filters.filters)
-        for doc in docs:
-            doc.embedding = None
-        return docs
+        try:
+            validate_fields(request.fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        if NDJSON_MEDIA_TYPE in http_request.headers.get("accept",""):
+            if request.cursor:
+                raise HTTPException(status_code=400, detail="Cursors can't be used with ndjson streams!")
+            lines = stream_documents(
+                self.document_store,
+                filters=request.filters,
+                fields=request.fields,
+                return_embedding=request.return_embedding,
+                batch_size=request.limit,
+                excluded_meta=[TOKEN_CACHE_META_KEY])
+            return StreamingResponse(content=lines,media_type=NDJSON_MEDIA_TYPE)
+
+        try:
+            documents,next_cursor = self.pager.page(
+                filters=request.filters,
+                limit=request.limit,
+                cursor=request.cursor,
+                fields=request.fields,
+                return_embedding=request.return_embedding)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except CursorExpired as e:
+            raise HTTPException(status_code=410, detail=str(e))
+        return DocumentPage(documents=[project_document(doc,request.fields) for doc in documents],next_cursor=next_cursor)
+
+
+    async def write_documents(self,http_request: Request,
+                              split: bool = Query(True, description="Split the documents into chunks of INGEST_SPLIT_LENGTH words"),
+                              embed: bool = Query(True, description="Embed the chunks with the embedding model"),
+                              cache_tokens: bool = Query(False, description="Store the token ids of the chunks for the embedding model"),
+                              digest: bool = Query(False, description="Store an extractive digest of every chunk"),
+                              batch_size: int = Query(100, ge=1, le=10000, description="Number of documents processed and written at once")):
+        """
+        This endpoint writes documents to your document store. The body is a ndjson stream with one document per line:
+        `{"content": "...", "meta": {"name": "..."}, "id": "..."}`, only the content is required.
+
+        The documents are processed in batches of `batch_size`, the next batch is only read from the request once the previous one is
+        written. Documents whose `id` was already written completely are skipped, so an interrupted upload can be resumed by sending it again.
+        Invalid lines are skipped and reported.
+        """
+        if embed or cache_tokens or digest:
+            self.loader.require("embedding")
+
+        enrichers = []
+        if embed:
+            enrichers.append(embed_documents(self.embedding_retriever()))
+        if cache_tokens:
+            enrichers.append(self.token_cache_node().cache_tokens)
+        if digest:
+            enrichers.append(self.digest_builder().digest_documents)
+
+        async def write_batch(batch):
+            return await self.executors.run("embedding",self.ingestor.write_batch,batch,split=split,enrichers=enrichers)
 
+        try:
+            result = await ingest_ndjson(http_request.stream(),write_batch,batch_size=batch_size)
+        except InvalidStream as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        self.logger.info(f"Ingested {result.documents} documents as {result.chunks} chunks in {result.seconds:.2f}s, skipped {result.skipped}, {result.failed} invalid lines")
+        return WriteDocumentsResponse(**asdict(result))
 
     def delete_documents(self,filters: FilterRequest):
         """
@@ -1,20 +1,28 @@
-from typing import List, Optional,Dict
+from typing import List, Optional,Dict,Any
+from dataclasses import asdict
 
 import os
 import pynvml
 import psutil
 
-from schemas.health import CPUUsage,MemoryUsage,GPUUsage,GPUInfo,HealthResponse
+from schemas.health import CPUUsage,MemoryUsage,GPUUsage,GPUInfo,HealthResponse,ReadinessResponse,ComponentReadiness
+from fastapi import Response
 
 
 from ._router import BaseRouter
+from ..metrics import MetricsRegistry
+from ..loading import ModelLoader
 
 class HealthRouter(BaseRouter):
-    def __init__(self):
+    def __init__(self,metrics:MetricsRegistry,loader:ModelLoader):
         super().__init__(prefix="/health")
+        self.metrics = metrics
+        self.loader = loader
         self.router.add_api_route("/check", self.check, methods=["GET"])
+        self.router.add_api_route("/ready", self.ready, methods=["GET"], response_model=ReadinessResponse)
         self.router.add_api_route("/version", self.versions, methods=["GET"])
         self.router.add_api_route("/usage", self.usage, methods=["GET"],response_model=HealthResponse, status_code=200)
+        self.router.add_api_route("/metrics", self.get_metrics, methods=["GET"])
     
     def check(self)-> bool:
         """
@@ -26,6 +34,23 @@ class HealthRouter(BaseRouter):
         """
         return True
 
+    def ready(self,response:Response)->ReadinessResponse:
+        """
+        Loading state of each model (loading, warming, ready or failed). Responds with 503 until all models are ready,
+        unlike `/check`, which only reports that the server is up.
+        """
+        components = {name:ComponentReadiness(**asdict(status)) for name,status in self.loader.status().items()}
+        ready = all(component.state == "ready" for component in components.values())
+        if not ready:
+            response.status_code = 503
+        return ReadinessResponse(ready=ready,components=components)
+
+    def get_metrics(self)->Dict[str,Any]:
+        """
+        Counters, gauges and rolling percentiles collected since the start of the api, e.g. chat queue wait times.
+        """
+        return self.metrics.snapshot()
+
     def versions(self)->Dict[str,str]:
         """
         Get the versions of the installed packages.
@@ -1,5 +1,7 @@
 
+from typing import Callable
 from ..pipelines import CustomPipeline
+from ..loading import ModelLoader
 from ._router import BaseRouter
 from schemas.pipelines import PipelineDescription,PipelinesResponse,ComponentDescription,PrimitiveType
 import haystack
@@ -7,10 +9,11 @@ from networkx.drawing.nx_agraph import to_agraph
 import os
 
 class PipelineRouter(BaseRouter):
-    def __init__(self,search_pipeline:CustomPipeline,extractive_qa_pipeline:CustomPipeline):
+    def __init__(self,search_pipeline:Callable[[],CustomPipeline],extractive_qa_pipeline:Callable[[],CustomPipeline],loader:ModelLoader):
         super().__init__("/pipeline")
         self.search_pipeline = search_pipeline
         self.extractive_qa_pipeline = extractive_qa_pipeline
+        self.loader = loader
         self.router.add_api_route("/pipelines", self.get_pipelines, methods=["GET"], response_model=PipelinesResponse)
         
 
@@ -19,6 +22,7 @@ class PipelineRouter(BaseRouter):
         """
         Lists the pipelines of this node and generates a DOT-Graph for each pipeline
         """
+        self.loader.require("embedding","reader")
         pipelines = PipelinesResponse(pipelines=[])
         hf_token = os.getenv("HUGGINGFACE_TOKEN",None)
         open_ai_token = os.getenv("OPENAI_TOKEN",None)
@@ -48,7 +52,7 @@ class PipelineRouter(BaseRouter):
             
             return PipelineDescription(name=name,components=components,graph=dot)
         
-        pipelines.pipelines.append(process_pipeline("search_pipeline",self.search_pipeline.pipeline))
-        pipelines.pipelines.append(process_pipeline("extractive_qa_pipeline",self.extractive_qa_pipeline.pipeline))
+        pipelines.pipelines.append(process_pipeline("search_pipeline",self.search_pipeline().pipeline))
+        pipelines.pipelines.append(process_pipeline("extractive_qa_pipeline",self.extractive_qa_pipeline().pipeline))
         return pipelines
 
@@ -1,4 +1,4 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable
 
 from collections.abc import Mapping
 import time
@@ -6,57 +6,118 @@ import json
 from haystack.document_stores import ElasticsearchDocumentStore
 from ..pipelines import SearchPipeline, ExtractiveQAPipeline
 from .utils import RequestLimiter
+from ..executors import ModelExecutors
+from ..loading import ModelLoader
 from ._router import BaseRouter
-from schemas.query import QueryRequest, QAResponse, SearchResponse, ReindexRequest
+from schemas.query import QueryRequest, QAResponse, SearchResponse, ReindexRequest, CacheTokensRequest, DigestRequest, DigestJobResponse
 from haystack.nodes import EmbeddingRetriever
+from fastapi import HTTPException
+from ..custom_nodes.token_cache_nodes import TokenCacheNode,cache_document_tokens,strip_token_cache
+from ..digests import DigestJob
 
 class QueryRouter(BaseRouter):
-    def __init__(self,document_store:ElasticsearchDocumentStore,search_pipeline:SearchPipeline,extractive_qa_pipeline:ExtractiveQAPipeline,limiter:RequestLimiter,embedding_retriever:EmbeddingRetriever):
+    def __init__(self,document_store:ElasticsearchDocumentStore,search_pipeline:Callable[[],SearchPipeline],extractive_qa_pipeline:Callable[[],ExtractiveQAPipeline],limiter:RequestLimiter,embedding_retriever:Callable[[],EmbeddingRetriever],token_cache_node:Callable[[],TokenCacheNode],executors:ModelExecutors,loader:ModelLoader,digest_job:DigestJob):
+        """
+        The model backed components are providers, they are built by the `loader` in the background and only called once it reports them ready.
+        """
         super().__init__("/query")
         self.document_store = document_store
         self.search_pipeline = search_pipeline
         self.extractive_qa_pipeline = extractive_qa_pipeline
         self.limiter = limiter
         self.embedding_retriever = embedding_retriever
+        self.token_cache_node = token_cache_node
+        self.executors = executors
+        self.loader = loader
+        self.digest_job = digest_job
         
         self.router.add_api_route("/qa", self.qa, methods=["POST"], response_model=QAResponse, response_model_exclude_none=True)
         self.router.add_api_route("/search", self.search, methods=["POST"], response_model=SearchResponse, response_model_exclude_none=True)
         self.router.add_api_route("/reindex", self.reindex, methods=["POST"], response_model=bool)
+        self.router.add_api_route("/cache_tokens", self.cache_tokens, methods=["POST"], response_model=int)
+        self.router.add_api_route("/digests", self.start_digests, methods=["POST"], response_model=DigestJobResponse)
+        self.router.add_api_route("/digests", self.digest_status, methods=["GET"], response_model=DigestJobResponse)
+        self.router.add_api_route("/digests/stop", self.stop_digests, methods=["POST"], response_model=DigestJobResponse)
         
-    def qa(self,request: QueryRequest):
+    async def qa(self,request: QueryRequest):
         """
         This endpoint receives the question as a string and allows the requester to set
         additional parameters that will be passed on to the Haystack pipeline.
         """
+        self.loader.require("embedding","reader")
         with self.limiter.run():
-            result = self._process_request(self.extractive_qa_pipeline, request)
+            result = await self.executors.run("reader",self._process_request,self.extractive_qa_pipeline(),request)
             # Ensure answers and documents exist, even if they're empty lists
             if not "documents" in result:
                 result["documents"] = []
             if not "answers" in result:
                 result["answers"] = []
+            strip_token_cache(result["documents"])
+            strip_token_cache(result["answers"])
             return result
         
-    def search(self, request: QueryRequest):
+    async def search(self, request: QueryRequest):
+        self.loader.require("embedding")
         with self.limiter.run():
-            result = self._process_request(self.search_pipeline, request)
+            result = await self.executors.run("embedding",self._process_request,self.search_pipeline(),request)
             # Ensure answers and documents exist, even if they're empty lists
             if not "documents" in result:
                 result["documents"] = []
+            strip_token_cache(result["documents"])
             return result
 
 
-    def reindex(self, request:ReindexRequest)->bool:
+    async def reindex(self, request:ReindexRequest)->bool:
+        self.loader.require("embedding")
+        start_time = time.time()
         try:
-            self.document_store.update_embeddings(
-                retriever= self.embedding_retriever,
+            await self.executors.run("embedding",self.document_store.update_embeddings,
+                retriever= self.embedding_retriever(),
                 update_existing_embeddings = request.update_existing_embeddings,
                 batch_size = request.batch_size
             )
         except Exception as e:
             self.logger.exception(e)
             return  False
+        self.logger.info(f"Updated embeddings in {(time.time() - start_time):.2f}s")
         return True
+    
+    async def cache_tokens(self, request:CacheTokensRequest)->int:
+        """
+        Tokenizes all documents with the tokenizer of the embedding model and stores the token ids in their meta, which speeds up reindexing.
+        Returns the number of updated documents.
+        """
+        self.loader.require("embedding")
+        start_time = time.time()
+        filters = self._format_filters(request.filters) if request.filters else None
+        updated = await self.executors.run("embedding",cache_document_tokens,self.document_store,self.token_cache_node(),filters=filters,batch_size=request.batch_size)
+        self.logger.info(f"Cached tokens of {updated} documents in {(time.time() - start_time):.2f}s")
+        return updated
+    
+    def start_digests(self, request:DigestRequest)->DigestJobResponse:
+        """
+        Starts building the extractive digests of the documents in the background, which are used in rag prompts when the context budget is tight.
+        Documents which already have a digest are skipped, so a stopped run resumes when it is started again.
+        """
+        self.loader.require("embedding")
+        filters = self._format_filters(request.filters) if request.filters else None
+        if not self.digest_job.start(filters=filters,batch_size=request.batch_size,overwrite=request.overwrite):
+            raise HTTPException(status_code=409, detail="The digest job is already running.")
+        return vars(self.digest_job.status())
+    
+    def digest_status(self)->DigestJobResponse:
+        """
+        Returns the progress of the current or last digest run.
+        """
+        return vars(self.digest_job.status())
+    
+    def stop_digests(self)->DigestJobResponse:
+        """
+        Stops the digest job after the current batch.
+        """
+        self.digest_job.stop()
+        return vars(self.digest_job.status())
+
 
 
     def _process_request(self, pipeline, request) -> Dict[str, Any]:
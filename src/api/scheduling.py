@@ -0,0 +1,157 @@
+import time
+import asyncio
+import itertools
+from typing import Optional,List,Dict,AsyncIterator
+from .metrics import MetricsRegistry
+
+class QueueFullError(Exception):
+    pass
+
+class QueueTimeoutError(Exception):
+    pass
+
+class ChatTicket():
+    """
+    A place in the chat queue. `started` is set once a generation slot was assigned to the ticket.
+    """
+    def __init__(self,client_id:str,priority:int,sequence:int,turn:int) -> None:
+        self.client_id = client_id
+        self.priority = priority
+        self.sequence = sequence
+        self.turn = turn
+        self.enqueued_at = time.perf_counter()
+        self.started_at:Optional[float] = None
+        self.finished = False
+        self.changed = asyncio.Event()
+
+    @property
+    def started(self)->bool:
+        return self.started_at is not None
+
+    @property
+    def wait_time(self)->float:
+        end = self.started_at if self.started_at is not None else time.perf_counter()
+        return end - self.enqueued_at
+
+
+class ChatScheduler():
+    """
+    Queues chat requests until one of the generation slots is free.
+    Lower priority values are served first, within a priority clients take turns and each client is served in FIFO order.
+    Must only be used from the event loop.
+    """
+    def __init__(self,metrics:MetricsRegistry,slots:int=1,max_queue:int=32,max_wait:float=300) -> None:
+        self.metrics = metrics
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queue:List[ChatTicket] = []
+        self.active:List[ChatTicket] = []
+        self._sequence = itertools.count()
+        #Round robin between clients: every request gets the next turn of its client, but never one which already passed
+        self._current_turn = 0
+        self._client_turns:Dict[str,int] = {}
+
+    def _order(self)->List[ChatTicket]:
+        return sorted(self.queue,key=lambda t:(t.priority,t.turn,t.sequence))
+
+    def _update_gauges(self):
+        self.metrics.set_gauge("chat_queue_length",len(self.queue))
+        self.metrics.set_gauge("chat_active_generations",len(self.active))
+
+    def _notify_queue(self):
+        for ticket in self.queue:
+            ticket.changed.set()
+
+    def _dispatch(self):
+        while len(self.active) < self.slots and len(self.queue) > 0:
+            ticket = self._order()[0]
+            self.queue.remove(ticket)
+            ticket.started_at = time.perf_counter()
+            self._current_turn = max(self._current_turn,ticket.turn)
+            self.active.append(ticket)
+            self.metrics.observe("chat_queue_wait_seconds",ticket.wait_time)
+            ticket.changed.set()
+        #Clients whose last turn has passed would get the current turn anyway
+        self._client_turns = {client:turn for client,turn in self._client_turns.items() if turn > self._current_turn}
+        self._notify_queue()
+        self._update_gauges()
+
+    def has_capacity(self)->bool:
+        return len(self.active) < self.slots or len(self.queue) < self.max_queue
+
+    def has_idle_slot(self)->bool:
+        """
+        If a slot is free and nobody waits for it, i.e. a ticket submitted now would start right away.
+        """
+        return len(self.active) < self.slots and len(self.queue) == 0
+
+    def submit(self,client_id:str,priority:int=0)->ChatTicket:
+        """
+        Adds a request to the queue. Raises a `QueueFullError` if the queue is full.
+        """
+        if len(self.active) >= self.slots and len(self.queue) >= self.max_queue:
+            self.metrics.increment("chat_rejected_requests")
+            raise QueueFullError("The chat queue is full.")
+        turn = max(self._current_turn,self._client_turns.get(client_id,0)) + 1
+        self._client_turns[client_id] = turn
+        ticket = ChatTicket(client_id=client_id,priority=priority,sequence=next(self._sequence),turn=turn)
+        self.queue.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def position(self,ticket:ChatTicket)->int:
+        """
+        1-based position of the ticket in the queue, 0 if it already started.
+        """
+        if ticket.started:
+            return 0
+        return self._order().index(ticket)+1
+
+    async def wait(self,ticket:ChatTicket,interval:float=1.0)->AsyncIterator[int]:
+        """
+        Yields the position of the ticket whenever it changes (or at least every `interval` seconds) until it started.
+        Raises a `QueueTimeoutError` if the ticket waited longer than `max_wait`.
+        """
+        last_position = None
+        while not ticket.started:
+            position = self.position(ticket)
+            if position != last_position:
+                last_position = position
+                yield position
+
+            remaining = self.max_wait - ticket.wait_time
+            if remaining <= 0:
+                self.queue.remove(ticket)
+                self._dispatch()
+                self.metrics.increment("chat_queue_timeouts")
+                raise QueueTimeoutError(f"Waited more than {self.max_wait}s for a free chat slot.")
+            ticket.changed.clear()
+            try:
+                await asyncio.wait_for(ticket.changed.wait(),timeout=min(interval,remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    def cancel(self,ticket:ChatTicket):
+        """
+        Removes a waiting ticket from the queue, e.g. if the client disconnected.
+        """
+        if ticket in self.queue:
+            self.queue.remove(ticket)
+            self.metrics.increment("chat_abandoned_requests")
+            self._dispatch()
+
+    def release(self,ticket:ChatTicket):
+        """
+        Frees the slot of a started ticket or removes it from the queue.
+        """
+        if ticket.finished:
+            return
+        ticket.finished = True
+        if ticket in self.active:
+            self.active.remove(ticket)
+            self.metrics.increment("chat_completed_requests")
+            self.metrics.observe("chat_generation_seconds",time.perf_counter()-ticket.started_at)
+            self._dispatch()
+        else:
+            self.cancel(ticket)
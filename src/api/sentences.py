@@ -0,0 +1,19 @@
+import re
+from typing import List,Tuple
+
+SENTENCE_PATTERN = re.compile(r"[^.!?\n]+(?:[.!?]+|$)",re.MULTILINE)
+
+def split_sentences(text:str)->List[Tuple[int,int]]:
+    """
+    Character spans of the sentences in `text`, without surrounding whitespace.
+    Used by the reader narrowing, the rag context compression and the digests, so all of them cut a passage the same way.
+    """
+    spans = []
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = match.group()
+        stripped = sentence.strip()
+        if len(stripped) == 0:
+            continue
+        start = match.start()+(len(sentence)-len(sentence.lstrip()))
+        spans.append((start,start+len(stripped)))
+    return spans
@@ -0,0 +1,169 @@
+import time
+import logging
+import threading
+from typing import List,Optional,Dict,Callable,Tuple
+
+import torch
+from transformers import GenerationConfig
+
+from .batched_generation import BatchedSequence,PastKeyValues,eos_token_ids
+
+logger = logging.getLogger(__name__)
+
+def _crop(past_key_values:Optional[PastKeyValues],length:int)->Optional[PastKeyValues]:
+    if past_key_values is None or length == 0:
+        return None
+    return tuple(tuple(tensor[:,:,:length,:] for tensor in layer) for layer in past_key_values)
+
+
+class SpeculativeDecoder():
+    """
+    Speculative decoding: a small draft model proposes `num_draft_tokens` tokens, which the main model verifies in a single forward pass.
+    Greedy decoding produces exactly the output of the main model, when sampling the drafts are accepted with probability min(1,p/q)
+    and rejected ones are resampled from the residual distribution, so the output follows the distribution of the main model.
+    Both models must share the tokenizer and have (batch,heads,length,head_dim) kv-caches.
+    """
+    def __init__(self,model,draft_model,tokenizer,device:str="cuda",num_draft_tokens:int=4) -> None:
+        self.model = model
+        self.draft_model = draft_model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.num_draft_tokens = num_draft_tokens
+        self.eos_token_ids = eos_token_ids(model,tokenizer)
+        self.lock = threading.Lock()
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.main_passes = 0
+        self.generation_seconds = 0.0
+
+    def submit(self,prepare_inputs:Callable[[],Dict],generation_config:GenerationConfig,stop_words:List[str]=None)->BatchedSequence:
+        """
+        Starts the generation of a sequence on its own thread, `prepare_inputs` works like in the `BatchedGenerationEngine`.
+        """
+        sequence = BatchedSequence(prepare_inputs,generation_config,self.tokenizer,self.eos_token_ids,stop_words)
+        def run():
+            try:
+                self.generate(sequence)
+            except Exception as e:
+                logger.exception(e)
+                sequence.finish("Error!")
+        threading.Thread(target=run,daemon=True).start()
+        return sequence
+
+    def stats(self)->Dict[str,float]:
+        with self.lock:
+            return {
+                "proposed_tokens":self.proposed_tokens,
+                "accepted_tokens":self.accepted_tokens,
+                "acceptance_rate":self.accepted_tokens/self.proposed_tokens if self.proposed_tokens > 0 else 0.0,
+                "tokens_per_main_pass":self.generated_tokens/self.main_passes if self.main_passes > 0 else 0.0,
+                "tokens_per_second":self.generated_tokens/self.generation_seconds if self.generation_seconds > 0 else 0.0,
+            }
+
+    def _tensor(self,token_ids:List[int])->torch.Tensor:
+        return torch.tensor([token_ids],device=self.device)
+
+    def _pick(self,sequence:BatchedSequence,scores:torch.Tensor)->Tuple[int,Optional[torch.Tensor]]:
+        """
+        Returns the chosen token and, when sampling, the probabilities it was drawn from.
+        """
+        if not sequence.config.do_sample:
+            return int(scores.argmax(dim=-1)),None
+        probabilities = torch.softmax(scores,dim=-1)
+        return int(torch.multinomial(probabilities,num_samples=1)),probabilities
+
+    def _draft(self,sequence:BatchedSequence,tokens:List[int],past_key_values:Optional[PastKeyValues],cached:int,count:int):
+        drafts:List[int] = []
+        probabilities:List[Optional[torch.Tensor]] = []
+        draft_input = tokens[cached:]
+        for _ in range(count):
+            output = self.draft_model(input_ids=self._tensor(draft_input),past_key_values=past_key_values,use_cache=True)
+            past_key_values = output.past_key_values
+            cached += len(draft_input)
+            token,probability = self._pick(sequence,sequence.scores(output.logits[:,-1,:],tokens+drafts))
+            drafts.append(token)
+            probabilities.append(probability)
+            draft_input = [token]
+        return drafts,probabilities,past_key_values,cached
+
+    def _verify(self,sequence:BatchedSequence,tokens:List[int],drafts:List[int],draft_probabilities:List[Optional[torch.Tensor]],logits:torch.Tensor)->Tuple[List[int],int]:
+        """
+        Compares the drafts with the main model, `logits` has one row per draft plus one for the token after the last draft.
+        Returns the new tokens (the accepted drafts followed by a corrected or bonus token) and the number of accepted drafts.
+        """
+        new_tokens = []
+        for i,draft in enumerate(drafts):
+            scores = sequence.scores(logits[i:i+1],tokens+drafts[:i])
+            if not sequence.config.do_sample:
+                token = int(scores.argmax(dim=-1))
+                if token == draft:
+                    new_tokens.append(draft)
+                    continue
+                new_tokens.append(token)
+                return new_tokens,i
+
+            p = torch.softmax(scores,dim=-1)[0]
+            q = draft_probabilities[i][0]
+            if torch.rand(1).item() < min(1.0,(p[draft]/q[draft]).item()):
+                new_tokens.append(draft)
+                continue
+            residual = torch.clamp(p-q,min=0)
+            residual = residual/residual.sum() if residual.sum() > 0 else p
+            new_tokens.append(int(torch.multinomial(residual,num_samples=1)))
+            return new_tokens,i
+
+        token,_ = self._pick(sequence,sequence.scores(logits[len(drafts):len(drafts)+1],tokens+drafts))
+        new_tokens.append(token)
+        return new_tokens,len(drafts)
+
+    def generate(self,sequence:BatchedSequence):
+        """
+        Generates the sequence on the calling thread.
+        """
+        with torch.no_grad():
+            inputs = sequence.prepare_inputs()
+            tokens = inputs["input_ids"][0].tolist()
+            sequence.prompt_ids = list(tokens)
+            sequence.stream.prompt_tokens = len(tokens)
+            #The main model can continue from the prefix cache, the draft model starts from scratch
+            main_past = inputs.get("past_key_values")
+            main_cached = main_past[0][0].shape[2] if main_past is not None else 0
+            draft_past,draft_cached = None,0
+
+            proposed,accepted_drafts,passes = 0,0,0
+            try:
+                while True:
+                    started = time.perf_counter()
+                    remaining = sequence.max_new_tokens-len(sequence.generated_ids)
+                    count = max(0,min(self.num_draft_tokens,remaining-1))
+                    drafts,draft_probabilities,draft_past,draft_cached = self._draft(sequence,tokens,draft_past,draft_cached,count)
+
+                    main_input = tokens[main_cached:]+drafts
+                    output = self.model(input_ids=self._tensor(main_input),past_key_values=main_past,use_cache=True)
+                    new_tokens,accepted = self._verify(sequence,tokens,drafts,draft_probabilities,output.logits[0,-(len(drafts)+1):,:])
+
+                    #Only the kv-states of the known tokens and the accepted drafts stay valid
+                    valid = len(tokens)+accepted
+                    main_past,main_cached = _crop(output.past_key_values,valid),valid
+                    draft_cached = min(draft_cached,valid)
+                    draft_past = _crop(draft_past,draft_cached)
+
+                    proposed += len(drafts)
+                    accepted_drafts += accepted
+                    passes += 1
+                    with self.lock:
+                        self.main_passes += 1
+                        self.proposed_tokens += len(drafts)
+                        self.accepted_tokens += accepted
+                        self.generated_tokens += len(new_tokens)
+                        self.generation_seconds += time.perf_counter()-started
+
+                    for token in new_tokens:
+                        tokens.append(token)
+                        if not sequence.accept(token):
+                            return
+            finally:
+                if passes > 0:
+                    rate = accepted_drafts/proposed if proposed > 0 else 0.0
+                    logger.info(f"Speculative decoding: accepted {accepted_drafts} of {proposed} drafts ({rate:.0%}), {len(sequence.generated_ids)/passes:.2f} tokens per main pass")
@@ -0,0 +1,295 @@
+import time
+import asyncio
+import logging
+import threading
+import collections
+from typing import Optional,Dict,List,Tuple,Iterator,AsyncIterator
+
+_END = object()
+
+class TokenStream():
+    """
+    Thread-safe stream of generated text chunks. The generating thread `put`s chunks and calls `end` once it is done,
+    consumers either iterate it synchronously (blocking waits) or asynchronously from an event loop without occupying a thread.
+    The producer is blocked while the consumer is `max_buffer` chunks behind, `None` disables the limit.
+    """
+    def __init__(self,max_buffer:Optional[int]=64) -> None:
+        self.max_buffer = max_buffer
+        self._buffer = collections.deque()
+        self._condition = threading.Condition()
+        self._ended = False
+        self._cancelled = False
+        self._loop:Optional[asyncio.AbstractEventLoop] = None
+        self._async_event:Optional[asyncio.Event] = None
+
+        self.created_at = time.perf_counter()
+        self.first_token_at:Optional[float] = None
+        self.last_token_at:Optional[float] = None
+        self.ended_at:Optional[float] = None
+        self.tokens = 0
+        #Reported by the producer, `tokens` only counts the chunks
+        self.prompt_tokens:Optional[int] = None
+        self.completion_tokens:Optional[int] = None
+        self.prompt_eval_seconds:Optional[float] = None
+        self.stop_reason:Optional[str] = None
+
+    def _notify(self):
+        self._condition.notify_all()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._async_event.set)
+            except RuntimeError:
+                #The event loop of the consumer is already closed
+                self._loop = None
+
+    def put(self,text:str,timeout:Optional[float]=None)->bool:
+        """
+        Adds a chunk to the stream. Blocks while the buffer is full.
+        Returns False if the stream was cancelled or ended, in which case the producer should stop generating.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._cancelled or self._ended or self.max_buffer is None or len(self._buffer) < self.max_buffer,timeout=timeout):
+                return False
+            if self._cancelled or self._ended:
+                return False
+
+            now = time.perf_counter()
+            if self.first_token_at is None:
+                self.first_token_at = now
+            self.last_token_at = now
+            self.tokens += 1
+            self._buffer.append(text)
+            self._notify()
+            return True
+
+    def end(self,stop_reason:Optional[str]=None):
+        """
+        Marks the end of the stream. Calling it multiple times is safe, only the first stop reason is kept.
+        """
+        with self._condition:
+            if self.stop_reason is None:
+                self.stop_reason = stop_reason
+            if self._ended:
+                return
+            self._ended = True
+            self.ended_at = time.perf_counter()
+            self._buffer.append(_END)
+            self._notify()
+
+    def cancel(self):
+        """
+        Cancels the stream, the producer will be told to stop on its next `put`.
+        """
+        with self._condition:
+            self._cancelled = True
+        self.end("Cancelled!")
+
+    @property
+    def cancelled(self)->bool:
+        return self._cancelled
+
+    @property
+    def ended(self)->bool:
+        return self._ended
+
+    def _pop(self):
+        item = self._buffer.popleft()
+        self._condition.notify_all()
+        return item
+
+    def __iter__(self)->Iterator[str]:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._buffer) > 0)
+                item = self._pop()
+            if item is _END:
+                return
+            yield item
+
+    def __aiter__(self)->AsyncIterator[str]:
+        return self._aiter()
+
+    def heartbeat(self,interval:float)->AsyncIterator[Optional[str]]:
+        """
+        Async iteration which yields `None` whenever no chunk arrived for `interval` seconds.
+        """
+        return self._aiter(interval)
+
+    async def _aiter(self,heartbeat:Optional[float]=None)->AsyncIterator[Optional[str]]:
+        with self._condition:
+            self._loop = asyncio.get_running_loop()
+            self._async_event = asyncio.Event()
+        while True:
+            with self._condition:
+                item = self._pop() if len(self._buffer) > 0 else None
+                if item is None:
+                    #Cleared under the lock, so a producer can't slip a chunk in between
+                    self._async_event.clear()
+            if item is None:
+                if heartbeat is None:
+                    await self._async_event.wait()
+                    continue
+                try:
+                    await asyncio.wait_for(self._async_event.wait(),timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def stats(self)->Dict[str,Optional[float]]:
+        """
+        Time to first token and mean inter-token latency in seconds, and the generated tokens per second after the first one.
+        """
+        time_to_first_token = self.first_token_at - self.created_at if self.first_token_at else None
+        inter_token_latency = None
+        if self.tokens > 1:
+            inter_token_latency = (self.last_token_at - self.first_token_at)/(self.tokens-1)
+        completion_tokens = self.completion_tokens if self.completion_tokens is not None else self.tokens
+        tokens_per_second = None
+        if completion_tokens > 1 and self.first_token_at is not None:
+            end = self.ended_at if self.ended_at is not None else self.last_token_at
+            if end > self.first_token_at:
+                tokens_per_second = (completion_tokens-1)/(end-self.first_token_at)
+        return {
+            "tokens":self.tokens,
+            "time_to_first_token":time_to_first_token,
+            "inter_token_latency":inter_token_latency,
+            "tokens_per_second":tokens_per_second,
+        }
+
+    def log_stats(self,logger:logging.Logger,name:str):
+        stats = self.stats()
+        if stats["time_to_first_token"] is None:
+            logger.info(f"{name}: No tokens generated")
+            return
+        inter_token_latency = f"{stats['inter_token_latency']*1000:.1f}ms" if stats["inter_token_latency"] is not None else "-"
+        logger.info(f"{name}: {stats['tokens']} chunks, time to first token {stats['time_to_first_token']:.2f}s, inter-token latency {inter_token_latency}")
+
+
+class StopWordMatcher():
+    """
+    Incremental Aho-Corasick matcher for stop words in streamed text.
+    Only text which can't be the beginning of a stop word is released, the rest is held back until it is decided.
+    """
+    def __init__(self,stop_words:List[str]) -> None:
+        self.stop_words = [word for word in stop_words if word]
+        #Trie with goto transitions, failure links and the length of the longest stop word ending in each node
+        self._goto:List[Dict[str,int]] = [{}]
+        self._fail:List[int] = [0]
+        self._depth:List[int] = [0]
+        self._match:List[int] = [0]
+        for word in self.stop_words:
+            self._add(word)
+        self._build()
+        
+        self.state = 0
+        self.pending = ""
+        self.stopped = False
+        
+    def _add(self,word:str):
+        node = 0
+        for char in word:
+            if char not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[node]+1)
+                self._match.append(0)
+                self._goto[node][char] = len(self._goto)-1
+            node = self._goto[node][char]
+        self._match[node] = max(self._match[node],len(word))
+        
+    def _build(self):
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char,child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char,0)
+                self._match[child] = max(self._match[child],self._match[self._fail[child]])
+                queue.append(child)
+                
+    def _step(self,char:str)->int:
+        state = self.state
+        while state and char not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(char,0)
+    
+    def feed(self,text:str)->Tuple[str,bool]:
+        """
+        Processes the next chunk of text. Returns the text which is safe to emit and if a stop word was found.
+        After a stop word was found, all further text is swallowed.
+        """
+        if self.stopped:
+            return "",True
+        if len(self.stop_words) == 0:
+            return text,False
+        
+        self.pending += text
+        processed = len(self.pending) - len(text)
+        for char in text:
+            processed += 1
+            self.state = self._step(char)
+            if self._match[self.state]:
+                self.stopped = True
+                released = self.pending[:processed-self._match[self.state]]
+                self.pending = ""
+                return released,True
+            
+        hold = self._depth[self.state]
+        released = self.pending[:len(self.pending)-hold]
+        self.pending = self.pending[len(self.pending)-hold:]
+        return released,False
+    
+    def flush(self)->str:
+        """
+        Releases the held back text at the end of the stream.
+        """
+        released = "" if self.stopped else self.pending
+        self.pending = ""
+        return released
+
+
+class IncrementalDetokenizer():
+    """
+    Decodes a growing sequence of token ids while only decoding a small trailing window per token.
+    The window always starts a few tokens before the new ones, so tokenizers which drop or merge leading whitespace
+    (e.g. SentencePiece) decode the boundary correctly. Text ending in an incomplete multi-byte character is held back.
+    """
+    def __init__(self,tokenizer,**decode_kwargs) -> None:
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.token_ids:List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        
+    def _decode(self,token_ids:List[int])->str:
+        return self.tokenizer.decode(token_ids,**self.decode_kwargs)
+        
+    def put(self,token_ids:List[int])->str:
+        """
+        Adds tokens and returns the newly decoded text.
+        """
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(text) > len(prefix_text) and not text.endswith("\ufffd"):
+            new_text = text[len(prefix_text):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text
+        return ""
+    
+    def flush(self)->str:
+        """
+        Returns the remaining text, even if it ends in an incomplete character, and resets the detokenizer.
+        """
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        text = self._decode(self.token_ids[self.prefix_offset:])
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        return text[len(prefix_text):]
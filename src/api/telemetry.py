@@ -0,0 +1,80 @@
+import re
+import threading
+from dataclasses import dataclass,asdict
+from typing import Any,Dict,Optional
+from .metrics import MetricsRegistry
+from .streaming import TokenStream
+
+@dataclass
+class GenerationRecord:
+    """
+    Timings of a single chat generation, values which the adapter couldn't measure are None.
+    """
+    queue_wait_seconds:Optional[float] = None
+    prompt_tokens:Optional[int] = None
+    completion_tokens:Optional[int] = None
+    prompt_eval_seconds:Optional[float] = None
+    time_to_first_token:Optional[float] = None
+    tokens_per_second:Optional[float] = None
+    stop_reason:Optional[str] = None
+
+    @property
+    def prompt_seconds_per_token(self)->Optional[float]:
+        if not self.prompt_tokens or self.prompt_eval_seconds is None:
+            return None
+        return self.prompt_eval_seconds/self.prompt_tokens
+
+    @classmethod
+    def from_stream(cls,stream:TokenStream,queue_wait_seconds:Optional[float]=None)->"GenerationRecord":
+        stats = stream.stats()
+        return cls(
+            queue_wait_seconds=queue_wait_seconds,
+            prompt_tokens=stream.prompt_tokens,
+            completion_tokens=stream.completion_tokens if stream.completion_tokens is not None else stats["tokens"],
+            #Adapters which can't measure the prompt evaluation separately report it as part of the time to first token
+            prompt_eval_seconds=stream.prompt_eval_seconds if stream.prompt_eval_seconds is not None else stats["time_to_first_token"],
+            time_to_first_token=stats["time_to_first_token"],
+            tokens_per_second=stats["tokens_per_second"],
+            stop_reason=stream.stop_reason,
+        )
+
+
+class GenerationTelemetry():
+    """
+    Feeds the timings of every chat generation into the metrics registry as rolling percentiles (`chat_generation_*`)
+    and counts the stop reasons, so different adapter settings can be compared on the same workload.
+    """
+    def __init__(self,metrics:MetricsRegistry,prefix:str="chat_generation") -> None:
+        self.metrics = metrics
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.generations = 0
+        self.stop_reasons:Dict[str,int] = {}
+
+    def _name(self,field:str)->str:
+        return f"{self.prefix}_{field}"
+
+    def record(self,record:GenerationRecord):
+        values = asdict(record)
+        stop_reason = values.pop("stop_reason") or "Unknown"
+        values["prompt_seconds_per_token"] = record.prompt_seconds_per_token
+        for field,value in values.items():
+            if value is not None:
+                self.metrics.observe(self._name(field),value)
+        with self.lock:
+            self.generations += 1
+            self.stop_reasons[stop_reason] = self.stop_reasons.get(stop_reason,0)+1
+        self.metrics.increment(self._name("stop_"+re.sub(r"[^a-z0-9]+","_",stop_reason.lower()).strip("_")))
+
+    def summary(self,field:str)->Optional[Dict[str,float]]:
+        return self.metrics.summary(self._name(field))
+
+    def snapshot(self)->Dict[str,Any]:
+        fields = [*GenerationRecord.__dataclass_fields__,"prompt_seconds_per_token"]
+        percentiles = {field:self.summary(field) for field in fields if field != "stop_reason"}
+        with self.lock:
+            return {
+                "generations":self.generations,
+                "stop_reasons":dict(self.stop_reasons),
+                "percentiles":{field:summary for field,summary in percentiles.items() if summary is not None},
+            }
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import platform
+import threading
+from typing import Callable,Dict,List,Optional,Tuple
+import psutil
+
+logger = logging.getLogger(__name__)
+
+def cpu_model_name()->str:
+    try:
+        with open("/proc/cpuinfo","r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":",1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or "unknown"
+
+
+def host_fingerprint()->str:
+    """
+    Identifies the cpu the api runs on, a calibration is only reused on the same kind of host.
+    """
+    description = {
+        "machine":platform.machine(),
+        "cpu":cpu_model_name(),
+        "logical_cores":psutil.cpu_count(logical=True),
+        "physical_cores":psutil.cpu_count(logical=False),
+        #Containers can be limited to a subset of the cores
+        "usable_cores":len(os.sched_getaffinity(0)) if hasattr(os,"sched_getaffinity") else None,
+    }
+    return hashlib.sha256(json.dumps(description,sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def thread_candidates(instances:int=1,configured:Optional[int]=None)->List[int]:
+    """
+    Total thread counts worth measuring: all physical cores, all logical cores (hyperthreads), fractions of the physical cores
+    and the configured value. Each candidate gives every instance at least one thread.
+    """
+    logical = psutil.cpu_count(logical=True) or 1
+    physical = psutil.cpu_count(logical=False) or logical
+    if hasattr(os,"sched_getaffinity"):
+        usable = len(os.sched_getaffinity(0))
+        logical,physical = min(logical,usable),min(physical,usable)
+    candidates = {physical,logical,physical//2,physical*3//4}
+    if configured:
+        candidates.add(configured)
+    return sorted(candidate for candidate in candidates if candidate >= instances)
+
+
+class ThreadCalibration():
+    """
+    Measures the generation speed of the cpu model with several thread counts and keeps the fastest in a json file,
+    keyed by the model and the host fingerprint, so following starts on the same host skip the measurement.
+    """
+    def __init__(self,path:str,fingerprint:Optional[str]=None) -> None:
+        self.path = path
+        self.fingerprint = fingerprint or host_fingerprint()
+        self.lock = threading.Lock()
+
+    def _key(self,model_key:str)->str:
+        return f"{model_key}@{self.fingerprint}"
+
+    def _read(self)->Dict[str,Dict]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path,"r",encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError,ValueError) as e:
+            logger.warning(f"Could not read the thread calibration {self.path}: {e}")
+            return {}
+
+    def lookup(self,model_key:str)->Optional[int]:
+        with self.lock:
+            entry = self._read().get(self._key(model_key))
+        return entry["threads"] if entry else None
+
+    def store(self,model_key:str,threads:int,tokens_per_second:Dict[int,float]):
+        with self.lock:
+            calibrations = self._read()
+            calibrations[self._key(model_key)] = {
+                "threads":threads,
+                "tokens_per_second":{str(candidate):speed for candidate,speed in tokens_per_second.items()},
+                "calibrated_at":time.time(),
+            }
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory,exist_ok=True)
+            #Written to a temporary file first, a crash must not leave a truncated calibration behind
+            temporary = f"{self.path}.tmp"
+            with open(temporary,"w",encoding="utf-8") as f:
+                json.dump(calibrations,f,indent=2)
+            os.replace(temporary,self.path)
+
+    def calibrate(self,model_key:str,measure:Callable[[int],float],candidates:List[int])->Tuple[int,Dict[int,float]]:
+        """
+        Returns the stored thread count of the model, or measures the tokens per second of each candidate with `measure`
+        and stores the fastest. Candidates which fail to run are skipped.
+        """
+        stored = self.lookup(model_key)
+        if stored is not None:
+            return stored,{}
+        tokens_per_second = {}
+        for threads in candidates:
+            try:
+                tokens_per_second[threads] = measure(threads)
+                logger.info(f"Thread calibration: {threads} threads generate {tokens_per_second[threads]:.2f} tokens/s")
+            except Exception as e:
+                logger.warning(f"Thread calibration: {threads} threads failed: {e}")
+        if len(tokens_per_second) == 0:
+            raise RuntimeError("The thread calibration failed for every candidate!")
+        best = max(tokens_per_second,key=tokens_per_second.get)
+        self.store(model_key,best,tokens_per_second)
+        return best,tokens_per_second
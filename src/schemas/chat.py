@@ -10,10 +10,45 @@ class ChatRequest(BaseModel):
     messages: List[ChatMessage] = Field(..., description="The messages to be used for the chat")
     config:Optional[Dict[str,Any]] = Field(None,description="The generation config to use for the chat. Dictionary of a transfomers GenerationConfig")
     stop_words:Optional[List[str]] = Field(None,description="The stop words to use for the chat")
+    priority:int = Field(0,description="Priority in the chat queue, lower values are served first")
     
 class ChatResponse(BaseModel):
     content: str = Field(..., description="The generated response")
+    dropped_messages: int = Field(0, description="Older messages which were dropped to fit the prompt into the context")
+    truncated_messages: int = Field(0, description="Messages which were shortened to fit the prompt into the context")
     
+
+class ChatStreamFinal(BaseModel):
+    stop_reason: Optional[str] = Field(None, description="Why the generation stopped")
+    prompt_tokens: Optional[int] = Field(None, description="Tokens in the prompt")
+    completion_tokens: Optional[int] = Field(None, description="Generated tokens")
+    queue_wait_seconds: Optional[float] = Field(None, description="Seconds the request waited for a generation slot")
+    prompt_eval_seconds: Optional[float] = Field(None, description="Seconds the model spent evaluating the prompt")
+    time_to_first_token: Optional[float] = Field(None, description="Seconds until the first token was generated")
+    tokens_per_second: Optional[float] = Field(None, description="Generated tokens per second after the first token")
+    cached: bool = Field(False, description="If the response was replayed from the response cache")
+    
+class RagChatRequest(BaseModel):
+    question: str = Field(..., description="The question to answer from the documents")
+    config:Optional[Dict[str,Any]] = Field(None,description="The generation config to use for the chat. Dictionary of a transfomers GenerationConfig")
+    stop_words:Optional[List[str]] = Field(None,description="The stop words to use for the chat")
+    priority:int = Field(0,description="Priority in the chat queue, lower values are served first")
+    top_k_retriever:int = Field(5,description="Documents retrieved by each retriever")
+    top_k_reader:int = Field(5,description="Answers extracted by the reader")
+    documents:int = Field(3,description="Documents of the best answers which are used as context")
+    template:Optional[str] = Field(None,description="Name of the prompt template, defaults to the template of the chat model")
+    include_answer_spans:bool = Field(False,description="Add the answers of the reader as hints to the prompt")
+    context_tokens:Optional[int] = Field(None,description="Token budget of the contexts, longer contexts are reduced to their most relevant sentences. 0 disables the compression, defaults to RAG_CONTEXT_TOKENS")
+    
+class RagSource(BaseModel):
+    document_id: str = Field(..., description="Id of the document used as context")
+    answer: str = Field(..., description="The answer the reader extracted from the document")
+    score: Optional[float] = Field(None, description="Score of the answer")
+    context: Optional[str] = Field(None, description="The text around the answer")
+    offsets_in_context: Optional[List[int]] = Field(None, description="Start and end of the answer in the context")
+    offsets_in_document: Optional[List[int]] = Field(None, description="Start and end of the answer in the document")
+    meta: Dict[str,Any] = Field(default_factory=dict, description="Meta of the document, e.g. its title and source")
+    content: Optional[str] = Field(None, description="Full text of the document")
     
 class DefaultConfigResponse(BaseModel):
     config:Dict[str,Any] = Field(...,description="The default generation config of the chat model")
@@ -21,4 +56,11 @@ class DefaultConfigResponse(BaseModel):
 class ModelInfo(BaseModel):
     name: str = Field(..., description="The name of the adapter")
     model: str = Field(..., description="The description of the model")
-    accelerator: str = Field(..., description="The accelerator used for the model")
\ No newline at end of file
+    accelerator: str = Field(..., description="The accelerator used for the model")
+    
+class GenerationTelemetryResponse(BaseModel):
+    model: ModelInfo = Field(..., description="The chat model")
+    settings: Dict[str,Any] = Field(default_factory=dict, description="Settings of the chat model which affect its speed, e.g. threads and kv precision")
+    generations: int = Field(0, description="Generations recorded since startup")
+    stop_reasons: Dict[str,int] = Field(default_factory=dict, description="Number of generations per stop reason")
+    percentiles: Dict[str,Dict[str,float]] = Field(default_factory=dict, description="Rolling count, mean, p50, p90, p99, max and rate per minute of each timing, e.g. `prompt_eval_seconds` or `tokens_per_second`")
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field, validator
 
 class CPUUsage(BaseModel):
@@ -41,3 +41,15 @@ class HealthResponse(BaseModel):
     cpu: CPUUsage = Field(..., description="CPU usage details")
     memory: MemoryUsage = Field(..., description="Memory usage details")
     gpus: List[GPUInfo] = Field(default_factory=list, description="GPU usage details")
+
+
+class ComponentReadiness(BaseModel):
+    state: str = Field(..., description="loading, warming, ready or failed")
+    error: Optional[str] = Field(None, description="Why loading failed")
+    load_seconds: Optional[float] = Field(None, description="Time spent loading the model")
+    warmup_seconds: Optional[float] = Field(None, description="Time spent on the warmup inference")
+
+
+class ReadinessResponse(BaseModel):
+    ready: bool = Field(..., description="If all models are ready")
+    components: Dict[str, ComponentReadiness] = Field(default_factory=dict, description="Readiness of each model")
@@ -42,6 +42,33 @@ class QAResponse(BaseModel):
 class FilterRequest(RequestBaseModel):
     filters: Optional[Dict[str, Union[PrimitiveType, List[PrimitiveType], Dict[str, PrimitiveType]]]] = None
 
+class GetDocumentsRequest(RequestBaseModel):
+    filters: Optional[Dict[str, Union[PrimitiveType, List[PrimitiveType], Dict[str, PrimitiveType]]]] = Field(None, description="Only return documents matching these filters. Ignored if a cursor is given, the cursor continues its own query.")
+    limit:int = Field(100, ge=1, le=10000, description="Maximum number of documents per page. In ndjson mode the number of documents read from the store at once.")
+    cursor:Optional[str] = Field(None, description="The `next_cursor` of the previous page, empty for the first page.")
+    fields:Optional[List[str]] = Field(None, description="Only return these fields of the documents, e.g. `[\"content\", \"meta.name\"]`. The id is always returned.")
+    return_embedding:bool = Field(False, description="If True, the embeddings of the documents are returned.")
+
+class DocumentPage(BaseModel):
+    documents:List[Dict[str,Any]] = Field(..., description="The (projected) documents of this page")
+    next_cursor:Optional[str] = Field(None, description="Cursor of the next page, empty after the last page")
+
+class IngestBatchResponse(BaseModel):
+    documents:int = Field(..., description="Documents written in this batch")
+    chunks:int = Field(..., description="Chunks the documents were split into")
+    skipped:int = Field(..., description="Documents which were already written under their id")
+    seconds:float = Field(..., description="Duration of the batch in seconds")
+    documents_per_second:float = Field(..., description="Throughput of the batch")
+
+class WriteDocumentsResponse(BaseModel):
+    documents:int = Field(..., description="Documents written")
+    chunks:int = Field(..., description="Chunks written")
+    skipped:int = Field(..., description="Documents which were already written under their id")
+    failed:int = Field(..., description="Invalid lines which were skipped")
+    seconds:float = Field(..., description="Duration of the ingestion in seconds")
+    errors:List[str] = Field([], description="The errors of the first invalid lines")
+    batches:List[IngestBatchResponse] = []
+
 class CreateLabelSerialized(RequestBaseModel):
     id: Optional[str] = None
     query: str
@@ -63,3 +90,20 @@ class ReindexRequest(RequestBaseModel):
     batch_size:int = Field(10000, description="Number of documents to index at once.")
 
 
+
+class CacheTokensRequest(RequestBaseModel):
+    filters: Optional[Dict[str, Union[PrimitiveType, List[PrimitiveType], Dict[str, PrimitiveType]]]] = Field(None, description="Only cache the tokens of documents matching these filters.")
+    batch_size:int = Field(1000, description="Number of documents to tokenize and write at once.")
+    
+class DigestRequest(RequestBaseModel):
+    filters: Optional[Dict[str, Union[PrimitiveType, List[PrimitiveType], Dict[str, PrimitiveType]]]] = Field(None, description="Only digest documents matching these filters.")
+    batch_size:int = Field(500, description="Number of documents to digest and write at once.")
+    overwrite:bool = Field(False, description="If True, existing digests of the current version are rebuilt. If False, documents which have one are skipped.")
+
+class DigestJobResponse(BaseModel):
+    state:str = Field(..., description="idle, running, stopped, finished or failed")
+    processed:int = Field(..., description="Documents read from the store in this run")
+    updated:int = Field(..., description="Documents whose digest was written in this run")
+    skipped:int = Field(..., description="Documents which already had a digest or are not text")
+    seconds:float = Field(..., description="Duration of the run in seconds")
+    error:Optional[str] = Field(None, description="Error of a failed run")
@@ -1,5 +1,6 @@
-from typing import Optional,Any,Type,Generator,List,Dict
+from typing import Optional,Any,Type,Generator,List,Dict,Callable
 import os
+import json
 
 
 from httpx import Client, Timeout, Response
@@ -11,7 +12,7 @@ import pydantic
 from schemas.health import HealthResponse
 from schemas.pipelines import PipelinesResponse
 from schemas.query import QAResponse,SearchResponse,QueryRequest,ReindexRequest
-from schemas.chat import ChatResponse,ChatRequest,ChatMessage,ModelInfo,DefaultConfigResponse
+from schemas.chat import ChatResponse,ChatRequest,ChatMessage,ModelInfo,DefaultConfigResponse,ChatStreamFinal,RagChatRequest,RagSource,GenerationTelemetryResponse
     
 class ApiConnector():
     def __init__(self) -> None:
@@ -128,17 +129,42 @@ class ApiConnector():
             logging.exception(e)
         return None
         
-    def chat_streaming(self,messages:List[ChatMessage],config:Dict[str,Any]=None,stop_words:List[str]=[])->Generator[str,None,None]:
-        url="/chat/prompt_streaming"
-        request = ChatRequest(messages=messages,config=config,stop_words=stop_words)
+    def __stream_chat(self,url:str,payload:Dict[str,Any],client_id:Optional[str]=None,on_final:Optional[Callable[[ChatStreamFinal],None]]=None,on_sources:Optional[Callable[[List[RagSource]],None]]=None)->Generator[str,None,None]:
+        headers = {"Accept":"application/x-ndjson"}
+        if client_id:
+            headers["X-Client-Id"] = client_id
         try:
-            with self.client.stream("POST",url,json=request.dict(),timeout=None) as response:
-                for line in response.iter_text():
-                    yield line
+            with self.client.stream("POST",url,json=payload,headers=headers,timeout=None) as response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "delta":
+                        yield event["text"]
+                    elif event["type"] == "sources" and on_sources:
+                        on_sources([RagSource(**source) for source in event["sources"]])
+                    elif event["type"] == "final" and on_final:
+                        on_final(ChatStreamFinal(**{key:value for key,value in event.items() if key != "type"}))
+                    elif event["type"] == "error":
+                        logging.error(f"Chat stream failed: {event['detail']}")
                     
         except Exception as e:
             logging.exception(e)
     
+    def chat_streaming(self,messages:List[ChatMessage],config:Dict[str,Any]=None,stop_words:List[str]=[],client_id:Optional[str]=None,on_final:Optional[Callable[[ChatStreamFinal],None]]=None)->Generator[str,None,None]:
+        """
+        Yields the generated text chunks. `on_final` receives the stop reason, token counts and timings once the generation finished.
+        """
+        request = ChatRequest(messages=messages,config=config,stop_words=stop_words)
+        yield from self.__stream_chat("/chat/prompt_streaming",request.dict(),client_id=client_id,on_final=on_final)
+    
+    def rag_streaming(self,question:str,config:Dict[str,Any]=None,documents:int=3,include_answer_spans:bool=False,client_id:Optional[str]=None,on_sources:Optional[Callable[[List[RagSource]],None]]=None,on_final:Optional[Callable[[ChatStreamFinal],None]]=None)->Generator[str,None,None]:
+        """
+        Answers the question from the documents on the server. `on_sources` receives the documents used as context before the answer is generated.
+        """
+        request = RagChatRequest(question=question,config=config,documents=documents,include_answer_spans=include_answer_spans)
+        yield from self.__stream_chat("/chat/rag_streaming",request.dict(),client_id=client_id,on_final=on_final,on_sources=on_sources)
+    
     st.cache_data        
     def chat_info(self)->Optional[ModelInfo]:
         url="/chat/info"
@@ -159,6 +185,15 @@ class ApiConnector():
             logging.exception(e)
         return None
     
+    def chat_telemetry(self)->Optional[GenerationTelemetryResponse]:
+        url="/chat/telemetry"
+        try:
+            result = self.__get(url)
+            return self.__parse_response(result,GenerationTelemetryResponse)
+        except Exception as e:
+            logging.exception(e)
+        return None
+    
     def chat_is_ready(self)->bool:
         url="/chat/availability"
         try:
@@ -9,10 +9,10 @@ if root not in sys.path:
 from typing import List,Optional,Dict,Any,Iterator,Generator
 import streamlit as st 
 from streamlit_chat import message as show_message
-from ui.utils import show_answer,sidebar_footer,get_api_connector,set_state_if_absent,set_default_generation_config,get_generation_config
+from ui.utils import show_answer,source_to_answer,source_to_documents,sidebar_footer,get_api_connector,set_state_if_absent,set_default_generation_config,get_generation_config
 import time
-from schemas.chat import ChatMessage,DefaultConfigResponse
-from haystack.schema import Answer,Document
+import uuid
+from schemas.chat import ChatMessage,DefaultConfigResponse,ChatStreamFinal,RagSource
 
 
 SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT","The following is a friendly conversation between a human and an AI. The AI is talkative and provides lots of specific details from its context. If the AI does not know the answer to a question, it truthfully says it does not know. \n\n Current Conversation:")
@@ -29,39 +29,6 @@ def batch_generator(generator:Generator[str,None,None],size:int=7)->Generator[st
         yield "".join(buffer)
         buffer=[]
                 
-def build_alpaca_prompt(question:str,contexts:List[str],answers:List[str],include_answer_spans:bool=False):
-    instruction = f"Try to answer the following question concise and well formulated in a few sentenes using only the given informations. Explain your answer.\nQuestion:\"{question}\"\n"
-    
-    if include_answer_spans:
-        instruction += f"Here are some hints for the answer:"
-        for i,answer in enumerate(answers):
-            instruction+= f"Hint for context {i+1}: \"{answer}\""
-            
-    input = ""
-    for i,context in enumerate(contexts):
-        input+= f"Context {i+1}: \"{context}\""   
-    prompt = f"""### Instruction:
-{instruction}
-
-### Input:
-{input}
-
-### Response:"""
-    return [ChatMessage(role="system",content=prompt)]
-
-
-def build_chatgpt_prompt(question:str,contexts:List[str],answers:List[str],include_answer_spans:bool=False):
-    system_prompt = "You will be given a question and multiple contexts. Try to answer the question concise and well formulated in a few sentences using only the provided information. The contexts most likely contain the answer but its not assured."
-    def with_answer_template_chatgpt(question:str,contexts:List[str],answers:List[str])->str:
-        joined_contexts = ""
-        for i,context in enumerate(contexts):
-            joined_contexts += f"Context {i+1}:\"{context}\""
-            if include_answer_spans:
-                joined_contexts += "\nHint for context {i+1}: \"{answers[i]}\"\n"
-        joined_contexts = joined_contexts.strip()
-        return f"Question:{question}\nContexts:{joined_contexts}" 
-    return [ChatMessage(role="system",content=system_prompt),ChatMessage(role="user",content=with_answer_template_chatgpt(question,contexts,answers))]
-
 class UIChatMessage:
     def __init__(self,chatmessage:ChatMessage,display_message:str=None, should_send:bool=True) -> None:
         self.chatmessage = chatmessage
@@ -80,9 +47,10 @@ class UIChatMessage:
     
 def render():
     set_state_if_absent("chat_prompt","")
-    set_state_if_absent("chat_qa_results",None)
+    set_state_if_absent("chat_sources",None)
     set_state_if_absent("chat_document_count",3)
     set_state_if_absent("chat_use_document_search",True)
+    set_state_if_absent("chat_client_id",str(uuid.uuid4()))
     
     set_state_if_absent("chat_messages",[UIChatMessage(ChatMessage(content=SYSTEM_PROMPT,role="system")),UIChatMessage(ChatMessage(content=WELCOME_MESSAGE,role="assistant"),should_send=False)])
     
@@ -172,16 +140,6 @@ def render():
       
     
     
-    def build_augmented_prompt(prompt:str,possible_answers:List[Answer],documents:List[Document])->List[ChatMessage]:
-    
-        filtered_contexts = []
-        for answer in possible_answers:
-            filtered_contexts.append(next(doc for doc in documents if doc.id == answer.document_ids[0]).content)
-            
-        if chat_info.name == "OpenAI":
-            return build_chatgpt_prompt(prompt,filtered_contexts,[answer.answer for answer in possible_answers],include_answer_spans)
-        return build_alpaca_prompt(prompt,filtered_contexts,[answer.answer for answer in possible_answers],include_answer_spans)
-    
     placeholder=st.empty().container()
     
     def render_chat_history():
@@ -196,14 +154,54 @@ def render():
     placeholder_generated_massage=st.empty()    
     
     
-    def prompt_model(chat_messages,stop_words=[])->str:
+    def show_generation(stream:Generator[str,None,None],finals:List[ChatStreamFinal])->str:
         render_chat_history()
         answer = ""
-        config = get_generation_config(temperature,top_p,max_new_tokens,repetition_penalty)
-        for i,piece in enumerate(batch_generator(connector.chat_streaming(chat_messages,config=config,stop_words=stop_words),size= 2 if chat_info.accelerator == "CPU" else 10)):
+        for i,piece in enumerate(batch_generator(stream,size= 2 if chat_info.accelerator == "CPU" else 10)):
             answer+=piece
             with placeholder_generated_massage:
                 show_message(answer,key=f"generated_answer_{i}",seed="Felix")
+        if len(finals) > 0:
+            final = finals[0]
+            details = [final.stop_reason or "Finished"]
+            if final.cached:
+                details.append("cached")
+            if final.completion_tokens is not None:
+                details.append(f"{final.completion_tokens} tokens")
+            if final.tokens_per_second:
+                details.append(f"{final.tokens_per_second:.1f} tokens/s")
+            if final.time_to_first_token is not None:
+                details.append(f"first token after {final.time_to_first_token:.1f}s")
+            st.caption(" · ".join(details))
+        return answer
+    
+    def prompt_model(chat_messages,stop_words=[])->str:
+        config = get_generation_config(temperature,top_p,max_new_tokens,repetition_penalty)
+        finals = []
+        stream = connector.chat_streaming(chat_messages,config=config,stop_words=stop_words,client_id=st.session_state.chat_client_id,on_final=finals.append)
+        answer = show_generation(stream,finals)
+        st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=answer,role="assistant")))
+        return answer
+    
+    def prompt_with_documents(question:str)->str:
+        #Retrieval, prompt building and generation run on the server, the sources arrive before the answer
+        config = get_generation_config(temperature,top_p,max_new_tokens,repetition_penalty)
+        finals = []
+        def on_sources(sources:List[RagSource]):
+            st.session_state.chat_sources = sources
+            if len(sources) == 0:
+                return
+            st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=f"I found {len(sources)} documents that might answer your question and linked them bellow. I will now try to formulate an answer based on them.",role="assistant"),should_send=False))
+            if sources[0].score is not None and sources[0].score < 0.1:
+                st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=f"Im very uncertain that the documents contain the answer. My answer will probably be incorrect, please verify it with the context documents bellow.😅",role="assistant"),should_send=False))
+            render_chat_history()
+        
+        stream = connector.rag_streaming(question,config=config,documents=document_count,include_answer_spans=include_answer_spans,client_id=st.session_state.chat_client_id,on_sources=on_sources,on_final=finals.append)
+        answer = show_generation(stream,finals)
+        if not st.session_state.chat_sources:
+            st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=f"Sorry i found no documents regarding your question, are you sure the document store is running?",role="assistant"),should_send=False))
+            render_chat_history()
+            return answer
         st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=answer,role="assistant")))
         return answer
             
@@ -225,26 +223,14 @@ def render():
     if submitted and prompt and len(prompt) > 0:
         
         if not connector.chat_is_ready():
-            st.info("The model is at capacity right now. Please wait a few seconds and try again.")
+            st.info("The chat queue is full right now. Please wait a few seconds and try again.")
             render_chat_history()
             return 
         
         if use_document_search:
             st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=prompt,role="user")))
-            st.session_state.chat_qa_results = connector.qa(prompt)
-            if st.session_state.chat_qa_results:
-                possible_answers =  st.session_state.chat_qa_results.answers[:document_count]
-                documents =  st.session_state.chat_qa_results.documents
-                augmented_prompts=build_augmented_prompt(prompt,possible_answers,documents)
-                
-                st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=f"I found {len(documents)} documents that might answer your question and linked them bellow. I will now try to formulate an answer based on the top {document_count} documents.",role="assistant"),should_send=False))
-                if possible_answers[0].score < 0.1:
-                    st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=f"Im very uncertain that the documents contain the answer. My answer will probably be incorrect, please verify it with the context documents bellow.😅",role="assistant"),should_send=False))
-                
-                prompt_model(augmented_prompts)
-            else:
-                st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=f"Sorry i found no documents regarding your question, are you sure the document store is running?",role="assistant"),should_send=False))
-                render_chat_history()
+            st.session_state.chat_sources = None
+            prompt_with_documents(prompt)
         else:      
             st.session_state.chat_messages.append(UIChatMessage(ChatMessage(content=prompt,role="user")))    
             prompt_model(get_messages_to_send(),stop_words=["Human:"])
@@ -253,12 +239,10 @@ def render():
     else:
         render_chat_history()
     
-    if st.session_state.chat_qa_results is not None:
+    if st.session_state.chat_sources:
         st.write("## Used Context Documents:")
-        possible_answers =  st.session_state.chat_qa_results.answers[:document_count]
-        documents =  st.session_state.chat_qa_results.documents 
-        for possible_answer in possible_answers:
-            show_answer(possible_answer,documents)   
+        for source in st.session_state.chat_sources:
+            show_answer(source_to_answer(source),source_to_documents(source))   
    
 
 render()    
@@ -56,6 +56,19 @@ def render():
             else:
                 st.write("⚠️The API-Node has no GPU acceleration!⚠️")
          
+    st.write("## 💬Chat Generation")
+    telemetry = connector.chat_telemetry()
+    if telemetry:
+        st.write(f"**{telemetry.model.name}** ({telemetry.model.model}) on {telemetry.model.accelerator}, {telemetry.generations} generations since startup")
+        if telemetry.settings:
+            st.code("\n".join(f"{key}={value}" for key,value in telemetry.settings.items()),language="python")
+        if telemetry.percentiles:
+            st.table([{"timing":name,**{key:round(value,3) for key,value in summary.items()}} for name,summary in telemetry.percentiles.items()])
+        if telemetry.stop_reasons:
+            with st.expander("Stop reasons",expanded=False):
+                for reason,count in telemetry.stop_reasons.items():
+                    st.write(f"**{reason}**: {count}")
+         
     st.write("## ✳️Embeddings")
     st.text("Recalculate all embeddings in the database.⚠️ If the node is not GPU accelerated this could take some time!")
     update_all_embeddings = st.checkbox(value=False,label="Recalculate all embeddings")
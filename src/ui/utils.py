@@ -2,8 +2,8 @@ from typing import List, Dict, Any, Tuple, Optional
 import streamlit as st
 from ui.api_connector import get_api_connector
 from annotated_text import annotation,annotated_text
-from haystack.schema import Answer,Document
-from schemas.chat import DefaultConfigResponse
+from haystack.schema import Answer,Document,Span
+from schemas.chat import DefaultConfigResponse,RagSource
 
 def sidebar_footer()->None:
     connector = get_api_connector()
@@ -54,7 +54,28 @@ def get_wikipedia_url_from_title(title:str)->str:
     return  f"{url}{title.replace(' ', '_')}"
 
 
-def show_answer(answer:Answer,documents:List[Document]):
+def source_to_answer(source:RagSource)->Answer:
+    return Answer(
+        answer=source.answer,
+        type="extractive",
+        score=source.score,
+        context=source.context,
+        offsets_in_context=[Span(*source.offsets_in_context)] if source.offsets_in_context else None,
+        offsets_in_document=[Span(*source.offsets_in_document)] if source.offsets_in_document else None,
+        document_ids=[source.document_id],
+        meta=source.meta,
+    )
+
+def source_to_documents(source:RagSource)->Optional[List[Document]]:
+    """
+    The document of a rag source for the full context of `show_answer`, None if the source came without its content.
+    """
+    if source.content is None:
+        return None
+    return [Document(id=source.document_id,content=source.content,meta=source.meta)]
+
+
+def show_answer(answer:Answer,documents:Optional[List[Document]]=None):
     # highlight_color =  "#024d10#"#"#023020"
     # background_color = "#0f1212"
     score =  round(answer.score*100,2)
@@ -94,16 +115,20 @@ def show_answer(answer:Answer,documents:List[Document]):
         wikipedia_url = get_wikipedia_url_from_title(title)
         source_display=f"[{source_display}]({wikipedia_url})"
         
-    with st.expander("Show full context"):
-        document = next(doc for doc in documents if doc.id == answer.document_ids[0])
-        offsets_in_document = answer.offsets_in_document[0]
-        
-        if title:
-            st.markdown(f"### Title: {title}")
-        
-        annotated_text(document.content[:offsets_in_document.start],
-        (answer.answer, f"ANSWER ({score}%)"),
-            document.content[offsets_in_document.end:])
+    if documents is not None:
+        with st.expander("Show full context"):
+            document = next(doc for doc in documents if doc.id == answer.document_ids[0])
+            
+            if title:
+                st.markdown(f"### Title: {title}")
+            
+            if answer.offsets_in_document:
+                offsets_in_document = answer.offsets_in_document[0]
+                annotated_text(document.content[:offsets_in_document.start],
+                (answer.answer, f"ANSWER ({score}%)"),
+                    document.content[offsets_in_document.end:])
+            else:
+                st.write(document.content)
         
     st.markdown(f"#### Source: {source_display}") 
     st.markdown('----')
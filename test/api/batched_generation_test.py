@@ -0,0 +1,83 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import time
+import pytest
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+from api.batched_generation import BatchedGenerationEngine
+
+MODEL = "distilgpt2"
+PROMPTS = [
+    "The meaning of life is",
+    "Once upon a time, in a land far away, there lived a",
+    "Python is a programming language which",
+    "The weather today",
+]
+
+@pytest.fixture(scope="module")
+def model_and_tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    model = AutoModelForCausalLM.from_pretrained(MODEL).eval()
+    return model,tokenizer
+
+def _submit(engine,tokenizer,prompt,config):
+    return engine.submit(lambda: {"input_ids":tokenizer(prompt,return_tensors="pt")["input_ids"]},config)
+
+def test_batched_generation_matches_generate(model_and_tokenizer):
+    model,tokenizer = model_and_tokenizer
+    engine = BatchedGenerationEngine(model,tokenizer,device="cpu",max_batch_size=4)
+    
+    #Prompts of different lengths share the batch and leave it at different steps
+    sequences = [_submit(engine,tokenizer,prompt,GenerationConfig(max_new_tokens=10+5*i,do_sample=False)) for i,prompt in enumerate(PROMPTS)]
+    outputs = ["".join(sequence.stream) for sequence in sequences]
+    
+    for i,(prompt,output) in enumerate(zip(PROMPTS,outputs)):
+        input_ids = tokenizer(prompt,return_tensors="pt")["input_ids"]
+        with torch.no_grad():
+            expected = model.generate(input_ids=input_ids,max_new_tokens=10+5*i,do_sample=False,pad_token_id=tokenizer.eos_token_id)
+        assert output == tokenizer.decode(expected[0][input_ids.shape[1]:],skip_special_tokens=True)
+        assert sequences[i].stop_reason in ("Max Tokens!","End of sequence!")
+    
+def test_batched_generation_stops_on_stop_words_and_cancel(model_and_tokenizer):
+    model,tokenizer = model_and_tokenizer
+    engine = BatchedGenerationEngine(model,tokenizer,device="cpu",max_batch_size=2)
+    config = GenerationConfig(max_new_tokens=200,do_sample=False)
+    
+    stopped = engine.submit(lambda: {"input_ids":tokenizer("1, 2, 3, 4,",return_tensors="pt")["input_ids"]},config,stop_words=["8"])
+    cancelled = _submit(engine,tokenizer,PROMPTS[0],config)
+    cancelled.stream.cancel()
+    
+    assert "8" not in "".join(stopped.stream)
+    assert stopped.stop_reason == "Stopword detected!"
+    list(cancelled.stream)
+    assert len(cancelled.generated_ids) < 200
+
+def test_batched_generation_throughput(model_and_tokenizer):
+    """
+    Decodes 1, 4 and 8 sampled streams of 64 tokens, run with `-s` to see the tokens/s of each batch size.
+    """
+    model,tokenizer = model_and_tokenizer
+    throughput = {}
+    for streams in (1,4,8):
+        torch.manual_seed(0)
+        engine = BatchedGenerationEngine(model,tokenizer,device="cpu",max_batch_size=streams)
+        config = GenerationConfig(max_new_tokens=64,do_sample=True,top_k=50)
+        
+        started = time.perf_counter()
+        sequences = [_submit(engine,tokenizer,PROMPTS[i%len(PROMPTS)],config) for i in range(streams)]
+        tokens = sum(len(list(sequence.stream)) for sequence in sequences)
+        elapsed = time.perf_counter()-started
+        
+        stats = engine.stats()
+        throughput[streams] = stats['generated_tokens']/elapsed
+        print(f"{streams} streams: {throughput[streams]:.1f} tokens/s ({stats['tokens_per_second']:.1f} tokens/s in the model)")
+        assert tokens > 0
+    #One decoding step serves the whole batch
+    assert throughput[8] > throughput[1]
@@ -0,0 +1,163 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import json
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+import torch
+from api.model_utils import GeneratorStreamer,ManualStopCondition,CPUStreamer
+from api.model_pool import ModelPool
+from api.streaming import TokenStream
+from api.prompt_packing import PackedMessages
+from api.metrics import MetricsRegistry
+from api.executors import ModelExecutors
+from api.scheduling import ChatScheduler
+from api.response_cache import ChatResponseCache
+from api.telemetry import GenerationTelemetry
+from api.routers.chat import ChatRouter
+from schemas.chat import ChatMessage,ChatRequest
+from transformers import GenerationConfig
+
+class FakeTokenizer():
+    """
+    Every token id is a letter.
+    """
+    def decode(self,token_ids,**kwargs):
+        return "".join(chr(ord("a")+id) for id in token_ids)
+
+    def tokenize(self,text):
+        return list(text)
+
+class FakeLlama():
+    """
+    Generates the letters of `text` and calls `before_token` with the index of every token before it is emitted.
+    """
+    def __init__(self,text:str,before_token=None) -> None:
+        self.text = text
+        self.before_token = before_token
+        self.callback_results = []
+
+    def tokenize(self,prompt):
+        return list(prompt)
+
+    def generate(self,prompt,generation_config,callback):
+        for index,token in enumerate(self.text):
+            if self.before_token:
+                self.before_token(index)
+            result = callback(token)
+            self.callback_results.append(result)
+            if result:
+                break
+        return SimpleNamespace(stop_reason="StopReason.MaxLength",times=SimpleNamespace(prompt_feeding=0))
+
+def test_cancelled_stream_stops_the_hf_generation():
+    stop_condition = ManualStopCondition()
+    streamer = GeneratorStreamer(FakeTokenizer(),stop_condition,max_new_tokens=10)
+    #The same calls `.generate()` makes: the prompt, then one token per step
+    streamer.put(torch.tensor([[0,1,2]]))
+    streamer.put(torch.tensor([3]))
+    assert not stop_condition(None,None)
+
+    streamer.stream.cancel()
+    streamer.put(torch.tensor([4]))
+    assert stop_condition(None,None)
+    streamer.end()
+    assert streamer.stop_reason == "Cancelled!"
+    assert streamer.stream.stop_reason == "Cancelled!"
+
+def test_cancelled_stream_stops_the_cpu_generation():
+    model = FakeLlama("abcdef")
+    streamer = CPUStreamer(ModelPool([model]),config=None,prompt="prompt")
+    model.before_token = lambda index: streamer.stream.cancel() if index == 2 else None
+    streamer.start()
+    streamer.thread.join(timeout=1)
+
+    assert not streamer.thread.is_alive()
+    #The callback asks llm-rs to stop with the first token after the cancellation
+    assert model.callback_results == [None,None,True]
+    assert streamer.stream.stop_reason == "Cancelled!"
+    assert streamer.stream.completion_tokens == 2
+
+class FakeChatModel():
+    supports_async = False
+
+    def __init__(self) -> None:
+        self.streams = []
+
+    def default_config(self):
+        return GenerationConfig()
+
+    def pack_messages(self,messages,config):
+        return PackedMessages(messages=messages,tokens=len(messages))
+
+    def stream(self,messages,config,stop_words=[]):
+        stream = TokenStream(max_buffer=1)
+        def produce():
+            while stream.put("token"):
+                time.sleep(0.001)
+            stream.end()
+        threading.Thread(target=produce,daemon=True).start()
+        self.streams.append(stream)
+        return stream
+
+class ReadyLoader():
+    def require(self,*names):
+        pass
+
+def make_router(chat_model,metrics:MetricsRegistry,scheduler:ChatScheduler)->ChatRouter:
+    executors = ModelExecutors(metrics,{"chat":1,"reader":1,"embedding":1})
+    return ChatRouter(chat_model=chat_model,scheduler=scheduler,metrics=metrics,response_cache=ChatResponseCache(max_entries=0),
+                      executors=executors,loader=ReadyLoader(),extractive_qa_pipeline=None,rag_templates={},context_compressor=None,
+                      telemetry=GenerationTelemetry(metrics))
+
+def test_disconnected_clients_cancel_the_generation():
+    metrics = MetricsRegistry()
+    chat_model = FakeChatModel()
+    scheduler = ChatScheduler(metrics)
+    router = make_router(chat_model,metrics,scheduler)
+
+    async def run():
+        ticket = scheduler.submit("client")
+        events = router._generation_events([ChatMessage(role="user",content="Hi")],GenerationConfig(),[],None,lambda type,**kwargs:type,None,ticket)
+        assert await events.__anext__() == "token"
+        #Starlette closes the response iterator when the client disconnects
+        await events.aclose()
+
+    asyncio.run(run())
+    stream = chat_model.streams[0]
+    assert stream.cancelled
+    assert stream.stop_reason == "Cancelled!"
+    assert metrics.get("chat_cancelled_generations") == 1
+
+def test_unstarted_responses_hold_no_slot():
+    metrics = MetricsRegistry()
+    scheduler = ChatScheduler(metrics,slots=1,max_queue=0)
+    router = make_router(FakeChatModel(),metrics,scheduler)
+    request = ChatRequest(messages=[ChatMessage(role="user",content="Hi")])
+    http_request = SimpleNamespace(headers={"accept":"application/x-ndjson"},client=None)
+
+    async def run():
+        #The client disconnects before the response starts, its iterator is dropped without ever running
+        response = await router.prompt_streaming(request,http_request)
+        del response
+        assert scheduler.has_capacity()
+
+        #Both pass the capacity check, the second one only finds the queue full once it starts
+        first = (await router.prompt_streaming(request,http_request)).body_iterator
+        second = (await router.prompt_streaming(request,http_request)).body_iterator
+        assert json.loads(await first.__anext__()) == {"type":"delta","text":"token"}
+        assert not scheduler.has_capacity()
+        assert [json.loads(chunk)["type"] async for chunk in second] == ["error"]
+        await first.aclose()
+        assert scheduler.has_capacity()
+        assert scheduler.active == []
+
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import numpy as np
+from api.context_compression import ContextCompressor
+
+VOCABULARY = ["faust","goethe","wrote","weather","rain","train","station"]
+
+def embed(texts):
+    #Bag of words over a tiny vocabulary
+    return np.array([[text.lower().count(word)+0.01 for word in VOCABULARY] for text in texts])
+
+def count_tokens(text):
+    return len(text.split())
+
+CONTEXT = "The weather was bad. It rained all day at the station. Goethe wrote Faust in Weimar. The train was late."
+
+def test_keeps_the_sentences_most_similar_to_the_question():
+    compressor = ContextCompressor(embed,count_tokens)
+    result = compressor.compress("rain at the station",[CONTEXT],[None],budget=8)
+    
+    assert result.contexts == ["It rained all day at the station."]
+    assert result.tokens == 7
+    assert result.original_tokens == 20
+
+def test_kept_sentences_stay_in_order_with_gap_markers():
+    compressor = ContextCompressor(embed,count_tokens)
+    answer_start = CONTEXT.index("Goethe")
+    result = compressor.compress("Who wrote Faust?",[CONTEXT],[[answer_start,answer_start+6]],budget=9)
+    
+    assert result.contexts == ["The weather was bad. ... Goethe wrote Faust in Weimar."]
+    assert result.ratio == 9/20
+
+def test_answer_sentences_are_kept_before_similar_ones():
+    compressor = ContextCompressor(embed,count_tokens)
+    contexts = ["Faust by Goethe. The rain stopped.","Goethe wrote Faust and Faust wrote nothing. The train left the station."]
+    result = compressor.compress("weather rain",contexts,[[0,5],None],budget=4)
+    
+    assert result.contexts[0] == "Faust by Goethe."
+    assert result.contexts[1] == ""
+
+def test_contexts_within_budget_are_unchanged():
+    compressor = ContextCompressor(embed,count_tokens)
+    contexts = ["Goethe wrote Faust."]
+    result = compressor.compress("Who wrote Faust?",contexts,[None],budget=100)
+    assert result.contexts == contexts
+    assert result.ratio == 1
@@ -0,0 +1,105 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import time
+import struct
+import pytest
+import numpy as np
+from api.chat_models import Cpu_Adapter
+from schemas.chat import ChatMessage
+
+CORES = len(os.sched_getaffinity(0))
+INSTANCES = [1,2,4]
+WORDS = ["the","a","robot","story","short","write","about","is","of","and","it","was","to","in","he","she"]
+
+def write_llama(path:Path,n_embd:int=768,n_layer:int=6,n_head:int=12,n_mult:int=256):
+    """
+    Writes a llama model with random fp16 weights in the ggjt format of llm-rs. The vocabulary has the printable ascii characters
+    and a few words, every token is valid utf-8 on its own, llm-rs ends the generation on a token it can't decode.
+    """
+    tokens = [b"<unk>",b"<s>",b"</s>",b"\n"]+[bytes([i]) for i in range(32,127)]+[f" {word}".encode("utf-8") for word in WORDS]
+    n_ff = ((2*(4*n_embd)//3+n_mult-1)//n_mult)*n_mult
+    rng = np.random.default_rng(0)
+    with open(path,"wb") as f:
+        f.write(struct.pack("<II",0x67676a74,1))
+        f.write(struct.pack("<7i",len(tokens),n_embd,n_mult,n_head,n_layer,n_embd//n_head,1))
+        for token in tokens:
+            f.write(struct.pack("<I",len(token))+token+struct.pack("<f",float(len(token))))
+
+        def tensor(name:str,*shape:int,data:np.ndarray=None):
+            data = data if data is not None else (rng.standard_normal(shape,dtype=np.float32)*0.02).astype(np.float16)
+            encoded = name.encode("utf-8")
+            #ggml lists the dimensions from the innermost one, the data is 32 byte aligned
+            f.write(struct.pack("<3i",len(shape),len(encoded),0 if data.dtype == np.float32 else 1))
+            f.write(struct.pack(f"<{len(shape)}i",*reversed(shape))+encoded)
+            f.seek((f.tell()+31)&~31)
+            f.write(data.tobytes())
+
+        tensor("tok_embeddings.weight",len(tokens),n_embd)
+        tensor("norm.weight",n_embd,data=np.ones(n_embd,dtype=np.float32))
+        #A zero end token logit never makes it into the top k, every stream generates all of its tokens
+        output = (rng.standard_normal((len(tokens),n_embd),dtype=np.float32)*0.02).astype(np.float16)
+        output[2] = 0
+        tensor("output.weight",len(tokens),n_embd,data=output)
+        for layer in range(n_layer):
+            prefix = f"layers.{layer}."
+            tensor(prefix+"attention_norm.weight",n_embd,data=np.ones(n_embd,dtype=np.float32))
+            for weight in "qkvo":
+                tensor(prefix+f"attention.w{weight}.weight",n_embd,n_embd)
+            tensor(prefix+"ffn_norm.weight",n_embd,data=np.ones(n_embd,dtype=np.float32))
+            tensor(prefix+"feed_forward.w1.weight",n_ff,n_embd)
+            tensor(prefix+"feed_forward.w2.weight",n_embd,n_ff)
+            tensor(prefix+"feed_forward.w3.weight",n_ff,n_embd)
+
+class LocalRegistry():
+    def __init__(self,path:Path) -> None:
+        self.path = path
+
+    def resolve_file(self,repo_id,filename,revision=None):
+        return str(self.path)
+
+@pytest.fixture(scope="module")
+def registry(tmp_path_factory):
+    """
+    A 6 layer, 768 hidden llama with random weights, the hub isn't needed to run the benchmark.
+    """
+    path = tmp_path_factory.mktemp("ggjt")/"llama.bin"
+    write_llama(path)
+    return LocalRegistry(path)
+
+def test_cpu_model_pool_throughput(registry):
+    """
+    Generates one stream per instance with the same total thread budget (the cores of the host) for every pool size,
+    run with `-s` to see the aggregate and per stream tokens/s.
+    """
+    messages = [ChatMessage(role="user",content="Write a short story about a robot.")]
+    throughput = {}
+    for instances in INSTANCES:
+        adapter = Cpu_Adapter(threads=CORES,instances=instances,max_length=512,registry=registry)
+        adapter.load()
+        adapter.warmup()
+        config = adapter.default_config()
+        config.max_new_tokens = 64
+
+        started = time.perf_counter()
+        streams = [adapter.stream(messages,config) for _ in range(instances)]
+        for stream in streams:
+            list(stream)
+        elapsed = time.perf_counter()-started
+
+        tokens = sum(stream.completion_tokens for stream in streams)
+        assert tokens == 64*instances
+        throughput[instances] = tokens/elapsed
+        per_stream = sum(stream.stats()["tokens_per_second"] for stream in streams)/instances
+        print(f"{instances} instances, {CORES} threads: {throughput[instances]:.1f} tokens/s aggregate, {per_stream:.1f} tokens/s per stream")
+
+    if CORES < 2:
+        pytest.skip(f"Only {CORES} cores, the instances can't generate in parallel")
+    #Each instance decodes its own stream, the streams don't wait for each other
+    assert throughput[max(INSTANCES)] > throughput[1]
@@ -0,0 +1,162 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import time
+import threading
+from dataclasses import dataclass,field
+import numpy as np
+from api import digests
+from api.digests import DigestBuilder,DigestJob,get_digest,DIGEST_META_KEY,FINISHED,STOPPED
+from api.metrics import MetricsRegistry
+from api.executors import ModelExecutors
+
+VOCABULARY = ["faust","goethe","weimar","weather"]
+
+def embed(texts):
+    #Bag of words over a tiny vocabulary
+    return np.array([[text.lower().count(word)+0.01 for word in VOCABULARY] for text in texts])
+
+@dataclass
+class FakeDocument:
+    id:str
+    content:str
+    content_type:str = "text"
+    meta:dict = field(default_factory=dict)
+
+class FakeStore():
+    def __init__(self,documents) -> None:
+        self.documents = {doc.id:doc for doc in documents}
+        self.writes = []
+
+    def get_all_documents_generator(self,filters=None,return_embedding=None,batch_size=None):
+        yield from list(self.documents.values())
+
+    def write_documents(self,documents,batch_size=None,duplicate_documents=None):
+        self.writes.append([doc.id for doc in documents])
+
+def make_job(store,builder,executors=None)->DigestJob:
+    metrics = MetricsRegistry()
+    return DigestJob(store,lambda:builder,metrics,executors or ModelExecutors(metrics,{"embedding":1}))
+
+CONTENT = "Goethe wrote Faust. Faust was written in Weimar by Goethe. The weather was bad. Weimar is a small town."
+
+def test_digest_keeps_the_central_sentences_in_order():
+    builder = DigestBuilder(embed,max_words=12)
+    digest, = builder.build([CONTENT])
+
+    assert digest == "Goethe wrote Faust. Faust was written in Weimar by Goethe."
+    assert builder.build(["Short text."]) == ["Short text."]
+
+def test_digest_marks_skipped_sentences():
+    builder = DigestBuilder(embed,max_words=15)
+    digest, = builder.build([CONTENT])
+
+    assert digest == "Goethe wrote Faust. Faust was written in Weimar by Goethe. ... Weimar is a small town."
+
+def test_digests_are_stored_with_their_version():
+    builder = DigestBuilder(embed,max_words=12)
+    doc = FakeDocument(id="1",content=CONTENT)
+    builder.digest_documents([doc,FakeDocument(id="2",content="",content_type="table")])
+
+    assert get_digest(doc.meta) == "Goethe wrote Faust. Faust was written in Weimar by Goethe."
+    assert builder.has_digest(doc)
+    assert not DigestBuilder(embed,max_words=30).has_digest(doc)
+    assert get_digest({}) is None
+
+def test_job_skips_documents_which_already_have_a_digest():
+    builder = DigestBuilder(embed,max_words=12)
+    done = FakeDocument(id="done",content=CONTENT,meta={DIGEST_META_KEY:{"text":"old","version":builder.version}})
+    store = FakeStore([done]+[FakeDocument(id=str(i),content=CONTENT) for i in range(5)])
+    job = make_job(store,builder)
+
+    assert job.start(batch_size=2)
+    assert job.wait(5)
+    status = job.status()
+
+    assert status.state == FINISHED
+    assert (status.processed,status.updated,status.skipped) == (6,5,1)
+    assert store.writes == [["0","1"],["2","3"],["4"]]
+    assert get_digest(done.meta) == "old"
+
+def test_stopped_job_resumes_on_the_next_run():
+    builder = DigestBuilder(embed,max_words=12)
+    store = FakeStore([FakeDocument(id=str(i),content=CONTENT) for i in range(4)])
+    job = make_job(store,builder)
+
+    write = store.write_documents
+    def write_and_stop(documents,**kwargs):
+        write(documents,**kwargs)
+        job.stop()
+    store.write_documents = write_and_stop
+    job.start(batch_size=2)
+    assert job.wait(5)
+    assert job.status().state == STOPPED
+    assert store.writes == [["0","1"]]
+
+    store.write_documents = write
+    job.start(batch_size=2)
+    assert job.wait(5)
+    assert job.status().state == FINISHED
+    assert job.status().skipped == 2
+    assert store.writes == [["0","1"],["2","3"]]
+
+def test_wait_covers_a_run_started_right_after_the_previous_one(monkeypatch):
+    builder = DigestBuilder(embed,max_words=12)
+    store = FakeStore([FakeDocument(id="0",content=CONTENT)])
+    job = make_job(store,builder)
+    proceed = threading.Event()
+
+    class SlowLogger():
+        """
+        Holds the ending run in its last log line for a while.
+        """
+        def info(self,message):
+            proceed.wait(0.5)
+        def exception(self,e):
+            pass
+    monkeypatch.setattr(digests,"logger",SlowLogger())
+
+    job.start()
+    while job.status().state != FINISHED:
+        time.sleep(0.001)
+    release = threading.Event()
+    documents = store.get_all_documents_generator
+    def blocking_generator(**kwargs):
+        release.wait(5)
+        yield from documents(**kwargs)
+    store.get_all_documents_generator = blocking_generator
+    assert job.start(overwrite=True)
+    proceed.set()
+    #The previous run must not mark the new one as finished
+    assert not job.wait(0.1)
+    release.set()
+    assert job.wait(5)
+
+def test_digests_are_built_on_the_embedding_executor():
+    threads = []
+    def recording_embed(texts):
+        threads.append(threading.current_thread().name)
+        return embed(texts)
+    builder = DigestBuilder(recording_embed,max_words=12)
+    store = FakeStore([FakeDocument(id=str(i),content=CONTENT) for i in range(2)])
+    metrics = MetricsRegistry()
+    executors = ModelExecutors(metrics,{"embedding":1})
+    job = make_job(store,builder,executors)
+
+    #A busy embedding model holds the job back
+    busy = threading.Event()
+    executors.submit("embedding",busy.wait,5)
+    job.start(batch_size=1)
+    time.sleep(0.1)
+    assert store.writes == []
+    assert metrics.gauges["embedding_executor_pending"] == 2
+    busy.set()
+    assert job.wait(5)
+    assert store.writes == [["0"],["1"]]
+    assert all(name.startswith("embedding-executor") for name in threads) and len(threads) == 2
@@ -0,0 +1,83 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import pytest
+from elasticsearch.exceptions import NotFoundError
+from api.document_paging import DocumentPager,CursorExpired,InvalidCursor,project_document
+
+class FakeClient():
+    """
+    A point in time over a fixed list of sources, the position in the list is the sort value.
+    """
+    def __init__(self,sources) -> None:
+        self.sources = sources
+        self.bodies = []
+        self.closed = []
+        self.expired = False
+
+    def open_point_in_time(self,index,keep_alive):
+        return {"id":"pit-1"}
+
+    def close_point_in_time(self,body):
+        self.closed.append(body["id"])
+
+    def search(self,body):
+        if self.expired:
+            raise NotFoundError(404,"search_phase_execution_exception",{})
+        self.bodies.append(body)
+        start = body["search_after"][0]+1 if "search_after" in body else 0
+        hits = [{"_id":f"doc-{i}","_source":dict(self.sources[i]),"sort":[i]} for i in range(start,min(start+body["size"],len(self.sources)))]
+        return {"pit_id":"pit-1","hits":{"hits":hits}}
+
+class FakeStore():
+    index = "document"
+    content_field = "content"
+    embedding_field = "embedding"
+    name_field = "name"
+
+    def __init__(self,sources) -> None:
+        self.client = FakeClient(sources)
+
+SOURCES = [{"content":f"Text {i}","content_type":"text","name":f"Article {i}","category":"wiki"} for i in range(5)]
+
+def test_pages_continue_with_the_cursor_until_the_last_page():
+    store = FakeStore(SOURCES)
+    pager = DocumentPager(store,excluded_meta=["token_cache"])
+    ids,cursor,pages = [],None,0
+    while True:
+        documents,cursor = pager.page(filters={"category":"wiki"},limit=2,cursor=cursor)
+        ids.extend(doc.id for doc in documents)
+        pages += 1
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert ids == [f"doc-{i}" for i in range(5)]
+    assert store.client.closed == ["pit-1"]
+    #The cursor carries the filters and the embeddings are never read
+    assert all(body["query"] != {"match_all":{}} for body in store.client.bodies)
+    assert store.client.bodies[0]["_source"] == {"excludes":["token_cache","embedding"]}
+
+def test_projection_is_pushed_down_to_the_store():
+    store = FakeStore(SOURCES)
+    documents,_ = DocumentPager(store).page(limit=10,fields=["meta.name"])
+
+    assert store.client.bodies[0]["_source"] == {"includes":["name"],"excludes":["embedding"]}
+    assert project_document(documents[0],["meta.name"]) == {"id":"doc-0","meta":{"name":"Article 0"}}
+
+def test_invalid_and_expired_cursors():
+    store = FakeStore(SOURCES)
+    pager = DocumentPager(store)
+    with pytest.raises(InvalidCursor):
+        pager.page(cursor="not a cursor")
+
+    _,cursor = pager.page(limit=2)
+    store.client.expired = True
+    with pytest.raises(CursorExpired):
+        pager.page(limit=2,cursor=cursor)
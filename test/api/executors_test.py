@@ -0,0 +1,75 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import time
+import asyncio
+import logging
+import threading
+from api.metrics import MetricsRegistry
+from api.executors import ModelExecutors,EventLoopLagMonitor
+
+def test_executors_limit_threads_per_model_type():
+    metrics = MetricsRegistry()
+    executors = ModelExecutors(metrics,{"chat":1,"reader":2})
+    running = {"chat":0,"reader":0}
+    peak = {"chat":0,"reader":0}
+    lock = threading.Lock()
+    
+    def work(kind):
+        with lock:
+            running[kind] += 1
+            peak[kind] = max(peak[kind],running[kind])
+        time.sleep(0.05)
+        with lock:
+            running[kind] -= 1
+        return kind
+    
+    async def run():
+        tasks = [executors.run(kind,work,kind) for kind in ["chat"]*3+["reader"]*4]
+        return await asyncio.gather(*tasks)
+    
+    results = asyncio.run(run())
+    executors.shutdown()
+    assert results == ["chat"]*3+["reader"]*4
+    assert peak == {"chat":1,"reader":2}
+    assert metrics.snapshot()["gauges"]["chat_executor_pending"] == 0
+    assert metrics.snapshot()["observations"]["reader_executor_wait_seconds"]["count"] == 4
+    
+def test_event_loop_keeps_running_during_model_work():
+    executors = ModelExecutors(MetricsRegistry(),{"chat":1})
+    ticks = []
+    
+    async def run():
+        async def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+        ticker = asyncio.get_running_loop().create_task(tick())
+        await executors.run("chat",time.sleep,0.2)
+        ticker.cancel()
+        
+    asyncio.run(run())
+    executors.shutdown()
+    assert len(ticks) > 5
+    
+def test_lag_monitor_reports_blocking(caplog):
+    metrics = MetricsRegistry()
+    monitor = EventLoopLagMonitor(metrics,interval=0.02,threshold=0.05)
+    
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)
+        await asyncio.sleep(0.05)
+        monitor.stop()
+        
+    with caplog.at_level(logging.WARNING,logger="api.executors"):
+        asyncio.run(run())
+    assert metrics.get("event_loop_blocked") >= 1
+    assert any("test_lag_monitor_reports_blocking" in record.getMessage() for record in caplog.records)
@@ -0,0 +1,92 @@
+import os
+import sys
+import asyncio
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import pytest
+from haystack.schema import Document
+from api.ingestion import DocumentIngestor,InvalidStream,ingest_ndjson,ndjson_lines,SOURCE_ID_META_KEY
+from api.metrics import MetricsRegistry
+
+class FakeStore():
+    def __init__(self,fail_on_write:int=None) -> None:
+        self.documents = {}
+        self.writes = []
+        self.fail_on_write = fail_on_write
+
+    def get_documents_by_id(self,ids,batch_size=None):
+        return [self.documents[id] for id in ids if id in self.documents]
+
+    def write_documents(self,documents,batch_size=None,duplicate_documents=None):
+        if len(self.writes) == self.fail_on_write:
+            raise ConnectionError("Bulk write failed")
+        self.writes.append([doc.id for doc in documents])
+        self.documents.update({doc.id:doc for doc in documents})
+
+class SentencePreprocessor():
+    def process(self,documents):
+        return [Document(content=sentence,meta=dict(doc.meta)) for doc in documents for sentence in doc.content.split(". ")]
+
+async def body(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+def ingest(ingestor,*chunks,enrichers=None,batch_size=2):
+    async def write_batch(batch):
+        return ingestor.write_batch(batch,enrichers=enrichers)
+    return asyncio.run(ingest_ndjson(body(*chunks),write_batch,batch_size=batch_size))
+
+LINES = [
+    b'{"id": "a", "content": "First. Second", "meta": {"name": "A"}}\n',
+    b'{"id": "b", "content": "Third"}\n',
+    b'{"content": "Fourth"}\n',
+]
+
+def test_documents_are_split_and_written_in_batches():
+    store = FakeStore()
+    enriched = []
+    ingestor = DocumentIngestor(store,lambda:SentencePreprocessor(),MetricsRegistry())
+    #Lines are split across the chunks of the body
+    data = b"".join(LINES)
+    result = ingest(ingestor,data[:30],data[30:],enrichers=[lambda docs:enriched.extend(doc.id for doc in docs)])
+
+    assert (result.documents,result.chunks,result.skipped,result.failed) == (3,4,0,0)
+    assert [batch.documents for batch in result.batches] == [2,1]
+    #The first chunk of a document marks it as complete, it is written after the other chunks
+    assert store.writes[:2] == [["a#1"],["a","b"]]
+    assert store.documents["a#1"].meta == {"name":"A",SOURCE_ID_META_KEY:"a"}
+    assert enriched[:3] == ["a#1","a","b"]
+
+def test_written_documents_are_skipped_on_resume():
+    store = FakeStore()
+    ingestor = DocumentIngestor(store,lambda:SentencePreprocessor(),MetricsRegistry())
+    ingest(ingestor,LINES[0])
+
+    result = ingest(ingestor,b"not json\n",*LINES)
+    assert (result.documents,result.skipped,result.failed) == (2,1,1)
+    assert result.errors[0].startswith("Line 1:")
+    assert store.writes[-2] == ["b"]
+
+def test_failed_writes_leave_documents_incomplete():
+    store = FakeStore(fail_on_write=0)
+    ingestor = DocumentIngestor(store,lambda:SentencePreprocessor(),MetricsRegistry())
+    with pytest.raises(ConnectionError):
+        ingest(ingestor,LINES[0])
+    assert "a" not in store.documents
+
+    #The document isn't marked as written, so it is written again on resume
+    store.fail_on_write = None
+    result = ingest(ingestor,LINES[0])
+    assert (result.documents,result.skipped) == (1,0)
+    assert store.writes == [["a#1"],["a"]]
+
+def test_oversized_lines_fail_the_stream():
+    async def read():
+        return [line async for line in ndjson_lines(body(b"x"*20),max_line_bytes=10)]
+    with pytest.raises(InvalidStream):
+        asyncio.run(read())
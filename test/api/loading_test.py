@@ -0,0 +1,60 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import time
+import threading
+import pytest
+from api.metrics import MetricsRegistry
+from api.loading import ModelLoader,ComponentNotReady
+
+def test_components_load_concurrently_and_warm_up():
+    loader = ModelLoader(MetricsRegistry())
+    release = threading.Event()
+    warmed = []
+    def slow_load(name):
+        def load():
+            release.wait(5)
+            return name
+        return load
+    loader.register("chat",slow_load("chat"),warmed.append)
+    loader.register("reader",slow_load("reader"),warmed.append)
+    
+    started = time.perf_counter()
+    loader.start()
+    assert {status.state for status in loader.status().values()} == {"loading"}
+    with pytest.raises(ComponentNotReady):
+        loader.require("chat")
+    
+    release.set()
+    assert loader.wait(timeout=5)
+    assert time.perf_counter()-started < 5
+    assert loader.is_ready()
+    assert sorted(warmed) == ["chat","reader"]
+    loader.require("chat","reader")
+    assert loader.status()["chat"].warmup_seconds is not None
+
+def test_failed_component_does_not_block_the_others():
+    metrics = MetricsRegistry()
+    loader = ModelLoader(metrics)
+    def fail():
+        raise RuntimeError("Out of memory")
+    loader.register("chat",fail)
+    loader.register("embedding",lambda:"model")
+    loader.start()
+    assert loader.wait(timeout=5)
+    
+    status = loader.status()
+    assert status["chat"].state == "failed"
+    assert status["chat"].error == "Out of memory"
+    assert status["embedding"].state == "ready"
+    assert loader.is_ready("embedding")
+    assert not loader.is_ready()
+    with pytest.raises(ComponentNotReady,match="failed: Out of memory"):
+        loader.require("chat")
+    assert metrics.snapshot()["gauges"]["embedding_ready"] == 1
@@ -0,0 +1,66 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import time
+import threading
+import pytest
+from api.model_pool import ModelPool,split_threads
+from api.chat_models import Cpu_Adapter
+
+def test_split_threads():
+    assert split_threads(8,1) == [8]
+    assert split_threads(8,3) == [3,3,2]
+    assert split_threads(2,4) == [1,1,1,1]
+
+def test_pool_hands_out_each_instance_once():
+    pool = ModelPool(["a","b"])
+    used = []
+    lock = threading.Lock()
+    peak = {"busy":0}
+    def generate():
+        with pool.acquire() as instance:
+            with lock:
+                used.append(instance)
+                peak["busy"] = max(peak["busy"],pool.stats()["busy"])
+            time.sleep(0.05)
+    
+    threads = [threading.Thread(target=generate) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert sorted(set(used)) == ["a","b"]
+    assert peak["busy"] == 2
+    assert pool.stats() == {"instances":2,"busy":0,"waiting":0}
+
+def test_pool_times_out_without_free_instance():
+    pool = ModelPool(["a"])
+    with pool.acquire():
+        with pytest.raises(TimeoutError):
+            with pool.acquire(timeout=0.01):
+                pass
+    with pool.acquire(timeout=0.01) as instance:
+        assert instance == "a"
+
+class FakeLlama():
+    def tokenize(self,text):
+        return text.split()
+
+def test_cpu_adapter_counts_tokens_while_the_pool_is_busy():
+    adapter = Cpu_Adapter()
+    adapter.pool = ModelPool([FakeLlama()])
+    adapter.tokenizer_model = FakeLlama()
+    #A generation holds the only instance, counting uses the separate tokenizer instance
+    with adapter.pool.acquire():
+        assert adapter.count_tokens("a b c") == 3
+    #Without mmap a free instance of the pool is borrowed
+    adapter.tokenizer_model = None
+    assert adapter.count_tokens("a b") == 2
+    assert adapter.pool.stats()["busy"] == 0
@@ -0,0 +1,73 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import pytest
+from api import model_registry
+from api.model_registry import ModelRegistry,ModelNotAvailable
+
+class FakeHub():
+    def __init__(self,directory:Path) -> None:
+        self.directory = directory
+        self.calls = []
+
+    def snapshot_download(self,repo_id,cache_dir,force_download=False,**kwargs):
+        self.calls.append((repo_id,force_download))
+        snapshot = Path(cache_dir)/repo_id.replace("/","--")
+        snapshot.mkdir(parents=True,exist_ok=True)
+        (snapshot/"config.json").write_text('{"hidden_size": 8}')
+        (snapshot/"pytorch_model.bin").write_bytes(b"weights")
+        return str(snapshot)
+
+    def hf_hub_download(self,repo_id,filename,cache_dir,force_download=False,**kwargs):
+        self.calls.append((f"{repo_id}/{filename}",force_download))
+        path = Path(cache_dir)/repo_id.replace("/","--")/filename
+        path.parent.mkdir(parents=True,exist_ok=True)
+        path.write_bytes(b"ggml weights")
+        return str(path)
+
+@pytest.fixture
+def hub(monkeypatch,tmp_path):
+    hub = FakeHub(tmp_path)
+    monkeypatch.setattr(model_registry,"snapshot_download",hub.snapshot_download)
+    monkeypatch.setattr(model_registry,"hf_hub_download",hub.hf_hub_download)
+    return hub
+
+def test_present_models_resolve_without_downloads(hub,tmp_path):
+    directory = str(tmp_path/"registry")
+    snapshot = ModelRegistry(directory).resolve_snapshot("org/embedder")
+    file = ModelRegistry(directory).resolve_file("org/ggml","model.bin")
+    assert hub.calls == [("org/embedder",False),("org/ggml/model.bin",False)]
+
+    #A new process (and offline mode) finds both in the manifest
+    registry = ModelRegistry(directory,offline=True)
+    assert registry.resolve_snapshot("org/embedder") == snapshot
+    assert registry.resolve_file("org/ggml","model.bin") == file
+    assert len(hub.calls) == 2
+    assert registry.verify("org/embedder")
+    assert registry.manifest()["org/embedder"].files["config.json"].size == len('{"hidden_size": 8}')
+
+    with pytest.raises(ModelNotAvailable):
+        registry.resolve_snapshot("org/missing")
+    assert registry.resolve_snapshot(directory) == directory
+
+def test_corrupt_models_are_downloaded_again(hub,tmp_path):
+    directory = str(tmp_path/"registry")
+    snapshot = ModelRegistry(directory).resolve_snapshot("org/embedder")
+    #Same size, different content: only the checksum verification notices it
+    Path(snapshot,"pytorch_model.bin").write_bytes(b"weighTs")
+
+    registry = ModelRegistry(directory)
+    assert not registry.verify("org/embedder")
+    assert ModelRegistry(directory).manifest()["org/embedder"].corrupt
+    with pytest.raises(ModelNotAvailable):
+        ModelRegistry(directory,offline=True).resolve_snapshot("org/embedder")
+
+    ModelRegistry(directory).resolve_snapshot("org/embedder")
+    assert hub.calls[-1] == ("org/embedder",True)
+    assert not ModelRegistry(directory).manifest()["org/embedder"].corrupt
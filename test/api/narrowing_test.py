@@ -0,0 +1,85 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import pytest
+import numpy as np
+from haystack.schema import Document,Answer,Span
+from api.custom_nodes.narrowing_nodes import ContextNarrowingNode,ContextRestoringNode,build_narrowing_node
+
+FILLER = [f"Filler sentence number {i} is here." for i in range(30)]
+SENTENCES = FILLER[:5]+["The capital of France is Paris."]+FILLER[5:20]+["The longest river of France is the Loire."]+FILLER[20:]
+DOCUMENT = Document(id="doc",content=" ".join(SENTENCES))
+SHORT_DOCUMENT = Document(id="short",content="Paris is short.")
+
+class BagOfWordsRetriever():
+    VOCABULARY = ["capital","river","france","paris","loire"]
+    def embed_queries(self,queries):
+        return np.array([[float(word in query.lower()) for word in self.VOCABULARY] for query in queries])
+
+def read(query,documents,answers):
+    """
+    Stands in for the reader: answers with the offsets of the answer strings in the (narrowed) documents it was given.
+    """
+    found = []
+    for document in documents:
+        for answer in answers:
+            start = document.content.find(answer)
+            if start >= 0:
+                span = Span(start=start,end=start+len(answer))
+                found.append(Answer(answer=answer,type="extractive",context=document.content,offsets_in_context=[span],offsets_in_document=[span],document_ids=[document.id]))
+    return found
+
+def narrowing_nodes():
+    return [
+        ContextNarrowingNode(max_words=40,window_sentences=1),
+        ContextNarrowingNode(max_words=40,window_sentences=1,mode="embedding",embedding_retriever=BagOfWordsRetriever()),
+    ]
+
+@pytest.mark.parametrize("node",narrowing_nodes(),ids=["lexical","embedding"])
+def test_answers_are_restored_to_the_original_offsets(node):
+    output,_ = node.run(query="capital river France",documents=[DOCUMENT,SHORT_DOCUMENT])
+    narrowed = output["documents"][0]
+    #Both windows are kept as separate spans, the short document is untouched
+    assert len(output["narrowed_contexts"]["doc"].spans) == 2
+    assert len(narrowed.content.split()) < len(DOCUMENT.content.split())
+    assert output["documents"][1] is SHORT_DOCUMENT
+
+    answers = read(output["query"],output["documents"],["Paris","the Loire","Filler sentence number 4","Filler sentence number 20"])
+    assert len(answers) == 5
+    restored,_ = ContextRestoringNode(context_window_size=20).run(query=output["query"],answers=answers,documents=output["documents"],narrowed_contexts=output["narrowed_contexts"])
+
+    originals = {doc.id:doc for doc in restored["documents"]}
+    assert originals["doc"] is DOCUMENT
+    for answer in restored["answers"]:
+        span = answer.offsets_in_document[0]
+        assert originals[answer.document_ids[0]].content[span.start:span.end] == answer.answer
+        context_span = answer.offsets_in_context[0]
+        assert answer.context[context_span.start:context_span.end] == answer.answer
+
+def test_batches_are_narrowed_per_query():
+    node = ContextNarrowingNode(max_words=10,window_sentences=0)
+    output,_ = node.run_batch(queries=["capital of France","river of France"],documents=[DOCUMENT])
+    assert [len(docs) for docs in output["documents"]] == [1,1]
+    assert "Paris" in output["documents"][0][0].content and "Loire" not in output["documents"][0][0].content
+    assert "Loire" in output["documents"][1][0].content
+
+    answers = [read(query,docs,["Paris","the Loire"]) for query,docs in zip(output["queries"],output["documents"])]
+    restored,_ = ContextRestoringNode().run_batch(queries=output["queries"],answers=answers,documents=output["documents"],narrowed_contexts=output["narrowed_contexts"])
+    assert [[answer.answer for answer in answer_list] for answer_list in restored["answers"]] == [["Paris"],["the Loire"]]
+    for answer_list in restored["answers"]:
+        span = answer_list[0].offsets_in_document[0]
+        assert DOCUMENT.content[span.start:span.end] == answer_list[0].answer
+    assert restored["documents"] == [[DOCUMENT],[DOCUMENT]]
+
+def test_unknown_modes_are_rejected():
+    with pytest.raises(ValueError):
+        build_narrowing_node(enabled=False,max_words=100,mode="semantic",embedding_retriever=None)
+    with pytest.raises(ValueError):
+        ContextNarrowingNode(mode="Lexical")
+    assert build_narrowing_node(enabled=True,max_words=100,mode="lexical",embedding_retriever=None).mode == "lexical"
@@ -0,0 +1,164 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import json
+import time
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+import pytest
+from schemas.chat import ChatMessage
+from api.openai_client import OpenAIClient,OpenAIError,parse_duration
+from api.chat_models import ChatGPT_Adapter
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Mimics /v1/chat/completions: answers "Hello world!" as json or server-sent events
+    and responds with 429 to the first `server.rate_limited` requests.
+    """
+    def log_message(self,*args):
+        pass
+
+    def _send(self,status:int,body:bytes,headers:dict={}):
+        self.send_response(status)
+        for key,value in headers.items():
+            self.send_header(key,value)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight,server.in_flight)
+            rate_limited = server.rate_limited > 0
+            server.rate_limited -= 1
+        try:
+            if self.path != "/v1/chat/completions":
+                return self._send(404,b"{}")
+            if rate_limited:
+                return self._send(429,b'{"error":{"message":"Rate limit reached"}}',{"Retry-After":"0.05"})
+            time.sleep(server.delay)
+
+            pieces = ["Hello"," world","!"]
+            usage = {"prompt_tokens":12,"completion_tokens":3,"total_tokens":15}
+            if not payload.get("stream"):
+                body = {"choices":[{"index":0,"message":{"role":"assistant","content":"".join(pieces)},"finish_reason":"stop"}],"usage":usage}
+                return self._send(200,json.dumps(body).encode())
+
+            chunks = [{"choices":[{"index":0,"delta":{"role":"assistant"},"finish_reason":None}]}]
+            chunks += [{"choices":[{"index":0,"delta":{"content":piece},"finish_reason":None}]} for piece in pieces]
+            chunks += [{"choices":[{"index":0,"delta":{},"finish_reason":"length"}]}]
+            if server.send_usage and payload.get("stream_options",{}).get("include_usage"):
+                chunks += [{"choices":[],"usage":usage}]
+            body = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks)+"data: [DONE]\n\n"
+            self._send(200,body.encode(),{"Content-Type":"text/event-stream"})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1",0),StubOpenAIHandler)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.in_flight = 0
+    server.peak_in_flight = 0
+    server.rate_limited = 0
+    server.delay = 0.0
+    server.send_usage = True
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def messages():
+    return [ChatMessage(role="user",content="Say hello to the world")]
+
+def test_parse_duration():
+    assert parse_duration("2") == 2
+    assert parse_duration("1m30s") == 90
+    assert parse_duration("250ms") == 0.25
+    assert parse_duration(None) is None
+
+def test_client_retries_rate_limited_requests(stub_server):
+    stub_server.rate_limited = 2
+    async def run():
+        client = OpenAIClient("token",base_url=stub_server.base_url,max_retries=3)
+        try:
+            return await client.chat({"messages":[]}),client.retries
+        finally:
+            await client.aclose()
+    result,retries = asyncio.run(run())
+    assert result["choices"][0]["message"]["content"] == "Hello world!"
+    assert retries == 2
+    assert stub_server.requests == 3
+
+def test_client_gives_up_after_max_retries(stub_server):
+    stub_server.rate_limited = 10
+    async def run():
+        client = OpenAIClient("token",base_url=stub_server.base_url,max_retries=1)
+        try:
+            await client.chat({"messages":[]})
+        finally:
+            await client.aclose()
+    with pytest.raises(OpenAIError) as error:
+        asyncio.run(run())
+    assert error.value.status_code == 429
+
+def test_client_limits_concurrent_requests(stub_server):
+    stub_server.delay = 0.1
+    async def run():
+        client = OpenAIClient("token",base_url=stub_server.base_url,max_concurrency=2)
+        try:
+            await asyncio.gather(*[client.chat({"messages":[]}) for _ in range(6)])
+        finally:
+            await client.aclose()
+    asyncio.run(run())
+    assert stub_server.requests == 6
+    assert stub_server.peak_in_flight == 2
+
+def test_adapter_counts_tokens_of_requests(stub_server):
+    adapter = ChatGPT_Adapter("token",base_url=stub_server.base_url)
+    adapter.load()
+    config = adapter.default_config()
+
+    assert adapter.generate(messages(),config) == ("Hello world!","End of sequence!")
+    assert adapter.total_tokens == 15
+
+    stream = adapter.stream(messages(),config)
+    assert "".join(stream) == "Hello world!"
+    assert stream.prompt_tokens == 12
+    assert stream.completion_tokens == 3
+    assert stream.stop_reason == "Max Tokens!"
+    assert adapter.total_tokens == 30
+
+def test_adapter_counts_streamed_tokens_without_usage(stub_server):
+    stub_server.send_usage = False
+    adapter = ChatGPT_Adapter("token",base_url=stub_server.base_url)
+    adapter.load()
+
+    stream = adapter.stream(messages(),adapter.default_config())
+    assert "".join(stream) == "Hello world!"
+    assert stream.prompt_tokens > 0
+    assert stream.completion_tokens > 0
+    assert adapter.total_tokens == stream.prompt_tokens+stream.completion_tokens
+
+def test_adapter_generates_from_event_loop(stub_server):
+    adapter = ChatGPT_Adapter("token",base_url=stub_server.base_url)
+    adapter.load()
+    async def run():
+        return await asyncio.gather(*[adapter.agenerate(messages(),adapter.default_config()) for _ in range(3)])
+    assert asyncio.run(run()) == [("Hello world!","End of sequence!")]*3
@@ -0,0 +1,33 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+from api.prefix_cache import PrefixStateCache
+
+def test_prefix_cache_returns_longest_prefix():
+    cache = PrefixStateCache(max_size=100,size_of=len)
+    tokens = [1,2,3,4,5,6,7,8]
+    cache.put(tokens[:2],"ab")
+    cache.put(tokens[:5],"abcde")
+    assert cache.lookup(tokens,[2,5,7]) == (5,"abcde")
+    assert cache.lookup(tokens,[2,3]) == (2,"ab")
+    assert cache.lookup([9,9,9],[1,2]) == (0,None)
+    assert cache.hits == 2 and cache.misses == 1
+    
+def test_prefix_cache_evicts_least_recently_used():
+    cache = PrefixStateCache(max_size=6,size_of=len)
+    cache.put([1],"aa")
+    cache.put([2],"bb")
+    cache.lookup([1],[1])
+    cache.put([3],"ccc")
+    assert cache.contains([1]) and cache.contains([3])
+    assert not cache.contains([2])
+    assert cache.size == 5
+    #States larger than the cache are never stored
+    cache.put([4],"x"*7)
+    assert not cache.contains([4]) and cache.contains([1])
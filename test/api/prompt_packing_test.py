@@ -0,0 +1,64 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+from api.prompt_packing import PromptPacker
+from schemas.chat import ChatMessage
+
+class WordCounter():
+    def __init__(self) -> None:
+        self.calls = 0
+        
+    def __call__(self,text:str)->int:
+        self.calls += 1
+        return len(text.split())
+
+def _format(message:ChatMessage)->str:
+    return f"{message.role}: {message.content}"
+
+def _chat(turns:int):
+    messages = [ChatMessage(role="system",content="You are a helpful assistant")]
+    for i in range(turns):
+        messages.append(ChatMessage(role="user",content=f"question number {i}"))
+        messages.append(ChatMessage(role="assistant",content=f"answer number {i}"))
+    messages.append(ChatMessage(role="user",content="the last question"))
+    return messages
+
+def test_packer_keeps_fitting_prompts():
+    packer = PromptPacker(WordCounter(),_format)
+    messages = _chat(2)
+    packed = packer.pack(messages,budget=100)
+    assert packed.messages == messages and not packed.trimmed
+    assert packed.tokens == 6+4*4+4
+
+def test_packer_drops_oldest_turns_first():
+    packer = PromptPacker(WordCounter(),_format)
+    messages = _chat(3)
+    packed = packer.pack(messages,budget=6+4*2+4)
+    assert packed.dropped == 4 and packed.truncated == 0
+    assert packed.messages == [messages[0]]+messages[-3:]
+    assert packed.tokens <= 6+4*2+4
+
+def test_packer_truncates_kept_messages():
+    packer = PromptPacker(WordCounter(),_format)
+    messages = [ChatMessage(role="system",content="short system prompt"),
+                ChatMessage(role="assistant",content="a very long answer "*10),
+                ChatMessage(role="user",content="the question")]
+    packed = packer.pack(messages,budget=20)
+    assert packed.truncated == 1
+    assert packed.messages[0] == messages[0] and packed.messages[-1] == messages[-1]
+    assert messages[1].content.strip().endswith(packed.messages[1].content.strip())
+    assert packed.tokens <= 20
+
+def test_packer_counts_each_message_once():
+    counter = WordCounter()
+    packer = PromptPacker(counter,_format)
+    packer.pack(_chat(3),budget=100)
+    calls = counter.calls
+    packer.pack(_chat(4),budget=100)
+    assert counter.calls == calls + 2
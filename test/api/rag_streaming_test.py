@@ -0,0 +1,155 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import json
+import asyncio
+import threading
+from types import SimpleNamespace
+from haystack.schema import Document,Answer,Span
+from api.streaming import TokenStream
+from api.prompt_packing import PackedMessages
+from api.metrics import MetricsRegistry
+from api.executors import ModelExecutors
+from api.scheduling import ChatScheduler
+from api.response_cache import ChatResponseCache
+from api.telemetry import GenerationTelemetry
+from api.rag import DEFAULT_RAG_TEMPLATES
+from api.digests import DIGEST_META_KEY
+from api.routers.chat import ChatRouter
+from schemas.chat import RagChatRequest
+from transformers import GenerationConfig
+
+DOCUMENT = Document(id="faust",content="Faust is a play. Goethe wrote Faust.")
+
+class FakeChatModel():
+    supports_async = False
+    rag_template = "alpaca"
+
+    def __init__(self) -> None:
+        self.prefilled = []
+        self.prompts = []
+
+    def default_config(self):
+        return GenerationConfig()
+
+    def prefill(self,messages):
+        self.prefilled.append(messages)
+
+    def count_tokens(self,text):
+        return len(text.split())
+
+    def pack_messages(self,messages,config):
+        return PackedMessages(messages=messages,tokens=len(messages))
+
+    def stream(self,messages,config,stop_words=[]):
+        self.prompts.append(messages)
+        stream = TokenStream()
+        stream.put("Goethe.")
+        stream.end("End of sequence!")
+        return stream
+
+class BlockingPipeline():
+    """
+    Blocks the retrieval until `release` is set.
+    """
+    def __init__(self,document:Document=DOCUMENT) -> None:
+        self.document = document
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def run(self,query,params):
+        self.started.set()
+        self.release.wait(timeout=5)
+        span = Span(start=17,end=23)
+        answer = Answer(answer="Goethe",score=0.9,context=self.document.content,offsets_in_context=[span],offsets_in_document=[span],document_ids=[self.document.id])
+        return {"documents":[self.document],"answers":[answer]}
+
+class ReadyLoader():
+    def require(self,*names):
+        pass
+
+def make_router(chat_model,pipeline,scheduler:ChatScheduler,metrics:MetricsRegistry)->ChatRouter:
+    executors = ModelExecutors(metrics,{"chat":1,"reader":1,"embedding":1})
+    return ChatRouter(chat_model=chat_model,scheduler=scheduler,metrics=metrics,response_cache=ChatResponseCache(max_entries=0),
+                      executors=executors,loader=ReadyLoader(),extractive_qa_pipeline=lambda:pipeline,rag_templates=DEFAULT_RAG_TEMPLATES,
+                      context_compressor=None,telemetry=GenerationTelemetry(metrics),context_tokens=0)
+
+HTTP_REQUEST = SimpleNamespace(headers={"accept":"application/x-ndjson"},client=None)
+
+async def collect(response)->list:
+    return [json.loads(chunk) async for chunk in response.body_iterator]
+
+def test_the_slot_is_only_taken_once_the_prompt_is_built():
+    metrics = MetricsRegistry()
+    scheduler = ChatScheduler(metrics,slots=1)
+    chat_model = FakeChatModel()
+    pipeline = BlockingPipeline()
+    router = make_router(chat_model,pipeline,scheduler,metrics)
+
+    async def run():
+        events = asyncio.ensure_future(collect(await router.rag_streaming(RagChatRequest(question="Who wrote Faust?"),HTTP_REQUEST)))
+        while not pipeline.started.is_set():
+            await asyncio.sleep(0.01)
+        #Neither a slot nor a place in the queue is held while the documents are searched
+        assert scheduler.active == [] and scheduler.queue == []
+        pipeline.release.set()
+        return await events
+
+    events = asyncio.run(run())
+    assert [event["type"] for event in events] == ["sources","delta","final"]
+    #The ui shows the full document next to the answer
+    assert events[0]["sources"][0]["content"] == DOCUMENT.content
+    assert events[-1]["stop_reason"] == "End of sequence!"
+    assert len(chat_model.prefilled) == 1
+    assert scheduler.active == [] and metrics.get("chat_completed_requests") == 1
+
+def test_no_prefill_while_the_slots_are_busy():
+    metrics = MetricsRegistry()
+    scheduler = ChatScheduler(metrics,slots=1)
+    chat_model = FakeChatModel()
+    pipeline = BlockingPipeline()
+    pipeline.release.set()
+    router = make_router(chat_model,pipeline,scheduler,metrics)
+
+    async def run():
+        running = scheduler.submit("other")
+        events = asyncio.ensure_future(collect(await router.rag_streaming(RagChatRequest(question="Who wrote Faust?"),HTTP_REQUEST)))
+        while len(scheduler.queue) == 0:
+            await asyncio.sleep(0.01)
+        scheduler.release(running)
+        return await events
+
+    events = asyncio.run(run())
+    assert [event["type"] for event in events] == ["sources","queue","delta","final"]
+    assert chat_model.prefilled == []
+
+class FailingCounter(FakeChatModel):
+    def count_tokens(self,text):
+        raise RuntimeError("The tokenizer isn't loaded")
+
+class FakeCompressor():
+    def compress(self,question,contexts,answer_offsets,budget):
+        return SimpleNamespace(contexts=contexts,tokens=1,original_tokens=1,ratio=1.0)
+
+def test_failing_digests_fall_back_to_the_full_contexts():
+    metrics = MetricsRegistry()
+    scheduler = ChatScheduler(metrics,slots=1)
+    chat_model = FailingCounter()
+    pipeline = BlockingPipeline(Document(id="faust",content=DOCUMENT.content,meta={DIGEST_META_KEY:{"text":"Goethe wrote Faust."}}))
+    pipeline.release.set()
+    router = make_router(chat_model,pipeline,scheduler,metrics)
+    router.context_tokens = 1
+    router.context_compressor = FakeCompressor()
+
+    async def run():
+        return await collect(await router.rag_streaming(RagChatRequest(question="Who wrote Faust?"),HTTP_REQUEST))
+
+    events = asyncio.run(run())
+    assert [event["type"] for event in events] == ["sources","delta","final"]
+    assert DOCUMENT.content in chat_model.prompts[0][-1].content
@@ -0,0 +1,40 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import json
+from api.rag import RagPromptTemplate,DEFAULT_RAG_TEMPLATES,load_rag_templates
+
+def test_alpaca_template_puts_hints_into_the_instruction():
+    template = DEFAULT_RAG_TEMPLATES["alpaca"]
+    messages = template.build("Who wrote Faust?",["Goethe wrote Faust.","Faust is a play."],["Goethe","a play"],include_answer_spans=True)
+    
+    assert [message.role for message in messages] == ["system","system"]
+    assert messages[0] == template.static_messages()[0]
+    assert 'Question:"Who wrote Faust?"' in messages[1].content
+    assert 'Hint for context 1: "Goethe"' in messages[1].content
+    assert 'Context 2: "Faust is a play."' in messages[1].content
+    assert "{" not in messages[1].content
+
+def test_chatgpt_template_places_hints_after_each_context():
+    template = DEFAULT_RAG_TEMPLATES["chatgpt"]
+    without_hints = template.build("Who?",["A {curly} context"],["A"])
+    with_hints = template.build("Who?",["A {curly} context"],["A"],include_answer_spans=True)
+    
+    assert len(template.static_messages()) == 1
+    assert without_hints[1].content == 'Question:Who?\nContexts:Context 1:"A {curly} context"'
+    assert 'Context 1:"A {curly} context"\nHint for context 1: "A"' in with_hints[1].content
+
+def test_templates_can_be_loaded_from_a_file(tmp_path):
+    path = tmp_path/"templates.json"
+    path.write_text(json.dumps({"short":{"messages":[{"role":"user","content":"{contexts}\n{question}"}],"context":"- {content}"}}))
+    templates = load_rag_templates(str(path))
+    
+    assert set(templates) == {"alpaca","chatgpt","short"}
+    assert templates["short"].static_messages() == []
+    assert templates["short"].build("Why?",["a","b"],["a","b"])[0].content == "- a\n- b\nWhy?"
@@ -0,0 +1,68 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+from api.response_cache import ChatResponseCache,CachedResponse,response_cache_key,replay_chunks
+
+MODEL = {"name":"llm-rs","model":"test","accelerator":"CPU"}
+
+def test_cache_key_normalizes_messages():
+    key = response_cache_key(MODEL,[{"role":"user","content":"Hello "}],{"top_k":1},["Human:","AI:"])
+    assert key == response_cache_key(MODEL,[{"role":"user","content":"Hello"}],{"top_k":1},["AI:","Human:"])
+    assert key != response_cache_key(MODEL,[{"role":"user","content":"Hello"}],{"top_k":2},["Human:","AI:"])
+    assert key != response_cache_key({**MODEL,"model":"other"},[{"role":"user","content":"Hello"}],{"top_k":1},["Human:","AI:"])
+
+def test_cache_spills_evicted_entries_to_disk(tmp_path):
+    cache = ChatResponseCache(max_entries=1,spill_dir=str(tmp_path),max_disk_entries=1)
+    cache.put("a",CachedResponse(content="first",stop_reason="Max Tokens!"))
+    cache.put("b",CachedResponse(content="second"))
+    assert list(cache.entries) == ["b"]
+    assert os.listdir(tmp_path) == ["a.json"]
+    
+    #Loading a spilled entry moves it back into memory and spills the other one
+    assert cache.get("a") == CachedResponse(content="first",stop_reason="Max Tokens!")
+    assert list(cache.entries) == ["a"]
+    assert os.listdir(tmp_path) == ["b.json"]
+    
+    cache.put("c",CachedResponse(content="third"))
+    assert os.listdir(tmp_path) == ["a.json"]
+    assert cache.get("b") is None
+    
+def test_spilled_entries_are_tracked_in_memory(tmp_path,monkeypatch):
+    previous = ChatResponseCache(max_entries=1,spill_dir=str(tmp_path))
+    for key in "abc":
+        previous.put(key,CachedResponse(content=key))
+    assert sorted(os.listdir(tmp_path)) == ["a.json","b.json"]
+    os.utime(tmp_path/"a.json",(1,1))
+    os.utime(tmp_path/"b.json",(2,2))
+    
+    #The files of a previous run are picked up once and bounded to the new limit
+    cache = ChatResponseCache(max_entries=1,spill_dir=str(tmp_path),max_disk_entries=1)
+    assert list(cache.spilled) == ["b"]
+    assert os.listdir(tmp_path) == ["b.json"]
+    
+    def listdir(path):
+        raise AssertionError("The spill directory is listed on the request path")
+    monkeypatch.setattr(os,"listdir",listdir)
+    cache.put("d",CachedResponse(content="d"))
+    cache.put("e",CachedResponse(content="e"))
+    assert list(cache.spilled) == ["d"]
+    assert cache.get("b") is None
+    assert cache.get("d") == CachedResponse(content="d")
+    assert list(cache.spilled) == ["e"]
+    
+def test_disabled_cache_stores_nothing():
+    cache = ChatResponseCache(max_entries=0)
+    cache.put("a",CachedResponse(content="first"))
+    assert cache.get("a") is None
+
+def test_replay_chunks_restore_the_content():
+    content = " Hello  world,\nhow are you? "
+    chunks = list(replay_chunks(content))
+    assert "".join(chunks) == content
+    assert len(chunks) == 5
@@ -0,0 +1,65 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import asyncio
+import pytest
+from api.metrics import MetricsRegistry
+from api.scheduling import ChatScheduler,QueueFullError,QueueTimeoutError
+
+def test_scheduler_serves_clients_in_turns():
+    async def run():
+        scheduler = ChatScheduler(MetricsRegistry(),slots=1)
+        running = scheduler.submit("a")
+        a2 = scheduler.submit("a")
+        a3 = scheduler.submit("a")
+        b1 = scheduler.submit("b")
+        assert running.started
+        assert [scheduler.position(t) for t in (a2,a3,b1)] == [1,3,2]
+        scheduler.release(running)
+        assert a2.started
+        scheduler.release(a2)
+        assert b1.started
+        assert scheduler.position(a3) == 1
+    asyncio.run(run())
+    
+def test_scheduler_prefers_lower_priority_values():
+    async def run():
+        scheduler = ChatScheduler(MetricsRegistry(),slots=1)
+        running = scheduler.submit("a")
+        low = scheduler.submit("b",priority=1)
+        high = scheduler.submit("c",priority=0)
+        scheduler.release(running)
+        assert high.started and not low.started
+    asyncio.run(run())
+    
+def test_scheduler_reports_positions_until_started():
+    async def run():
+        metrics = MetricsRegistry()
+        scheduler = ChatScheduler(metrics,slots=1)
+        running = scheduler.submit("a")
+        waiting = scheduler.submit("b")
+        asyncio.get_running_loop().call_later(0.05,scheduler.release,running)
+        positions = [position async for position in scheduler.wait(waiting,interval=0.01)]
+        assert positions == [1]
+        assert waiting.started
+        assert metrics.snapshot()["observations"]["chat_queue_wait_seconds"]["count"] == 2
+    asyncio.run(run())
+    
+def test_scheduler_rejects_and_times_out():
+    async def run():
+        scheduler = ChatScheduler(MetricsRegistry(),slots=1,max_queue=1,max_wait=0.05)
+        scheduler.submit("a")
+        waiting = scheduler.submit("b")
+        with pytest.raises(QueueFullError):
+            scheduler.submit("c")
+        with pytest.raises(QueueTimeoutError):
+            async for _ in scheduler.wait(waiting,interval=0.01):
+                pass
+        assert len(scheduler.queue) == 0
+    asyncio.run(run())
@@ -0,0 +1,26 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+from haystack.schema import Document
+from api.sentences import split_sentences
+from api.context_compression import ContextCompressor
+from api.custom_nodes.narrowing_nodes import ContextNarrowingNode
+
+def test_split_sentences():
+    text = "First one. Second one!\n  Third without end"
+    assert [text[start:end] for start,end in split_sentences(text)] == ["First one.","Second one!","Third without end"]
+
+def test_narrowing_and_compression_cut_passages_alike():
+    text = "Intro line\nThe capital of France is Paris.  Filler words here?! " + " ".join(["More filler words."]*20)
+
+    narrowed = ContextNarrowingNode(max_words=5,window_sentences=0).narrow("capital of France",Document(content=text))
+    assert [text[span.original_start:span.original_start+span.length] for span in narrowed.spans] == ["The capital of France is Paris."]
+
+    compressor = ContextCompressor(lambda texts:[[float("France" in text),1.0] for text in texts],lambda text:len(text.split()))
+    assert compressor.compress("France",[text],[None],budget=6).contexts == ["The capital of France is Paris."]
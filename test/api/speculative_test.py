@@ -0,0 +1,87 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import time
+import logging
+import pytest
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+from api.speculative import SpeculativeDecoder
+from api.chat_models import HF_Gpu_Adapter
+from schemas.chat import ChatMessage
+
+MODEL = "gpt2-medium"
+DRAFT_MODEL = "distilgpt2"
+PROMPT = "The history of the Roman Empire began when"
+
+@pytest.fixture(scope="module")
+def models():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    model = AutoModelForCausalLM.from_pretrained(MODEL).eval()
+    draft_model = AutoModelForCausalLM.from_pretrained(DRAFT_MODEL).eval()
+    return model,draft_model,tokenizer
+
+def _generate(decoder,tokenizer,config):
+    sequence = decoder.submit(lambda: {"input_ids":tokenizer(PROMPT,return_tensors="pt")["input_ids"]},config)
+    return "".join(sequence.stream),sequence
+
+def test_greedy_speculative_decoding_matches_main_model(models):
+    model,draft_model,tokenizer = models
+    decoder = SpeculativeDecoder(model,draft_model,tokenizer,device="cpu",num_draft_tokens=4)
+    text,sequence = _generate(decoder,tokenizer,GenerationConfig(max_new_tokens=40,do_sample=False))
+    
+    input_ids = tokenizer(PROMPT,return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        expected = model.generate(input_ids=input_ids,max_new_tokens=40,do_sample=False,pad_token_id=tokenizer.eos_token_id)
+    assert text == tokenizer.decode(expected[0][input_ids.shape[1]:],skip_special_tokens=True)
+    assert sequence.stop_reason in ("Max Tokens!","End of sequence!")
+    assert decoder.stats()["proposed_tokens"] > 0
+    
+def test_speculative_decoding_can_sample(models):
+    model,draft_model,tokenizer = models
+    torch.manual_seed(0)
+    decoder = SpeculativeDecoder(model,draft_model,tokenizer,device="cpu",num_draft_tokens=4)
+    text,sequence = _generate(decoder,tokenizer,GenerationConfig(max_new_tokens=30,do_sample=True,top_k=40,temperature=0.8))
+    assert len(text) > 0
+    assert len(sequence.generated_ids) <= 30
+    
+def test_speculative_decoding_speedup(models):
+    model,draft_model,tokenizer = models
+    config = GenerationConfig(max_new_tokens=64,do_sample=False)
+    
+    #Without drafts every step is a plain forward pass of the main model
+    baseline = SpeculativeDecoder(model,draft_model,tokenizer,device="cpu",num_draft_tokens=0)
+    started = time.perf_counter()
+    _,baseline_sequence = _generate(baseline,tokenizer,config)
+    baseline_time = (time.perf_counter()-started)/len(baseline_sequence.generated_ids)
+    
+    decoder = SpeculativeDecoder(model,draft_model,tokenizer,device="cpu",num_draft_tokens=4)
+    started = time.perf_counter()
+    _,sequence = _generate(decoder,tokenizer,config)
+    speculative_time = (time.perf_counter()-started)/len(sequence.generated_ids)
+    
+    stats = decoder.stats()
+    print(f"acceptance rate {stats['acceptance_rate']:.2f}, {stats['tokens_per_main_pass']:.2f} tokens per pass, speedup {baseline_time/speculative_time:.2f}x")
+    assert stats["tokens_per_main_pass"] >= 1
+    
+def test_adapter_reports_speculative_stats(caplog):
+    #The draft model doubles as main model, the greedy drafts are always accepted
+    adapter = HF_Gpu_Adapter(base_model=DRAFT_MODEL,use_peft=False,adapter_model="",use_8bit=False,apply_optimications=False,
+                             model_prototype=AutoModelForCausalLM,tokenizer_prototype=AutoTokenizer,device="cpu",
+                             max_batch_size=4,draft_model=DRAFT_MODEL,num_draft_tokens=4)
+    with caplog.at_level(logging.INFO):
+        adapter.load()
+        text,stop_reason = adapter.generate([ChatMessage(role="user",content=PROMPT)],GenerationConfig(max_new_tokens=21,do_sample=False))
+    
+    assert "CHAT_BATCH_SIZE=4 is ignored" in caplog.text
+    assert "Speculative decoding: accepted" in caplog.text
+    assert stop_reason in ("Max Tokens!","End of sequence!")
+    stats = adapter.settings()["speculative_decoding"]
+    assert stats["acceptance_rate"] == 1.0
+    assert stats["tokens_per_main_pass"] > 1
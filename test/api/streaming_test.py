@@ -0,0 +1,172 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+    
+import time
+import asyncio
+import threading
+from api.streaming import TokenStream,StopWordMatcher,IncrementalDetokenizer
+
+def produce(stream:TokenStream,chunks,delay:float=0.0):
+    def run():
+        for chunk in chunks:
+            if delay:
+                time.sleep(delay)
+            if not stream.put(chunk):
+                break
+        stream.end()
+    thread = threading.Thread(target=run,daemon=True)
+    thread.start()
+    return thread
+
+def test_stream_yields_all_chunks_in_order():
+    stream = TokenStream()
+    produce(stream,["a","b","c"])
+    assert list(stream) == ["a","b","c"]
+    assert stream.stats()["tokens"] == 3
+    
+def test_stream_can_be_consumed_async():
+    stream = TokenStream()
+    
+    async def consume():
+        produce(stream,[str(i) for i in range(20)],delay=0.001)
+        return [chunk async for chunk in stream]
+    
+    assert asyncio.run(consume()) == [str(i) for i in range(20)]
+    
+def test_stream_sends_heartbeats_while_idle():
+    stream = TokenStream()
+    
+    async def consume():
+        def slow_producer():
+            time.sleep(0.12)
+            stream.put("a")
+            stream.end("Max Tokens!")
+        threading.Thread(target=slow_producer,daemon=True).start()
+        return [chunk async for chunk in stream.heartbeat(0.05)]
+    
+    chunks = asyncio.run(consume())
+    assert chunks[-1] == "a"
+    assert len(chunks) >= 2 and all(chunk is None for chunk in chunks[:-1])
+    assert stream.stop_reason == "Max Tokens!"
+    
+def test_stream_keeps_first_stop_reason():
+    stream = TokenStream()
+    stream.cancel()
+    stream.end("Max Tokens!")
+    assert stream.stop_reason == "Cancelled!"
+    
+def test_stream_applies_backpressure():
+    stream = TokenStream(max_buffer=2)
+    assert stream.put("a")
+    assert stream.put("b")
+    assert not stream.put("c",timeout=0.05)
+    assert next(iter(stream)) == "a"
+    assert stream.put("c",timeout=0.05)
+    
+def test_cancel_stops_producer():
+    stream = TokenStream(max_buffer=1)
+    thread = produce(stream,["a"]*100)
+    time.sleep(0.05)
+    stream.cancel()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    assert stream.cancelled
+    
+def test_stats_report_latencies():
+    stream = TokenStream()
+    produce(stream,["a","b","c"],delay=0.01)
+    list(stream)
+    stats = stream.stats()
+    assert stats["time_to_first_token"] >= 0.01
+    assert stats["inter_token_latency"] > 0
+    
+def feed_all(matcher:StopWordMatcher,chunks):
+    emitted = ""
+    for chunk in chunks:
+        released,stopped = matcher.feed(chunk)
+        emitted += released
+        if stopped:
+            return emitted,True
+    return emitted+matcher.flush(),False
+    
+def test_matcher_holds_back_partial_stop_words():
+    matcher = StopWordMatcher(["Human:"])
+    released,stopped = matcher.feed("Hello Hum")
+    assert released == "Hello "
+    assert not stopped
+    released,stopped = matcher.feed("an:")
+    assert released == ""
+    assert stopped
+    
+def test_matcher_releases_text_once_it_diverges():
+    matcher = StopWordMatcher(["Human:"])
+    assert feed_all(matcher,["Hum","ble ","pie"]) == ("Humble pie",False)
+    
+def test_matcher_finds_any_stop_word():
+    matcher = StopWordMatcher(["Human:","### Instruction","</s>"])
+    assert feed_all(matcher,["The answer is 42.","#","## Inst","ruction: more"]) == ("The answer is 42.",True)
+    
+def test_matcher_handles_overlapping_prefixes():
+    matcher = StopWordMatcher(["abcd","bce"])
+    assert feed_all(matcher,["xab","ce"]) == ("xa",True)
+    
+def test_matcher_without_stop_words_passes_everything():
+    matcher = StopWordMatcher([])
+    assert feed_all(matcher,["Human:","AI:"]) == ("Human:AI:",False)
+    
+class ByteTokenizer():
+    """
+    Byte level tokenizer, multi-byte characters are split over multiple tokens.
+    """
+    def __init__(self) -> None:
+        self.decoded_lengths = []
+        
+    def encode(self,text:str):
+        return list(text.encode("utf-8"))
+    
+    def decode(self,token_ids):
+        self.decoded_lengths.append(len(token_ids))
+        return bytes(token_ids).decode("utf-8",errors="replace")
+    
+class SentencePieceLikeTokenizer():
+    """
+    Word level tokenizer which marks word starts with "▁" and drops the leading space of a decoded sequence.
+    """
+    def __init__(self,words) -> None:
+        self.vocab = words
+        
+    def decode(self,token_ids):
+        return "".join(self.vocab[id] for id in token_ids).replace("▁"," ").lstrip(" ")
+    
+def detokenize(detokenizer:IncrementalDetokenizer,token_ids):
+    text = ""
+    for id in token_ids:
+        text += detokenizer.put([id])
+    return text + detokenizer.flush()
+    
+def test_detokenizer_holds_back_incomplete_characters():
+    tokenizer = ByteTokenizer()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    text = "Grüße 👋"
+    pieces = [detokenizer.put([id]) for id in tokenizer.encode(text)]
+    assert all("\ufffd" not in piece for piece in pieces)
+    assert "".join(pieces) + detokenizer.flush() == text
+    
+def test_detokenizer_keeps_sentencepiece_spaces():
+    tokenizer = SentencePieceLikeTokenizer(["▁Hello","▁wor","ld","!","▁How","▁are","▁you"])
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    assert detokenize(detokenizer,[0,1,2,3,4,5,6]) == "Hello world! How are you"
+    
+def test_detokenizer_decodes_constant_window():
+    tokenizer = ByteTokenizer()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    text = "Lorem ipsum dolor sit amet, äöü. " * 200
+    assert detokenize(detokenizer,tokenizer.encode(text)) == text
+    #The decoded window must not grow with the length of the output
+    assert max(tokenizer.decoded_lengths) <= 4
@@ -0,0 +1,45 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+from api.metrics import MetricsRegistry
+from api.streaming import TokenStream
+from api.telemetry import GenerationTelemetry,GenerationRecord
+
+def test_record_from_stream_falls_back_to_the_time_to_first_token():
+    stream = TokenStream()
+    stream.prompt_tokens = 10
+    stream.put("Hello")
+    stream.put(" world")
+    stream.end("End of sequence!")
+    record = GenerationRecord.from_stream(stream,queue_wait_seconds=0.5)
+
+    assert record.queue_wait_seconds == 0.5
+    assert record.completion_tokens == 2
+    assert record.prompt_eval_seconds == record.time_to_first_token
+    assert record.stop_reason == "End of sequence!"
+
+    stream.prompt_eval_seconds = 2.0
+    assert GenerationRecord.from_stream(stream).prompt_seconds_per_token == 0.2
+
+def test_telemetry_feeds_percentiles_and_stop_reasons():
+    metrics = MetricsRegistry()
+    telemetry = GenerationTelemetry(metrics)
+    for tokens_per_second in (5.0,10.0,15.0):
+        telemetry.record(GenerationRecord(prompt_tokens=100,prompt_eval_seconds=1.0,tokens_per_second=tokens_per_second,stop_reason="Max Tokens!"))
+    telemetry.record(GenerationRecord(queue_wait_seconds=0.1,stop_reason="Stopword detected!"))
+    snapshot = telemetry.snapshot()
+
+    assert snapshot["generations"] == 4
+    assert snapshot["stop_reasons"] == {"Max Tokens!":3,"Stopword detected!":1}
+    assert snapshot["percentiles"]["tokens_per_second"]["p50"] == 10.0
+    assert snapshot["percentiles"]["prompt_seconds_per_token"]["count"] == 3
+    assert snapshot["percentiles"]["queue_wait_seconds"]["count"] == 1
+    assert "time_to_first_token" not in snapshot["percentiles"]
+    assert metrics.get("chat_generation_stop_max_tokens") == 3
+    assert telemetry.summary("prompt_seconds_per_token")["p50"] == 0.01
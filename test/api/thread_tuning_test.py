@@ -0,0 +1,52 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import pytest
+from api import thread_tuning
+from api.thread_tuning import ThreadCalibration,thread_candidates
+
+SPEEDS = {4:6.0,8:9.0,16:7.5}
+
+def test_calibration_picks_the_fastest_and_persists_it(tmp_path):
+    path = str(tmp_path/"calibration.json")
+    measured = []
+    def measure(threads):
+        measured.append(threads)
+        return SPEEDS[threads]
+
+    threads,speeds = ThreadCalibration(path,fingerprint="host-a").calibrate("model",measure,[4,8,16])
+    assert threads == 8
+    assert speeds == SPEEDS
+
+    #A later start on the same host reuses the result
+    threads,speeds = ThreadCalibration(path,fingerprint="host-a").calibrate("model",measure,[4,8,16])
+    assert (threads,speeds) == (8,{})
+    assert measured == [4,8,16]
+
+    #Other hosts and models are calibrated separately
+    assert ThreadCalibration(path,fingerprint="host-b").lookup("model") is None
+    assert ThreadCalibration(path,fingerprint="host-a").lookup("other-model") is None
+
+def test_calibration_skips_failing_candidates(tmp_path):
+    def measure(threads):
+        if threads == 8:
+            raise RuntimeError("Out of memory")
+        return SPEEDS[threads]
+
+    calibration = ThreadCalibration(str(tmp_path/"calibration.json"),fingerprint="host")
+    assert calibration.calibrate("model",measure,[4,8,16])[0] == 16
+    with pytest.raises(RuntimeError):
+        calibration.calibrate("broken",lambda threads:1/0,[4])
+
+def test_candidates_cover_physical_and_logical_cores(monkeypatch):
+    monkeypatch.setattr(thread_tuning.psutil,"cpu_count",lambda logical=True:16 if logical else 8)
+    monkeypatch.setattr(thread_tuning.os,"sched_getaffinity",lambda pid:set(range(16)),raising=False)
+
+    assert thread_candidates() == [4,6,8,16]
+    assert thread_candidates(instances=5,configured=12) == [6,8,12,16]
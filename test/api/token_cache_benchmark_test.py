@@ -0,0 +1,125 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import time
+import sysconfig
+import pytest
+import torch
+from haystack.schema import Document
+from haystack.nodes import TransformersReader
+from haystack.document_stores import InMemoryDocumentStore
+from api.custom_nodes.token_cache_nodes import CachedTokenEmbeddingRetriever,build_token_cache_node
+
+PASSAGE_WORDS = 200
+DOCUMENTS = 40
+QUERIES = ["how is the file closed","which error is raised for invalid arguments","what does the function return","when is the lock released"]
+
+def corpus_files():
+    return sorted(Path(sysconfig.get_paths()["stdlib"]).glob("*.py"))[:300]
+
+@pytest.fixture(scope="module")
+def models(tmp_path_factory):
+    """
+    Random weights with the shapes of the default models (all-MiniLM-L12 embedder and reader) and a wordpiece vocabulary
+    trained on the standard library, tokenization and inference cost the same as with the real checkpoints.
+    """
+    from tokenizers import BertWordPieceTokenizer
+    from transformers import BertConfig,BertModel,BertForQuestionAnswering,BertTokenizerFast
+    from sentence_transformers import SentenceTransformer,models
+
+    directory = tmp_path_factory.mktemp("minilm")
+    wordpiece = BertWordPieceTokenizer(lowercase=True)
+    wordpiece.train([str(file) for file in corpus_files()],vocab_size=30522)
+    wordpiece.save_model(str(directory))
+    tokenizer = BertTokenizerFast(vocab_file=str(directory/"vocab.txt"))
+
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(tokenizer),hidden_size=384,num_hidden_layers=12,num_attention_heads=12,intermediate_size=1536)
+    for name,model_class in (("bert",BertModel),("reader",BertForQuestionAnswering)):
+        model_class(config).save_pretrained(directory/name)
+        tokenizer.save_pretrained(directory/name)
+
+    transformer = models.Transformer(str(directory/"bert"))
+    embedder = SentenceTransformer(modules=[transformer,models.Pooling(transformer.get_word_embedding_dimension())])
+    embedder.save(str(directory/"embedder"))
+    return directory
+
+@pytest.fixture(scope="module")
+def passages():
+    words = [word for file in corpus_files() for word in file.read_text(encoding="utf-8",errors="ignore").split()]
+    return [" ".join(words[start:start+PASSAGE_WORDS]) for start in range(0,PASSAGE_WORDS*DOCUMENTS,PASSAGE_WORDS)]
+
+class TimedTokenizer():
+    """
+    Sums the time spent in the wrapped tokenizer.
+    """
+    def __init__(self,tokenizer) -> None:
+        self._tokenizer = tokenizer
+        self.seconds = 0.0
+
+    def __call__(self,*args,**kwargs):
+        started = time.perf_counter()
+        try:
+            return self._tokenizer(*args,**kwargs)
+        finally:
+            self.seconds += time.perf_counter()-started
+
+    def __getattr__(self,name:str):
+        return getattr(self._tokenizer,name)
+
+def test_reader_tokenization_share(models,passages):
+    """
+    Times the tokenization inside the reader per query over 10 passages, run with `-s` to see the numbers.
+    """
+    reader = TransformersReader(model_name_or_path=str(models/"reader"),use_gpu=False,max_seq_len=512,context_window_size=150)
+    tokenizer = TimedTokenizer(reader.model.tokenizer)
+    reader.model.tokenizer = tokenizer
+    documents = [Document(content=passage) for passage in passages[:10]]
+    reader.predict(query=QUERIES[0],documents=documents,top_k=1)
+
+    tokenizer.seconds = 0.0
+    started = time.perf_counter()
+    for query in QUERIES:
+        assert len(reader.predict(query=query,documents=documents,top_k=1)["answers"]) > 0
+    elapsed = time.perf_counter()-started
+
+    share = tokenizer.seconds/elapsed
+    print(f"Reader: {1000*elapsed/len(QUERIES):.1f} ms per query, {1000*tokenizer.seconds/len(QUERIES):.1f} ms of it tokenizing ({100*share:.1f}%)")
+    #Caching the reader tokens could at most save this share
+    assert share < 0.1
+
+def test_reindex_with_cached_tokens(models,passages):
+    """
+    Times `update_embeddings` over the same documents with and without `meta['token_cache']`, run with `-s` to see the numbers.
+    """
+    retriever = CachedTokenEmbeddingRetriever(document_store=None,embedding_model=str(models/"embedder"),model_format="sentence_transformers",use_gpu=False,progress_bar=False)
+    node = build_token_cache_node(retriever)
+    transformer = retriever.embedding_encoder.embedding_model._first_module()
+    tokenizer = TimedTokenizer(transformer.tokenizer)
+    transformer.tokenizer = tokenizer
+    retriever.embed_documents([Document(content=passages[0])])
+
+    timings = {}
+    for cached in (False,True):
+        documents = [Document(content=passage) for passage in passages]
+        if cached:
+            node.cache_tokens(documents)
+        document_store = InMemoryDocumentStore(embedding_dim=384,use_gpu=False,progress_bar=False)
+        document_store.write_documents(documents)
+        runs = []
+        for _ in range(2):
+            tokenizer.seconds = 0.0
+            started = time.perf_counter()
+            document_store.update_embeddings(retriever,update_existing_embeddings=True)
+            runs.append(time.perf_counter()-started)
+        timings[cached] = min(runs)
+        print(f"Reindex {'with' if cached else 'without'} token cache: {timings[cached]:.2f}s for {DOCUMENTS} documents, {tokenizer.seconds:.3f}s of it tokenizing")
+    print(f"Speedup: {timings[False]/timings[True]:.2f}x")
+    #The cached documents never reach the tokenizer, the cache can at most save its share of the reindex
+    assert tokenizer.seconds == 0.0
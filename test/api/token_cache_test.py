@@ -0,0 +1,88 @@
+import os
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent.parent
+src=str(root/"src")
+if src not in sys.path:
+    sys.path.insert(0, src)
+
+import pytest
+import numpy as np
+from haystack.schema import Document
+from api.custom_nodes.token_cache_nodes import (CachedTokenEmbeddingRetriever,TokenCacheNode,TOKEN_CACHE_META_KEY,
+                                                build_token_cache_node,disable_token_cache_indexing,get_cached_token_ids,strip_token_cache)
+
+WORDS = ["the","cat","sat","on","a","mat","dog","ran","to","park","and","slept","in","sun","red","big"]
+
+@pytest.fixture(scope="module")
+def retriever(tmp_path_factory):
+    """
+    A tiny random bert wrapped as sentence transformer, the vectors are meaningless but deterministic.
+    """
+    import torch
+    from transformers import BertConfig,BertModel,BertTokenizerFast
+    from sentence_transformers import SentenceTransformer,models
+
+    directory = tmp_path_factory.mktemp("embedder")
+    bert_directory = directory/"bert"
+    bert_directory.mkdir()
+    (bert_directory/"vocab.txt").write_text("\n".join(["[PAD]","[UNK]","[CLS]","[SEP]","[MASK]"]+WORDS))
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=5+len(WORDS),hidden_size=16,num_hidden_layers=1,num_attention_heads=2,intermediate_size=32,max_position_embeddings=64)
+    BertModel(config).save_pretrained(bert_directory)
+    BertTokenizerFast(vocab_file=str(bert_directory/"vocab.txt")).save_pretrained(bert_directory)
+
+    transformer = models.Transformer(str(bert_directory),max_seq_length=16)
+    model = SentenceTransformer(modules=[transformer,models.Pooling(transformer.get_word_embedding_dimension())])
+    model.save(str(directory/"model"))
+    return CachedTokenEmbeddingRetriever(document_store=None,embedding_model=str(directory/"model"),model_format="sentence_transformers",use_gpu=False,progress_bar=False)
+
+def documents():
+    return [
+        Document(content="the cat sat on a mat"),
+        Document(content="a dog ran to the park and slept in the sun"),
+        #Longer than the max sequence length, the cached ids are truncated like the tokenizer would
+        Document(content=" ".join(WORDS*3)),
+    ]
+
+def test_cached_tokens_embed_like_the_text(retriever):
+    node = build_token_cache_node(retriever)
+    cached = node.cache_tokens(documents())
+    assert all(TOKEN_CACHE_META_KEY in doc.meta for doc in cached)
+
+    expected = retriever.embed_documents(documents())
+    #Mixes documents with and without cached ids, the order of the vectors is kept
+    mixed = [cached[0],documents()[1],cached[2]]
+    np.testing.assert_allclose(retriever.embed_documents(cached),expected,atol=1e-5)
+    np.testing.assert_allclose(retriever.embed_documents(mixed),expected,atol=1e-5)
+
+def test_token_cache_round_trip(retriever):
+    tokenizer = retriever.embedding_encoder.embedding_model.tokenizer
+    node = TokenCacheNode(tokenizers=[tokenizer])
+    output,_ = node.run(documents=documents())
+    document = output["documents"][0]
+    assert get_cached_token_ids(document,tokenizer) == tokenizer("the cat sat on a mat")["input_ids"]
+
+    output,_ = node.run_batch(documents=[documents(),[Document(content="big red dog")]])
+    assert get_cached_token_ids(output["documents"][1][0],tokenizer) == tokenizer("big red dog")["input_ids"]
+
+    stripped = strip_token_cache([document,Document(content="no cache")])
+    assert TOKEN_CACHE_META_KEY not in stripped[0].meta
+    assert get_cached_token_ids(stripped[0],tokenizer) is None
+
+def test_token_cache_is_not_indexed():
+    class FakeIndices():
+        def __init__(self) -> None:
+            self.mappings = []
+        def put_mapping(self,index,body):
+            self.mappings.append((index,body))
+
+    class FakeStore():
+        index = "document"
+        def __init__(self) -> None:
+            self.client = type("Client",(),{"indices":FakeIndices()})()
+
+    store = FakeStore()
+    disable_token_cache_indexing(store)
+    assert store.client.indices.mappings == [("document",{"properties":{TOKEN_CACHE_META_KEY:{"type":"object","enabled":False}}})]